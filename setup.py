@@ -14,7 +14,8 @@ setup(
   author_email = 'jbowen7@gmail.com',
   url = 'https://github.com/jbowen7/djangocarrot',
   keywords = ['django', 'task', 'queue'],
-  install_requires = ['pika',],
+  python_requires = '>=3.8',
+  install_requires = ['Django>=4.1', 'pika>=1.0',],
   package_dir={'': 'src'},
   packages=find_packages(where='src', exclude=[]),
 )
@@ -0,0 +1,299 @@
+import asyncio
+import logging
+import weakref
+from collections import OrderedDict
+
+import pika
+from asgiref.sync import sync_to_async
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+from carrot import amqp, metrics
+from carrot.amqp import RabbitConnection
+from carrot.settings import carrot_settings
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AsyncRabbitPublisher:
+	"""
+	A publisher for coroutines, on a pika AsyncioConnection with publisher confirms. Any number of coroutines
+	of the event loop may publish at once: their messages are multiplexed on one channel, and each publish
+	returns once the broker confirms its message. Up to `window` messages are kept in flight.
+
+	Example:
+	publisher = AsyncRabbitPublisher(exchange='task_queue')
+	await asyncio.gather(*(publisher.publish(str(i)) for i in range(1000)))
+	"""
+	DEFAULT_WINDOW = 1000
+	DEFAULT_CONFIRM_TIMEOUT = 30
+
+	def __init__(
+			self,
+			user=RabbitConnection.DEFAULT_USER,
+			password=RabbitConnection.DEFAULT_PASSWORD,
+			host=RabbitConnection.DEFAULT_HOST,
+			port=RabbitConnection.DEFAULT_PORT,
+			exchange=RabbitConnection.DEFAULT_EXCHANGE,
+			heartbeat=RabbitConnection.DEFAULT_HEARTBEAT,
+			blocked_connection_timeout=RabbitConnection.DEFAULT_BLOCKED_CONNECTION_TIMEOUT,
+			encoding=RabbitConnection.DEFAULT_MESSAGE_ENCODING,
+			window=DEFAULT_WINDOW,
+	):
+		"""
+		:param window: the maximum number of published messages waiting on a confirm
+		"""
+		self.exchange = exchange
+		self.message_encoding = encoding
+		self.window = int(window)
+		assert self.window > 0, "The confirm window must be a positive int"
+
+		self._parameters = pika.ConnectionParameters(
+			credentials=pika.PlainCredentials(username=user, password=password),
+			host=host,
+			port=port,
+			heartbeat=int(heartbeat),
+			blocked_connection_timeout=int(blocked_connection_timeout),
+		)
+
+		self._connection = None
+		self._channel = None
+		self._connecting = None
+		self._opening = set()
+		self._closing = None
+		self._slots = None
+		self._delivery_tag = 0
+		self._unconfirmed = OrderedDict()
+
+	@property
+	def is_open(self):
+		return self._channel is not None and self._channel.is_open
+
+	async def connect(self):
+		"""
+		Open the connection and its confirming channel. Coroutines publishing meanwhile wait on the same attempt.
+		"""
+		if self.is_open:
+			return
+		if self._connecting is None:
+			self._connecting = asyncio.ensure_future(self._connect())
+			self._connecting.add_done_callback(self._connected)
+		# Shielded, so a cancelled publisher doesn't abort the connection every other one waits on
+		await asyncio.shield(self._connecting)
+
+	async def close(self):
+		connection = self._connection
+		if connection is None or connection.is_closed:
+			return
+		self._closing = asyncio.get_running_loop().create_future()
+		if not connection.is_closing:
+			connection.close()
+		await self._closing
+
+	async def publish(self, message, exchange=None, routing_key='', encoding=None, priority=None, timeout=DEFAULT_CONFIRM_TIMEOUT):
+		"""
+		Publish a message and wait for the broker to confirm it. If the connection was lost, this makes one
+		attempt to reconnect before the message is written, like RabbitPublisher.publish.
+
+		:param str message: the body of the message to send
+		:param priority: optional message priority, only used by queues declared with a max priority
+		:param timeout: seconds to wait for the confirm
+		:raises pika.exceptions.NackError: if the broker nacked the message
+		:raises pika.exceptions.AMQPConnectionError: if the connection was lost before the message was confirmed
+		:raises TimeoutError: if the message wasn't confirmed within `timeout` seconds
+		"""
+		assert isinstance(message, (str, bytes)), "The message must be a str or bytes object"
+		exchange = exchange or self.exchange
+		assert exchange, "You must provide a name for the exchange"
+		properties = pika.BasicProperties(content_encoding=encoding or self.message_encoding, priority=priority)
+
+		if self._slots is None:
+			self._slots = asyncio.Semaphore(self.window)
+		async with self._slots:
+			try:
+				confirm = await self._publish(exchange, routing_key, message, properties)
+			except pika.exceptions.AMQPConnectionError:
+				metrics.PUBLISH_FAILURES.inc(exchange)
+				LOGGER.warning('Connection was closed while publishing. Reconnecting...')
+				confirm = await self._publish(exchange, routing_key, message, properties)
+			metrics.PUBLISHED.inc(exchange)
+
+			try:
+				return await asyncio.wait_for(confirm, timeout)
+			except Exception:
+				metrics.PUBLISH_FAILURES.inc(exchange)
+				raise
+
+	async def _publish(self, exchange, routing_key, message, properties):
+		await self.connect()
+		# The future is registered first, the confirm may arrive as soon as the loop runs again
+		delivery_tag = self._delivery_tag + 1
+		confirm = asyncio.get_running_loop().create_future()
+		self._unconfirmed[delivery_tag] = confirm
+		try:
+			self._channel.basic_publish(exchange, routing_key, message, properties=properties)
+		except Exception:
+			self._unconfirmed.pop(delivery_tag, None)
+			raise
+		self._delivery_tag = delivery_tag
+		return confirm
+
+	async def _connect(self):
+		opened = self._opening_future()
+		connection = AsyncioConnection(
+			self._parameters,
+			on_open_callback=self._resolve(opened),
+			on_open_error_callback=self._on_open_error,
+			on_close_callback=self._on_connection_closed,
+			custom_ioloop=asyncio.get_running_loop(),
+		)
+		self._connection = connection
+		try:
+			await self._opened(opened)
+
+			opened = self._opening_future()
+			connection.channel(on_open_callback=self._resolve(opened))
+			channel = await self._opened(opened)
+			channel.add_on_close_callback(self._on_channel_closed)
+
+			opened = self._opening_future()
+			channel.confirm_delivery(ack_nack_callback=self._on_confirm, callback=self._resolve(opened))
+			await self._opened(opened)
+		except BaseException:
+			if not connection.is_closed and not connection.is_closing:
+				connection.close()
+			raise
+
+		self._delivery_tag = 0
+		self._channel = channel
+
+	def _connected(self, future):
+		self._connecting = None
+		if not future.cancelled() and future.exception() is not None:
+			LOGGER.warning(f"Unable to connect the async publisher: {future.exception()}")
+
+	def _opening_future(self):
+		# Failed by the close callback if the connection is lost half way
+		future = asyncio.get_running_loop().create_future()
+		self._opening.add(future)
+		return future
+
+	async def _opened(self, future):
+		try:
+			return await future
+		finally:
+			self._opening.discard(future)
+
+	@staticmethod
+	def _resolve(future):
+		def callback(value):
+			if not future.done():
+				future.set_result(value)
+		return callback
+
+	def _fail_opening(self, error):
+		opening, self._opening = self._opening, set()
+		for future in opening:
+			if not future.done():
+				future.set_exception(error)
+
+	def _on_open_error(self, connection, error):
+		if connection is self._connection:
+			self._connection = None
+		if not isinstance(error, BaseException):
+			error = pika.exceptions.AMQPConnectionError(error)
+		self._fail_opening(error)
+
+	def _on_connection_closed(self, connection, reason):
+		if connection is self._connection:
+			self._connection = None
+			self._channel = None
+		error = reason if isinstance(reason, pika.exceptions.AMQPConnectionError) else pika.exceptions.AMQPConnectionError(reason)
+		self._fail_opening(error)
+		self._fail_unconfirmed(error)
+		if self._closing is not None and not self._closing.done():
+			self._closing.set_result(None)
+
+	def _on_channel_closed(self, channel, reason):
+		# Unconfirmed messages never will be on a new channel, and the connection is replaced with it
+		if channel is self._channel:
+			self._channel = None
+		self._fail_unconfirmed(pika.exceptions.AMQPConnectionError(f"Channel was closed before the message was confirmed: {reason}"))
+		connection = self._connection
+		if connection is not None and not connection.is_closed and not connection.is_closing:
+			connection.close()
+
+	def _on_confirm(self, method_frame):
+		"""
+		Resolves the futures of every message covered by a Basic.Ack or Basic.Nack
+		"""
+		method = method_frame.method
+		is_ack = isinstance(method, pika.spec.Basic.Ack)
+
+		if method.multiple:
+			delivery_tags = [tag for tag in self._unconfirmed if tag <= method.delivery_tag]
+		else:
+			delivery_tags = [method.delivery_tag]
+
+		for tag in delivery_tags:
+			future = self._unconfirmed.pop(tag, None)
+			if future is None or future.done():
+				continue
+			if is_ack:
+				future.set_result(True)
+			else:
+				future.set_exception(pika.exceptions.NackError([]))
+
+	def _fail_unconfirmed(self, error):
+		unconfirmed, self._unconfirmed = self._unconfirmed, OrderedDict()
+		for future in unconfirmed.values():
+			if not future.done():
+				future.set_exception(error)
+
+
+class TransportPublisher:
+	"""
+	Stands in for the AsyncRabbitPublisher when CARROT['transport'] replaces pika (e.g. the in-memory broker),
+	since transports only implement the blocking interface. Messages are published from a thread.
+	"""
+	def __init__(self, exchange):
+		self.exchange = exchange
+
+	async def publish(self, message, exchange=None, routing_key='', encoding=None, priority=None, timeout=None):
+		return await sync_to_async(self._publish, thread_sensitive=False)(message, exchange or self.exchange, routing_key, encoding, priority)
+
+	async def close(self):
+		pass
+
+	@staticmethod
+	def _publish(message, exchange, routing_key, encoding, priority):
+		from carrot.connections import pool
+
+		with pool.checkout() as publisher:
+			publisher.publish_confirmed(message, exchange=exchange, routing_key=routing_key, encoding=encoding, priority=priority)
+		return True
+
+
+# One publisher per event loop, pika's asyncio connections are bound to the loop they were opened on
+_publishers = weakref.WeakKeyDictionary()
+
+
+def get_publisher():
+	"""
+	:returns: the publisher of the running event loop, shared by every coroutine on it
+	"""
+	loop = asyncio.get_running_loop()
+	publisher = _publishers.get(loop)
+	if publisher is None:
+		if amqp._transport is not None:
+			publisher = TransportPublisher(exchange=carrot_settings['exchange'])
+		else:
+			publisher = AsyncRabbitPublisher(
+				host=carrot_settings['host'],
+				port=carrot_settings['port'],
+				user=carrot_settings['user'],
+				password=carrot_settings['password'],
+				exchange=carrot_settings['exchange'],
+				window=carrot_settings['publisher_confirm_window'],
+			)
+		_publishers[loop] = publisher
+	return publisher
@@ -1,11 +1,36 @@
+import asyncio
 import time
 import logging
 import signal
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from functools import partial
 
 import pika
 
+from carrot import metrics
+
 LOGGER = logging.getLogger(__name__)
 
+# How a MultiQueueConsumer picks the queue of its next message
+POLICY_WEIGHTED = 'weighted'
+POLICY_STRICT = 'strict'
+CONSUME_POLICIES = (POLICY_WEIGHTED, POLICY_STRICT)
+
+# Callable building a connection from pika.ConnectionParameters, None for pika.BlockingConnection
+_transport = None
+
+
+def set_transport(transport):
+	"""
+	Replace the broker transport of every connection opened from now on, e.g. with carrot.memory.MemoryConnection
+
+	:param transport: callable(parameters) returning an object with the interface of pika.BlockingConnection, or None for pika
+	"""
+	global _transport
+	_transport = transport
+
 
 class RabbitConnection:
 	DEFAULT_EXCHANGE = ''
@@ -82,7 +107,7 @@ class RabbitConnection:
 		assert parameters is None or isinstance(parameters, pika.ConnectionParameters)
 		parameters = parameters or self._parameters
 
-		self._connection = pika.BlockingConnection(parameters)
+		self._connection = (_transport or pika.BlockingConnection)(parameters)
 		self._channel = self._connection.channel()
 
 	def close(self):
@@ -102,9 +127,11 @@ class RabbitConnection:
 			self._connection = None
 			self._channel = None
 
-	def setup_queue_exchange(self, exchange=None, queue=None, routing_key=None, durable_queue=False, durable_exchange=False, exchange_type=DEFAULT_EXCHANGE_TYPE):
+	def setup_queue_exchange(self, exchange=None, queue=None, routing_key=None, durable_queue=False, durable_exchange=False, exchange_type=DEFAULT_EXCHANGE_TYPE, queue_arguments=None):
 		"""
 		Initialize the exchange and queue
+
+		:param queue_arguments: optional dict of queue arguments, e.g. x-message-ttl, x-dead-letter-exchange
 		"""
 		if not self.is_open:
 			self.connect()
@@ -117,9 +144,52 @@ class RabbitConnection:
 		assert queue, "You must provide a name for the queue"
 
 		self._channel.exchange_declare(exchange=exchange, exchange_type=exchange_type, durable=durable_exchange)
-		self._channel.queue_declare(queue, durable=durable_queue)
+		self._channel.queue_declare(queue, durable=durable_queue, arguments=queue_arguments)
 		self._channel.queue_bind(exchange=exchange, queue=queue, routing_key=routing_key)
 
+	def setup_priority_queue(self, max_priority, exchange=None, queue=None, routing_key=None, durable_queue=False, durable_exchange=False):
+		"""
+		Initialize a queue which delivers messages with a higher priority (0 to `max_priority`) first.
+		RabbitMQ can't change the arguments of an existing queue, so it has to be deleted to add or change a max priority.
+		"""
+		self.setup_queue_exchange(
+			exchange=exchange,
+			queue=queue,
+			routing_key=routing_key,
+			durable_queue=durable_queue,
+			durable_exchange=durable_exchange,
+			queue_arguments={'x-max-priority': int(max_priority)},
+		)
+
+	def setup_delay_queue(self, delay, target_routing_key, exchange=None, queue=None, durable_queue=False, durable_exchange=False):
+		"""
+		Initialize a queue where every message waits `delay` seconds, then is dead-lettered back to the
+		exchange with `target_routing_key`. Nothing consumes a delay queue.
+		"""
+		self.setup_queue_exchange(
+			exchange=exchange,
+			queue=queue,
+			routing_key=queue,
+			durable_queue=durable_queue,
+			durable_exchange=durable_exchange,
+			queue_arguments={
+				'x-message-ttl': int(delay * 1000),
+				'x-dead-letter-exchange': exchange or self.exchange,
+				'x-dead-letter-routing-key': target_routing_key,
+			},
+		)
+
+	def queue_depth(self, queue=None):
+		"""
+		:returns: the number of messages ready for delivery in the queue, via a passive queue_declare
+		"""
+		if not self.is_open:
+			self.connect()
+
+		queue = queue or self.queue
+		assert queue, "You must provide a name for the queue"
+		return self._channel.queue_declare(queue, passive=True).method.message_count
+
 
 class RabbitPublisher(RabbitConnection):
 	"""
@@ -130,13 +200,14 @@ class RabbitPublisher(RabbitConnection):
 	publisher.publish('loral igloo dolar')
 	"""
 
-	def publish(self, message, exchange=None, routing_key=None, encoding=None):
+	def publish(self, message, exchange=None, routing_key=None, encoding=None, priority=None):
 		"""
 		Publish a message to rabbitmq. This is the main purpose of this class and it's main method
 		If an attempt to publish fails because of a connection error, this will make one attempt
 		to reconnect (which might be necessary due to a heartbeat timeout)
 
 		:param str message: the body of the message to send
+		:param priority: optional message priority, only used by queues declared with a max priority
 		"""
 		assert isinstance(message, (str, bytes)), "The message must be a str or bytes object"
 		if not self.is_open:
@@ -150,18 +221,278 @@ class RabbitPublisher(RabbitConnection):
 		assert exchange, "You must provide a name for the exchange"
 
 		encoding = encoding or self.message_encoding
-		properties = pika.BasicProperties(content_encoding=encoding)
+		properties = pika.BasicProperties(content_encoding=encoding, priority=priority)
 		try:
 			self._channel.basic_publish(exchange, routing_key, message, properties=properties)
 		except pika.exceptions.AMQPConnectionError:
+			metrics.PUBLISH_FAILURES.inc(exchange)
 			LOGGER.warning(f'Connection was closed while publishing. Reconnecting...')
 			self.connect()
 			self._channel.basic_publish(exchange, routing_key, message, properties=properties)
+		metrics.PUBLISHED.inc(exchange)
+
+	def publish_batch(self, messages, exchange=None, encoding=None):
+		"""
+		Publish many messages back to back on this publisher's channel. Nothing is awaited from the
+		broker between messages, so a batch costs about the same as writing its frames to the socket.
+		A message that fails to publish is recorded and the connection is re-opened for the next one.
+
+		:param messages: iterable of (routing_key, message) or (routing_key, message, priority) tuples
+		:returns: list of (index, exception) for every message which could not be published
+		"""
+		exchange = exchange or self.exchange
+		assert exchange, "You must provide a name for the exchange"
+
+		encoding = encoding or self.message_encoding
+		properties = pika.BasicProperties(content_encoding=encoding)
+
+		failures = []
+		published = 0
+		connect_error = None
+		for index, (routing_key, message, *priority) in enumerate(messages):
+			assert isinstance(message, (str, bytes)), "The message must be a str or bytes object"
+			if connect_error is not None:
+				failures.append((index, connect_error))
+				continue
+
+			try:
+				if not self.is_open:
+					self.connect()
+			except pika.exceptions.AMQPError as e:
+				# The broker can't be reached, so every remaining message fails the same way
+				LOGGER.warning(f'Unable to connect while publishing batch: {str(e)}')
+				connect_error = e
+				failures.append((index, e))
+				continue
+
+			try:
+				if priority and priority[0] is not None:
+					message_properties = pika.BasicProperties(content_encoding=encoding, priority=priority[0])
+				else:
+					message_properties = properties
+				self._channel.basic_publish(exchange, routing_key or self.routing_key, message, properties=message_properties)
+				published += 1
+			except pika.exceptions.AMQPError as e:
+				LOGGER.warning(f'Failed to publish message ({index}) of batch: {str(e)}')
+				failures.append((index, e))
+				self.close()
+
+		metrics.PUBLISHED.inc(exchange, amount=published)
+		if failures:
+			metrics.PUBLISH_FAILURES.inc(exchange, amount=len(failures))
+		return failures
+
+	def flush(self, timeout=None):
+		"""
+		Wait for published messages to be confirmed by the broker.
+		Without publisher confirms a message is done once it's written, so there is nothing to wait for.
+		"""
+		pass
+
+	def publish_confirmed(self, message, exchange=None, routing_key=None, encoding=None, priority=None):
+		"""
+		Publish a single message and return once it's safe with the broker: once it's written here, once it's
+		confirmed with publisher confirms
+		"""
+		self.publish(message, exchange=exchange, routing_key=routing_key, encoding=encoding, priority=priority)
+
+
+class ConfirmingRabbitPublisher(RabbitPublisher):
+	"""
+	A RabbitPublisher with publisher confirms turned on. A publish doesn't wait on the broker, instead
+	up to `window` messages are kept in flight and each publish returns a Future which resolves to True
+	when the broker acks the message, or raises NackError if the broker nacks it.
+
+	Confirms are only read from the connection while this publisher is in use (publish, flush),
+	so call flush() before relying on the result of the returned futures.
+
+	Example:
+	publisher = ConfirmingRabbitPublisher(exchange='task_queue')
+	futures = [publisher.publish(str(i)) for i in range(1000)]
+	publisher.flush()
+	"""
+	DEFAULT_WINDOW = 1000
+	DEFAULT_FLUSH_TIMEOUT = 30
+
+	def __init__(self, *args, window=DEFAULT_WINDOW, **kwargs):
+		"""
+		:param window: the maximum number of published messages waiting on a confirm
+		"""
+		super().__init__(*args, **kwargs)
+		self.window = int(window)
+		assert self.window > 0, "The confirm window must be a positive int"
+
+		self._delivery_tag = 0
+		self._unconfirmed = OrderedDict()
+
+	def connect(self, parameters=None):
+		# Delivery tags are per channel, anything unconfirmed on the old channel never will be
+		self._fail_unconfirmed(pika.exceptions.AMQPConnectionError('Connection was reset before the message was confirmed'))
+		super().connect(parameters)
+
+		selected = []
+		self._channel._impl.confirm_delivery(ack_nack_callback=self._on_confirm, callback=selected.append)
+		while not selected:
+			self._connection.process_data_events(time_limit=None)
+
+	def close(self):
+		self._fail_unconfirmed(pika.exceptions.AMQPConnectionError('Connection was closed before the message was confirmed'))
+		super().close()
+
+	def publish(self, message, exchange=None, routing_key=None, encoding=None, priority=None, callback=None):
+		"""
+		Publish a message without waiting for the broker to confirm it.
+		If the window of unconfirmed messages is full, this blocks until there is room.
+
+		:param str message: the body of the message to send
+		:param priority: optional message priority, only used by queues declared with a max priority
+		:param callback: optional callable, called with the Future once the message is acked or nacked
+		:returns: concurrent.futures.Future
+		"""
+		assert isinstance(message, (str, bytes)), "The message must be a str or bytes object"
+		if not self.is_open:
+			self.connect()
+
+		exchange = exchange or self.exchange
+		routing_key = routing_key or self.routing_key
+		assert exchange, "You must provide a name for the exchange"
+
+		encoding = encoding or self.message_encoding
+		properties = pika.BasicProperties(content_encoding=encoding, priority=priority)
+
+		future = Future()
+		if callback is not None:
+			future.add_done_callback(callback)
+
+		try:
+			self._wait_for_window()
+			self._publish_unconfirmed(exchange, routing_key, message, properties, future)
+		except pika.exceptions.AMQPConnectionError:
+			metrics.PUBLISH_FAILURES.inc(exchange)
+			LOGGER.warning('Connection was closed while publishing. Reconnecting...')
+			self.connect()
+			self._publish_unconfirmed(exchange, routing_key, message, properties, future)
+
+		metrics.PUBLISHED.inc(exchange)
+		return future
+
+	def publish_batch(self, messages, exchange=None, encoding=None, timeout=DEFAULT_FLUSH_TIMEOUT):
+		"""
+		Publish many messages, keeping up to `window` of them in flight, then wait for every confirm
+
+		:param messages: iterable of (routing_key, message) or (routing_key, message, priority) tuples
+		:param timeout: seconds to wait for the outstanding confirms once everything is published
+		:returns: list of (index, exception) for every message which was not acked by the broker
+		"""
+		failures = []
+		futures = []
+		for index, (routing_key, message, *priority) in enumerate(messages):
+			try:
+				priority = priority[0] if priority else None
+				futures.append((index, self.publish(message, exchange=exchange, routing_key=routing_key, encoding=encoding, priority=priority)))
+			except pika.exceptions.AMQPError as e:
+				LOGGER.warning(f'Failed to publish message ({index}) of batch: {str(e)}')
+				failures.append((index, e))
+
+		try:
+			self.flush(timeout=timeout)
+		except (TimeoutError, pika.exceptions.AMQPError) as e:
+			LOGGER.warning(f'Not all messages of the batch were confirmed: {str(e)}')
+
+		for index, future in futures:
+			if not future.done():
+				failures.append((index, TimeoutError('The message was not confirmed in time')))
+			elif future.exception() is not None:
+				failures.append((index, future.exception()))
+
+		if failures:
+			metrics.PUBLISH_FAILURES.inc(exchange or self.exchange, amount=len(failures))
+		return sorted(failures, key=lambda failure: failure[0])
+
+	def publish_confirmed(self, message, exchange=None, routing_key=None, encoding=None, priority=None, timeout=DEFAULT_FLUSH_TIMEOUT):
+		"""
+		Publish a single message and wait for the broker to confirm it
+
+		:raises pika.exceptions.NackError: if the broker nacked the message
+		:raises TimeoutError: if the message wasn't confirmed within `timeout` seconds
+		"""
+		future = self.publish(message, exchange=exchange, routing_key=routing_key, encoding=encoding, priority=priority)
+		self.flush(timeout=timeout)
+		try:
+			return future.result(timeout=0)
+		except Exception:
+			metrics.PUBLISH_FAILURES.inc(exchange or self.exchange)
+			raise
+
+	def flush(self, timeout=DEFAULT_FLUSH_TIMEOUT):
+		"""
+		Block until the broker has confirmed every published message
+
+		:param timeout: seconds to wait, or None to wait indefinitely
+		:raises TimeoutError: if messages are still unconfirmed after `timeout` seconds
+		"""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while self._unconfirmed:
+			remaining = None if deadline is None else deadline - time.monotonic()
+			if remaining is not None and remaining <= 0:
+				raise TimeoutError(f'{len(self._unconfirmed)} messages were not confirmed within {timeout} seconds')
+			self._process_confirms(time_limit=remaining)
+
+	def _wait_for_window(self):
+		while len(self._unconfirmed) >= self.window:
+			self._process_confirms(time_limit=None)
+
+	def _process_confirms(self, time_limit):
+		try:
+			self._connection.process_data_events(time_limit=time_limit)
+		except pika.exceptions.AMQPConnectionError as e:
+			self._fail_unconfirmed(e)
+			raise
+
+	def _publish_unconfirmed(self, exchange, routing_key, message, properties, future):
+		# The future is registered before publishing since the confirm may be read while the frames are flushed
+		delivery_tag = self._delivery_tag + 1
+		self._unconfirmed[delivery_tag] = future
+		try:
+			self._channel.basic_publish(exchange, routing_key, message, properties=properties)
+		except Exception:
+			self._unconfirmed.pop(delivery_tag, None)
+			raise
+		self._delivery_tag = delivery_tag
+
+	def _on_confirm(self, method_frame):
+		"""
+		Resolves the futures of every message covered by a Basic.Ack or Basic.Nack
+		"""
+		method = method_frame.method
+		is_ack = isinstance(method, pika.spec.Basic.Ack)
+
+		if method.multiple:
+			delivery_tags = [tag for tag in self._unconfirmed if tag <= method.delivery_tag]
+		else:
+			delivery_tags = [method.delivery_tag]
+
+		for tag in delivery_tags:
+			future = self._unconfirmed.pop(tag, None)
+			if future is None:
+				continue
+			if is_ack:
+				future.set_result(True)
+			else:
+				future.set_exception(pika.exceptions.NackError([]))
+
+	def _fail_unconfirmed(self, error):
+		unconfirmed, self._unconfirmed = self._unconfirmed, OrderedDict()
+		self._delivery_tag = 0
+		for future in unconfirmed.values():
+			future.set_exception(error)
 
 
 class RabbitConsumer(RabbitConnection):
 	"""
-	A generic RabbitMQ consumer which gracefully handles SIGINTS and SIGTERMS
+	A generic RabbitMQ consumer which gracefully handles SIGINTS and SIGTERMS. Once asked to stop, it drains:
+	consuming is cancelled and prefetched messages are nacked back to the queue, callbacks in flight get
+	`drain_timeout` seconds to finish, and whatever is still unacked is requeued by the broker when the connection closes.
 
 	Example:
 	def print_article(x):
@@ -172,49 +503,58 @@ class RabbitConsumer(RabbitConnection):
 	"""
 	DEFAULT_RECONNECT_WAIT = 5
 	DEFAULT_PREFETCH_COUNT = 2
+	DEFAULT_POLL_INTERVAL = 1
 
-	def __init__(self, callback=None, queue=None, prefetch_count=DEFAULT_PREFETCH_COUNT, *args, **kwargs):
+	def __init__(self, callback=None, queue=None, prefetch_count=DEFAULT_PREFETCH_COUNT, executor=None, drain_timeout=None, *args, **kwargs):
 		"""
 		:param callback: callable function with w/ a single argument (the message body of a consumed message)
 		:param queue: name of the queue to consume messages from
 		:param prefetch_count: quantity of non-acked messages that can be obtained at any time
+		:param executor: optional executor (e.g. ThreadPoolExecutor) to run the callback in, instead of the
+			connection's thread. Messages are acked once the callback returns.
+		:param drain_timeout: seconds to wait for callbacks in flight once stopping, or None to wait until they finish
 		"""
 		super().__init__(*args, **kwargs)
 
 		self.queue = queue or self.queue
 		self.callback = callback
+		self.executor = executor
+		self.drain_timeout = drain_timeout
 
 		self._prefetch_count = prefetch_count
 		self._shutdown_flag = False
+		self._inflight = set()
 
 	def run(self, reconnect_wait=DEFAULT_RECONNECT_WAIT):
 		if self.callback is None or callable(self.callback) is False:
 			raise RuntimeError("A callback function must be set before running the consumer")
 
-		# Signals to stop running (SIGINT, SIGTERM)
-		LOGGER.info("Registering Signal handlers for: SIGINT, SIGTERM")
-		signal.signal(signal.SIGTERM, self._sigterm)
-		signal.signal(signal.SIGINT, self._sigterm)
+		# Signals to stop running (SIGINT, SIGTERM). Only the main thread can handle signals, a consumer
+		# running in another thread is stopped with request_stop()
+		if threading.current_thread() is threading.main_thread():
+			LOGGER.info("Registering Signal handlers for: SIGINT, SIGTERM")
+			signal.signal(signal.SIGTERM, self._sigterm)
+			signal.signal(signal.SIGINT, self._sigterm)
 
 		LOGGER.info("Starting consuming")
 		self._shutdown_flag = False
 		while self._shutdown_flag is False:
 			try:
 				self.connect()
-				self._channel.basic_qos(prefetch_count=self._prefetch_count)
-
-				self._channel.basic_consume(self.queue, self._on_message)
-				self._channel.start_consuming()
+				self._consume()
+				self._drain()
 				self._connection.close()
 
 			except pika.exceptions.AMQPConnectionError as e:
 				if not self._shutdown_flag:
+					metrics.CONSUMER_RECONNECTS.inc(self.queue)
 					LOGGER.warning(f'Connection was closed. Reconnecting... ({e})')
 					time.sleep(reconnect_wait)
 				continue
 
 			except pika.exceptions.ConnectionClosedByBroker:
 				if not self._shutdown_flag:
+					metrics.CONSUMER_RECONNECTS.inc(self.queue)
 					LOGGER.warning("Connection closed by broker. Will attempt reconnect shortly..")
 					time.sleep(reconnect_wait)
 				continue
@@ -223,9 +563,54 @@ class RabbitConsumer(RabbitConnection):
 				LOGGER.exception("Caught channel error. Stopping...")
 				break
 
+	def _consume(self):
+		"""
+		Consume until asked to stop. The connection is polled rather than blocking in start_consuming, so a stop
+		requested from a signal handler only sets a flag and never calls into pika while a callback is running.
+		"""
+		self._channel.basic_qos(prefetch_count=self._prefetch_count)
+		self._channel.basic_consume(self.queue, self._on_message)
+		while not self._shutdown_flag:
+			self._connection.process_data_events(time_limit=self.DEFAULT_POLL_INTERVAL)
+
 	def stop(self):
+		"""
+		Stop consuming after the current message, then drain. Safe to call from a signal handler.
+		"""
 		self._shutdown_flag = True
-		self._channel.stop_consuming()
+
+	def _drain(self):
+		"""
+		Hand back whatever isn't being worked on once consuming stopped
+		"""
+		# Cancelling the consumers nacks the messages the client received but hasn't dispatched yet
+		if self._channel.is_open:
+			self._channel.stop_consuming()
+		self._requeue_prefetched()
+		if not self._wait_for_inflight(self.drain_timeout):
+			self._on_drain_timeout()
+
+	def _requeue_prefetched(self):
+		"""
+		Nack messages which were dispatched to this consumer but not started. Nothing is held back by default.
+		"""
+		pass
+
+	def _on_drain_timeout(self):
+		"""
+		Called when callbacks are still in flight after drain_timeout. Their messages stay unacked, so the broker
+		requeues them once the connection closes.
+		"""
+		LOGGER.warning(f"({len(self._inflight)}) messages still in flight after ({self.drain_timeout}s), leaving them unacked")
+
+	def request_stop(self):
+		"""
+		Stop consuming after the current message. Unlike stop(), this is safe to call from any thread.
+		"""
+		self._shutdown_flag = True
+		connection = self._connection
+		if connection is not None and connection.is_open:
+			connection.add_callback_threadsafe(self._channel.stop_consuming)
 
 	def _on_message(self, channel, method_frame, header_frame, body):
 		"""
@@ -235,18 +620,154 @@ class RabbitConsumer(RabbitConnection):
 		Therefore, this method serves as a callback wrapper to ensure that the consumer never dies, and that message delivery
 		is always acknowledged. You have been warned.
 		"""
-		if not self._shutdown_flag:
+		if self._shutdown_flag:
+			# Delivered while stopping, it goes back to the queue for another consumer
+			channel.basic_nack(delivery_tag=method_frame.delivery_tag, requeue=True)
+			return
+
+		if self.executor is not None:
+			self._submit(channel, method_frame.delivery_tag, body)
+			return
+
+		self._deliver(body)
+		channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+
+	def _deliver(self, body):
+		try:
+			if self.message_encoding is not None:
+				body = body.decode(self.message_encoding)
+			return self.callback(body)
+		except:  # noqa
+			LOGGER.exception("RabbitConsumer does not die, but the callable it delivers messages to raised an exception")
+
+	async def _adeliver(self, body):
+		try:
+			if self.message_encoding is not None:
+				body = body.decode(self.message_encoding)
+			return await self.callback(body)
+		except:  # noqa
+			LOGGER.exception("RabbitConsumer does not die, but the callable it delivers messages to raised an exception")
+
+	def _submit(self, channel, delivery_tag, body):
+		"""
+		Run the callback in the executor. pika isn't thread-safe, so the ack is handed back to the
+		connection's thread with add_callback_threadsafe once the callback is done.
+		"""
+		connection = self._connection
+		deliver = self._adeliver if asyncio.iscoroutinefunction(self.callback) else self._deliver
+		future = self.executor.submit(deliver, body)
+		self._inflight.add(future)
+
+		def on_done(future):
 			try:
-				if self.message_encoding is not None:
-					body = body.decode(self.message_encoding)
-				self.callback(body)
-			except:  # noqa
-				LOGGER.exception("RabbitConsumer does not die, but the callable it delivers messages to raised an exception")
-			channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+				connection.add_callback_threadsafe(partial(self._ack, channel, delivery_tag, future))
+			except pika.exceptions.AMQPError:
+				self._inflight.discard(future)
+				LOGGER.warning(f"Connection closed before message ({delivery_tag}) could be acked, it will be redelivered")
+
+		future.add_done_callback(on_done)
+
+	def _ack(self, channel, delivery_tag, future):
+		self._inflight.discard(future)
+		if channel.is_open:
+			channel.basic_ack(delivery_tag=delivery_tag)
+
+	def _wait_for_inflight(self, timeout=None):
+		"""
+		Wait for callbacks running in the executor, then process their acks
+
+		:param timeout: seconds to wait, or None to wait until every callback is done
+		:returns: True if nothing is left in flight
+		"""
+		if self._inflight:
+			LOGGER.info(f"Waiting for ({len(self._inflight)}) in flight messages")
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while self._inflight:
+			if deadline is not None and time.monotonic() >= deadline:
+				return False
+			self._connection.process_data_events(time_limit=0.1)
+		return True
 
 	def _sigterm(self, signum, frame):
 		"""
 		Gracefully handle SIGTERM and SIGINT
 		"""
-		LOGGER.info('Caught Sigterm. Shutting down gracefully')
+		LOGGER.info('Caught Sigterm. Draining and shutting down gracefully')
 		self.stop()
+
+
+class MultiQueueConsumer(RabbitConsumer):
+	"""
+	A RabbitConsumer which consumes several queues on one channel. Up to `prefetch_count` messages of every
+	queue are buffered, and the next message is picked from the queues which have one ready:
+	- 'weighted': a smooth weighted round robin, a queue of weight 3 gets three messages for every one of a queue of weight 1
+	- 'strict': always the first queue (in the order given) with a message ready
+
+	Since only ready queues are considered, an idle queue never holds back a busy one.
+
+	Example:
+	consumer = MultiQueueConsumer(queues={'urgent': 3, 'bulk': 1}, callback=print)
+	consumer.run()
+	"""
+	def __init__(self, queues=None, policy=POLICY_WEIGHTED, max_inflight=1, *args, **kwargs):
+		"""
+		:param queues: dict of queue name to weight, in order of priority for the 'strict' policy
+		:param policy: one of CONSUME_POLICIES
+		:param max_inflight: messages dispatched to the executor at once, picking is deferred while it's busy
+		"""
+		super().__init__(*args, **kwargs)
+		assert queues, "You must provide the queues to consume"
+		assert policy in CONSUME_POLICIES, f"policy must be one of: {CONSUME_POLICIES}"
+		assert all(int(weight) > 0 for weight in queues.values()), "Queue weights must be positive ints"
+
+		self.weights = OrderedDict((queue, int(weight)) for queue, weight in queues.items())
+		self.policy = policy
+
+		self.max_inflight = int(max_inflight)
+		self._buffers = {queue: deque() for queue in self.weights}
+		self._credits = {queue: 0 for queue in self.weights}
+
+	def _consume(self):
+		"""
+		pika doesn't allow process_data_events from within a consumer callback, so callbacks only buffer the
+		message and the dispatching happens in this loop instead of start_consuming
+		"""
+		self._channel.basic_qos(prefetch_count=self._prefetch_count)
+		for queue in self.weights:
+			self._buffers[queue].clear()
+			self._channel.basic_consume(queue, partial(self._on_buffered, queue))
+
+		while not self._shutdown_flag:
+			queue = self._next_queue() if len(self._inflight) < self.max_inflight else None
+			if queue is None:
+				self._connection.process_data_events(time_limit=self.DEFAULT_POLL_INTERVAL)
+				continue
+
+			channel, method_frame, header_frame, body = self._buffers[queue].popleft()
+			self._on_message(channel, method_frame, header_frame, body)
+			# Read whatever arrived meanwhile, so the next pick sees every ready queue
+			self._connection.process_data_events(time_limit=0)
+
+	def _requeue_prefetched(self):
+		for buffer in self._buffers.values():
+			while buffer:
+				channel, method_frame, header_frame, body = buffer.popleft()
+				if channel.is_open:
+					channel.basic_nack(delivery_tag=method_frame.delivery_tag, requeue=True)
+
+	def _on_buffered(self, queue, channel, method_frame, header_frame, body):
+		self._buffers[queue].append((channel, method_frame, header_frame, body))
+
+	def _next_queue(self):
+		ready = [queue for queue in self.weights if self._buffers[queue]]
+		if not ready:
+			return None
+		if self.policy == POLICY_STRICT:
+			return ready[0]
+
+		total = sum(self.weights[queue] for queue in ready)
+		for queue in ready:
+			self._credits[queue] += self.weights[queue]
+		chosen = max(ready, key=self._credits.get)
+		self._credits[chosen] -= total
+		return chosen
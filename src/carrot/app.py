@@ -1,4 +1,6 @@
 import logging
+import sys
+
 from django.apps import AppConfig
 
 LOGGER = logging.getLogger(__name__)
@@ -9,18 +11,18 @@ class CarrotConfig(AppConfig):
 	verbose_name = "Carrots are better than celery"
 
 	def ready(self):
-		from carrot.connections import publisher  # noqa
+		from carrot.amqp import set_transport  # noqa
+		from carrot.connections import declare_queues  # noqa
 		from carrot.settings import carrot_settings  # noqa
+		from carrot.utils import import_callable  # noqa
+
+		if carrot_settings['transport'] is not None:
+			set_transport(import_callable(carrot_settings['transport']))
+
+		# Initialize queues, exchanges. `manage.py carrot bench` only uses the in-memory broker, RabbitMQ may not be running
+		if not self._is_bench():
+			declare_queues()
 
-		# Initialize queues, exchanges
-		publisher.connect()
-		for queue, queue_settings in carrot_settings['queues'].items():
-			LOGGER.info(f"Initializing queue ({queue_settings['queue_name']})")
-			publisher.setup_queue_exchange(
-				exchange=carrot_settings['exchange'],
-				queue=queue_settings['queue_name'],
-				routing_key=queue_settings['queue_name'],
-				durable_exchange=carrot_settings['durable_exchange'],
-				durable_queue=queue_settings['durable_queue'],
-			)
-		publisher.close()
+	@staticmethod
+	def _is_bench():
+		return len(sys.argv) > 2 and sys.argv[1] == 'carrot' and 'bench' in sys.argv[2:]
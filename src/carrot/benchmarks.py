@@ -0,0 +1,187 @@
+"""
+Throughput and latency benchmarks, run with `manage.py carrot bench`. Tasks are written to a throwaway test database
+and published to the in-memory broker, so neither the real database nor RabbitMQ is touched.
+"""
+import json
+import logging
+import platform
+import statistics
+import threading
+import time
+
+import django
+from django.db import connection
+from django.test.utils import setup_databases, teardown_databases
+
+from carrot import amqp, memory
+from carrot.connections import declare_queues, pool
+from carrot.settings import carrot_settings, DEFAULT_QUEUE_NAME
+
+LOGGER = logging.getLogger(__name__)
+
+NOOP = 'carrot.benchmarks.noop'
+SLEEP = 'carrot.benchmarks.sleep'
+
+# Seconds the latency scenario waits for its worker once every task was enqueued
+LATENCY_TIMEOUT = 30
+
+
+def noop():
+	pass
+
+
+def sleep(seconds):
+	time.sleep(seconds)
+
+
+def run(tasks=1000, queue=DEFAULT_QUEUE_NAME, sleep_seconds=0.01, latency_rate=200):
+	"""
+	:param tasks: tasks per scenario, the sleep and latency scenarios use fewer
+	:param queue: the carrot queue whose worker settings (execution mode, status reporting ...) are benchmarked
+	:param sleep_seconds: how long each task of the sleep scenario sleeps
+	:param latency_rate: tasks per second enqueued while measuring end-to-end latency
+	:returns: json serializable dict of the results
+	"""
+	old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'})
+	amqp.set_transport(memory.MemoryConnection)
+	try:
+		memory.broker.reset()
+		pool.close_all()
+		declare_queues()
+
+		results = {
+			'create': bench_create(tasks, queue),
+			'bulk_enqueue': bench_bulk_enqueue(tasks, queue),
+			'worker_noop': bench_worker(tasks, queue, NOOP),
+			'worker_sleep': bench_worker(max(tasks // 10, 1), queue, SLEEP, args=[sleep_seconds]),
+			'latency': bench_latency(min(tasks, 1000), queue, latency_rate),
+		}
+	finally:
+		pool.close_all()
+		amqp.set_transport(None)
+		teardown_databases(old_config, verbosity=0)
+
+	queue_settings = carrot_settings['queues'][queue]
+	return {
+		'python': platform.python_version(),
+		'django': django.get_version(),
+		'database': connection.vendor,
+		'queue': queue,
+		'execution_mode': queue_settings['execution_mode'],
+		'status_reporting': queue_settings['status_reporting'],
+		'message_format': carrot_settings['message_format'],
+		'publisher_confirms': carrot_settings['publisher_confirms'],
+		'results': results,
+	}
+
+
+def bench_create(count, queue):
+	from carrot.models import Task
+
+	start = time.perf_counter()
+	for _ in range(count):
+		Task.objects.create(kallable=NOOP, queue=queue)
+	return _throughput(count, time.perf_counter() - start)
+
+
+def bench_bulk_enqueue(count, queue):
+	from carrot.models import Task
+
+	start = time.perf_counter()
+	failures = Task.objects.bulk_enqueue(Task(kallable=NOOP, queue=queue) for _ in range(count))
+	result = _throughput(count, time.perf_counter() - start)
+	result['failures'] = len(failures)
+	return result
+
+
+def bench_worker(count, queue, kallable, args=None):
+	"""
+	Enqueue `count` tasks up front, then time a worker executing all of them
+	"""
+	from carrot.models import Task
+
+	_drain(queue)
+	Task.objects.bulk_enqueue(Task(kallable=kallable, args=args or [], queue=queue) for _ in range(count))
+
+	worker = _worker(queue, count)
+	start = time.perf_counter()
+	worker.run()
+	return _throughput(count, time.perf_counter() - start)
+
+
+def bench_latency(count, queue, rate):
+	"""
+	Enqueue tasks at `rate` per second while a worker runs, and measure from creation to completion
+	"""
+	from carrot.models import Task
+
+	_drain(queue)
+	worker = _worker(queue, count)
+	thread = threading.Thread(target=worker.run, name='carrot-bench-worker')
+	thread.start()
+
+	ids = []
+	interval = 1 / rate
+	next_at = time.perf_counter()
+	try:
+		for _ in range(count):
+			ids.append(Task.objects.create(kallable=NOOP, queue=queue).id)
+			next_at += interval
+			time.sleep(max(next_at - time.perf_counter(), 0))
+	finally:
+		# Tasks which failed to be fetched (e.g. a locked sqlite db) never count towards max_tasks
+		thread.join(LATENCY_TIMEOUT)
+		if thread.is_alive():
+			LOGGER.warning(f"Not every task was executed within ({LATENCY_TIMEOUT}s), stopping the worker")
+			worker.request_stop()
+			thread.join()
+
+	latencies = sorted(
+		(completed_on - created_on).total_seconds() * 1000
+		for created_on, completed_on in Task.objects.filter(id__in=ids).values_list('created_on', 'completed_on')
+		if completed_on is not None
+	)
+	if not latencies:
+		return {'count': 0}
+	return {
+		'count': len(latencies),
+		'rate': rate,
+		'mean_ms': round(statistics.mean(latencies), 3),
+		'p50_ms': round(_percentile(latencies, 50), 3),
+		'p90_ms': round(_percentile(latencies, 90), 3),
+		'p99_ms': round(_percentile(latencies, 99), 3),
+		'max_ms': round(latencies[-1], 3),
+	}
+
+
+def _worker(queue, count):
+	from carrot.services import Worker
+
+	worker = Worker(queue)
+	# The worker stops itself once every task was executed
+	worker.max_tasks = count
+	worker.max_memory = 0
+	return worker
+
+
+def _drain(queue):
+	# Leftovers of an earlier scenario would be counted by the next worker
+	with memory.broker.condition:
+		memory.broker.declare_queue(carrot_settings['queues'][queue]['queue_name'])._messages.clear()
+
+
+def _throughput(count, seconds):
+	return {
+		'count': count,
+		'seconds': round(seconds, 4),
+		'per_second': round(count / seconds, 1) if seconds else None,
+	}
+
+
+def _percentile(values, percent):
+	index = min(int(round(percent / 100 * (len(values) - 1))), len(values) - 1)
+	return values[index]
+
+
+def dumps(results):
+	return json.dumps(results, indent=2, sort_keys=True)
@@ -1,14 +1,215 @@
-from carrot.amqp import RabbitPublisher
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from carrot.amqp import RabbitPublisher, ConfirmingRabbitPublisher
+from carrot.scheduling import delay_queue_name
 from carrot.settings import carrot_settings
 
-publisher = RabbitPublisher(
-	host=carrot_settings['host'],
-	port=carrot_settings['port'],
-	user=carrot_settings['user'],
-	password=carrot_settings['password'],
-	exchange=carrot_settings['exchange'],
+LOGGER = logging.getLogger(__name__)
+
+
+class PublisherPool:
+	"""
+	A bounded pool of publishers, each with its own connection, safe to share between threads and across forks.
+
+	pika connections are not thread-safe, so a publisher is only ever used by the thread that checked it out.
+	Nested checkouts in the same thread reuse the same publisher. A forked child never touches the
+	parent's publishers (their sockets belong to the parent), it starts with an empty pool instead.
+
+	Example:
+	pool = PublisherPool(lambda: RabbitPublisher(exchange='task_queue'))
+	with pool.checkout() as publisher:
+		publisher.publish('loral igloo dolar')
+	"""
+	DEFAULT_MAX_SIZE = 10
+	DEFAULT_MAX_IDLE = 300
+	DEFAULT_TIMEOUT = 30
+
+	def __init__(self, factory, max_size=DEFAULT_MAX_SIZE, max_idle=DEFAULT_MAX_IDLE, timeout=DEFAULT_TIMEOUT):
+		"""
+		:param factory: callable returning a new (unconnected) RabbitPublisher
+		:param max_size: maximum number of publishers this process may hold at once
+		:param max_idle: seconds a publisher may sit unused before its connection is closed
+		:param timeout: seconds to wait for a publisher when all of them are checked out
+		"""
+		assert int(max_size) > 0, "The pool size must be a positive int"
+		self._factory = factory
+		self.max_size = int(max_size)
+		self.max_idle = max_idle
+		self.timeout = timeout
+
+		self._reset()
+		if hasattr(os, 'register_at_fork'):
+			os.register_at_fork(after_in_child=self._reset)
+
+	@contextmanager
+	def checkout(self):
+		"""
+		Check out a publisher for the exclusive use of the current thread
+		"""
+		local = self._local
+		if getattr(local, 'publisher', None) is not None:
+			yield local.publisher
+			return
+
+		publisher = self._acquire()
+		local.publisher = publisher
+		try:
+			yield publisher
+		finally:
+			local.publisher = None
+			self._release(publisher)
+
+	def close_all(self):
+		"""
+		Close the connections of every idle publisher. Checked out publishers are closed when they are returned.
+		"""
+		with self._condition:
+			self._check_pid()
+			idle, self._idle = self._idle, []
+			self._size -= len(idle)
+			self._generation += 1
+			self._condition.notify_all()
+		for publisher, _ in idle:
+			publisher.close()
+
+	def _reset(self):
+		self._pid = os.getpid()
+		self._condition = threading.Condition()
+		self._local = threading.local()
+		self._idle = []
+		self._size = 0
+		self._generation = 0
+
+	def _check_pid(self):
+		# Fallback for platforms without os.register_at_fork
+		if self._pid != os.getpid():
+			self._reset()
+
+	def _acquire(self):
+		self._check_pid()
+		deadline = time.monotonic() + self.timeout
+		expired = []
+		with self._condition:
+			while True:
+				expired.extend(self._evict_idle())
+				if self._idle:
+					publisher, _ = self._idle.pop()
+					break
+
+				if self._size < self.max_size:
+					publisher = self._factory()
+					publisher._pool_generation = self._generation
+					self._size += 1
+					break
+
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					raise TimeoutError(f"No publisher was returned to the pool within {self.timeout} seconds")
+				self._condition.wait(remaining)
+
+		for expired_publisher, _ in expired:
+			expired_publisher.close()
+
+		# Health check. Publishers connect lazily, so one whose connection died is reset and reconnects on use
+		if not publisher.is_open:
+			publisher.close()
+
+		return publisher
+
+	def _release(self, publisher):
+		with self._condition:
+			if self._pid != os.getpid():
+				return
+			if publisher._pool_generation != self._generation:
+				# close_all() was called while this publisher was checked out
+				self._size -= 1
+				stale = True
+			else:
+				self._idle.append((publisher, time.monotonic()))
+				stale = False
+			self._condition.notify()
+
+		if stale:
+			publisher.close()
+
+	def _evict_idle(self):
+		"""
+		Remove publishers which have been idle too long and return them to be closed.
+		Must be called with the lock held.
+		"""
+		if self.max_idle is None:
+			return []
+		cutoff = time.monotonic() - self.max_idle
+		expired = [(publisher, used) for publisher, used in self._idle if used < cutoff]
+		if expired:
+			self._idle = [(publisher, used) for publisher, used in self._idle if used >= cutoff]
+			self._size -= len(expired)
+		return expired
+
+
+def create_publisher():
+	publisher_kwargs = {
+		'host': carrot_settings['host'],
+		'port': carrot_settings['port'],
+		'user': carrot_settings['user'],
+		'password': carrot_settings['password'],
+		'exchange': carrot_settings['exchange'],
+	}
+
+	if carrot_settings['publisher_confirms']:
+		return ConfirmingRabbitPublisher(window=carrot_settings['publisher_confirm_window'], **publisher_kwargs)
+	return RabbitPublisher(**publisher_kwargs)
+
+
+pool = PublisherPool(
+	create_publisher,
+	max_size=carrot_settings['publisher_pool_size'],
+	max_idle=carrot_settings['publisher_pool_max_idle'],
+	timeout=carrot_settings['publisher_pool_timeout'],
 )
 
 
 def close_all():
-	publisher.close()
+	pool.close_all()
+
+
+def declare_queues():
+	"""
+	Declare the exchange, every queue and their delay queues
+	"""
+	with pool.checkout() as publisher:
+		publisher.connect()
+		for queue, queue_settings in carrot_settings['queues'].items():
+			LOGGER.info(f"Initializing queue ({queue_settings['queue_name']})")
+			if queue_settings['max_priority']:
+				publisher.setup_priority_queue(
+					queue_settings['max_priority'],
+					exchange=carrot_settings['exchange'],
+					queue=queue_settings['queue_name'],
+					routing_key=queue_settings['queue_name'],
+					durable_exchange=carrot_settings['durable_exchange'],
+					durable_queue=queue_settings['durable_queue'],
+				)
+			else:
+				publisher.setup_queue_exchange(
+					exchange=carrot_settings['exchange'],
+					queue=queue_settings['queue_name'],
+					routing_key=queue_settings['queue_name'],
+					durable_exchange=carrot_settings['durable_exchange'],
+					durable_queue=queue_settings['durable_queue'],
+				)
+			# Delayed tasks wait in these until their TTL dead-letters them back into the queue
+			for delay in carrot_settings['delay_buckets']:
+				publisher.setup_delay_queue(
+					delay,
+					target_routing_key=queue_settings['queue_name'],
+					exchange=carrot_settings['exchange'],
+					queue=delay_queue_name(queue_settings['queue_name'], delay),
+					durable_exchange=carrot_settings['durable_exchange'],
+					durable_queue=queue_settings['durable_queue'],
+				)
+	pool.close_all()
@@ -0,0 +1,63 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+EXECUTION_SERIAL = 'serial'
+EXECUTION_THREADS = 'threads'
+EXECUTION_ASYNCIO = 'asyncio'
+EXECUTION_MODES = (EXECUTION_SERIAL, EXECUTION_THREADS, EXECUTION_ASYNCIO)
+
+
+class AsyncioExecutor:
+	"""
+	Runs an asyncio event loop in a background thread, with the submit()/shutdown() interface of
+	concurrent.futures executors. Coroutine functions are scheduled on the loop, other callables are
+	run in the loop's default thread pool.
+
+	Example:
+	executor = AsyncioExecutor()
+	future = executor.submit(my_coroutine_function, 1, 2)
+	future.result()
+	"""
+	def __init__(self):
+		self._loop = asyncio.new_event_loop()
+		self._thread = threading.Thread(target=self._run_loop, name='carrot-asyncio', daemon=True)
+		self._thread.start()
+
+	def submit(self, fn, *args, **kwargs):
+		"""
+		:returns: concurrent.futures.Future
+		"""
+		if asyncio.iscoroutinefunction(fn):
+			coroutine = fn(*args, **kwargs)
+		else:
+			coroutine = self._run_in_thread(functools.partial(fn, *args, **kwargs))
+		return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+	def shutdown(self, wait=True):
+		self._loop.call_soon_threadsafe(self._loop.stop)
+		if wait:
+			self._thread.join()
+
+	async def _run_in_thread(self, fn):
+		return await self._loop.run_in_executor(None, fn)
+
+	def _run_loop(self):
+		asyncio.set_event_loop(self._loop)
+		self._loop.run_forever()
+
+
+def create_executor(mode, pool_size):
+	"""
+	:param mode: one of EXECUTION_MODES
+	:param pool_size: the number of tasks which may execute at once
+	:returns: an executor, or None when tasks execute inline (serial)
+	"""
+	if mode == EXECUTION_SERIAL:
+		return None
+	if mode == EXECUTION_THREADS:
+		return ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='carrot-worker')
+	if mode == EXECUTION_ASYNCIO:
+		return AsyncioExecutor()
+	raise ValueError(f"Unknown execution mode ({mode})")
@@ -1,4 +1,7 @@
 from django.db import models
+from django.db.models.expressions import Col
+from django.db.models.query import FlatValuesListIterable, NamedValuesListIterable, ValuesIterable, ValuesListIterable
+from django.db.models.query_utils import DeferredAttribute
 from django.core.exceptions import ValidationError
 
 import json
@@ -42,3 +45,99 @@ class DictField(models.TextField):
 		value = json.dumps(value)
 		value = value.lstrip('{').rstrip('}')
 		return super().get_db_prep_save(value, *args, **kwargs)
+
+
+class RawJSON(str):
+	"""
+	A JSON document read from the db which hasn't been decoded yet
+	"""
+	decoder = None
+
+	def decode(self):
+		try:
+			return json.loads(self, cls=self.decoder)
+		except json.JSONDecodeError:
+			return str(self)
+
+
+def decode_raw(value):
+	return value.decode() if isinstance(value, RawJSON) else value
+
+
+class LazyJSONDescriptor(DeferredAttribute):
+	"""
+	Decodes a LazyJSONField value the first time it's read from a model instance.
+	It's a data descriptor (unlike DeferredAttribute), so reads aren't served straight from the instance __dict__.
+	"""
+	def __get__(self, instance, cls=None):
+		value = super().__get__(instance, cls)
+		if isinstance(value, RawJSON):
+			value = instance.__dict__[self.field.attname] = value.decode()
+		return value
+
+	def __set__(self, instance, value):
+		instance.__dict__[self.field.attname] = value
+
+
+class LazyJSONField(models.JSONField):
+	"""
+	LazyJSONField is a native JSONField (jsonb on PostgreSQL) whose values are only decoded when first accessed,
+	so loading rows whose documents are never used costs no json.loads. Querysets of models using this field
+	should be LazyJSONQuerySets, so values() and values_list() still return decoded values.
+	"""
+	descriptor_class = LazyJSONDescriptor
+
+	def from_db_value(self, value, expression, connection):
+		# Key lookups (e.g. kwargs__customer_id) are decoded as usual
+		if isinstance(value, str) and isinstance(expression, Col):
+			value = RawJSON(value)
+			value.decoder = self.decoder
+			return value
+		return super().from_db_value(value, expression, connection)
+
+
+class DecodedValuesIterable(ValuesIterable):
+	def __iter__(self):
+		for row in super().__iter__():
+			yield {key: decode_raw(value) for key, value in row.items()}
+
+
+class DecodedValuesListIterable(ValuesListIterable):
+	def __iter__(self):
+		for row in super().__iter__():
+			yield tuple(decode_raw(value) for value in row)
+
+
+class DecodedNamedValuesListIterable(NamedValuesListIterable):
+	def __iter__(self):
+		for row in super().__iter__():
+			yield row._make(decode_raw(value) for value in row)
+
+
+class DecodedFlatValuesListIterable(FlatValuesListIterable):
+	def __iter__(self):
+		for value in super().__iter__():
+			yield decode_raw(value)
+
+
+class LazyJSONQuerySet(models.QuerySet):
+	"""
+	A QuerySet which decodes LazyJSONField values returned by values() and values_list(),
+	where there is no model instance to decode them lazily
+	"""
+	DECODED_ITERABLES = {
+		ValuesIterable: DecodedValuesIterable,
+		ValuesListIterable: DecodedValuesListIterable,
+		NamedValuesListIterable: DecodedNamedValuesListIterable,
+		FlatValuesListIterable: DecodedFlatValuesListIterable,
+	}
+
+	def values(self, *fields, **expressions):
+		clone = super().values(*fields, **expressions)
+		clone._iterable_class = self.DECODED_ITERABLES[clone._iterable_class]
+		return clone
+
+	def values_list(self, *fields, flat=False, named=False):
+		clone = super().values_list(*fields, flat=flat, named=named)
+		clone._iterable_class = self.DECODED_ITERABLES[clone._iterable_class]
+		return clone
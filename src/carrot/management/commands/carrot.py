@@ -1,40 +1,92 @@
 import logging
-import signal
-import multiprocessing
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-from carrot.services import Worker
-from carrot.settings import carrot_settings
+from carrot import outbox, recovery, retention
+from carrot.scheduling import PeriodicTask, Scheduler, registry
+from carrot.settings import carrot_settings, DEFAULT_QUEUE_NAME
+from carrot.supervisor import Supervisor
 
 
 LOGGER = logging.getLogger(__name__)
 
 
 class Command(BaseCommand):
+	help = "Run the carrot workers (default), or one of the maintenance actions"
+
+	def add_arguments(self, parser):
+		parser.add_argument('action', nargs='?', default='run', choices=['run', 'relay', 'prune', 'recover', 'scheduler', 'bench'])
+		parser.add_argument('--batch-size', type=int, default=1000, help="rows handled per query by maintenance actions")
+		parser.add_argument('--days', type=float, default=carrot_settings['retention_days'], help="prune: delete finished tasks older than this")
+		parser.add_argument('--archive', help="prune: append the deleted rows to this file as JSON lines")
+		parser.add_argument('--sleep', type=float, default=0.1, help="prune: seconds to pause between batches")
+		parser.add_argument('--tasks', type=int, default=1000, help="bench: tasks per scenario")
+		parser.add_argument('--queue', default=DEFAULT_QUEUE_NAME, help="bench: the queue whose worker settings are used")
+		parser.add_argument('--output', help="bench: write the json results to this file instead of stdout")
+
 	def handle(self, *args, **options):
+		getattr(self, f"handle_{options['action']}")(**options)
+
+	def handle_run(self, **options):
 		LOGGER.info("Carrot starting")
+		Supervisor().run()
+		LOGGER.info("Carrot shutdown complete")
 
-		signal.signal(signal.SIGTERM, self._sigterm)
-		signal.signal(signal.SIGINT, self._sigterm)
+	def handle_relay(self, batch_size, **options):
+		"""
+		Publish outbox tasks which were committed but never published
+		"""
+		if not carrot_settings['outbox']:
+			raise CommandError("The outbox relay requires CARROT['outbox'] = True")
 
-		workers = []
-		for queue, settings in carrot_settings['queues'].items():
-			for _ in range(int(settings['worker_concurrency'])):
-				workers.append(Worker(queue))
+		count = outbox.relay(batch_size=batch_size, grace=carrot_settings['outbox_relay_grace'])
+		LOGGER.info(f"Outbox relay published ({count}) tasks")
+		self.stdout.write(f"Published {count} tasks")
 
-		processes = []
-		for worker in workers:
-			p = multiprocessing.Process(target=worker.run, daemon=True)
-			p.start()
-			processes.append(p)
+	def handle_prune(self, batch_size, days, archive, sleep, **options):
+		"""
+		Delete (and optionally archive) completed and failed tasks older than the retention window
+		"""
+		if archive:
+			with open(archive, 'a') as f:
+				count = retention.prune(days, batch_size=batch_size, archive=f, sleep=sleep)
+		else:
+			count = retention.prune(days, batch_size=batch_size, sleep=sleep)
+		self.stdout.write(f"Pruned {count} tasks")
 
-		for p in processes:
-			p.join()
+		expired = retention.expire_results(batch_size=batch_size)
+		self.stdout.write(f"Cleared {expired} expired results")
 
-		LOGGER.info("Carrot shutdown complete")
+	def handle_recover(self, batch_size, **options):
+		"""
+		Re-publish the tasks left running by worker processes of this host which no longer exist
+		"""
+		count = recovery.recover(batch_size=batch_size)
+		LOGGER.info(f"Recovered ({count}) tasks")
+		self.stdout.write(f"Recovered {count} tasks")
+
+	def handle_scheduler(self, **options):
+		"""
+		Enqueue the periodic tasks from CARROT['schedule'] and carrot.scheduling.register() when they are due
+		"""
+		periodic_tasks = list(registry.values())
+		periodic_tasks += [PeriodicTask(name, **entry) for name, entry in carrot_settings['schedule'].items()]
+		LOGGER.info("Carrot scheduler starting")
+		Scheduler(periodic_tasks).run()
+		LOGGER.info("Carrot scheduler shutdown complete")
+
+	def handle_bench(self, tasks, queue, output, **options):
+		"""
+		Measure enqueue and execution throughput and end-to-end latency against a test db and the in-memory broker
+		"""
+		from carrot import benchmarks
+
+		if queue not in carrot_settings['queues']:
+			raise CommandError(f"({queue}) is not a valid carrot queue")
 
-	def _sigterm(self, signum, frame):
-		# Nothing needs to be done. The forked worker processes will handle their own signal
-		# and eventually the processes will be joined (hopefully)
-		LOGGER.info(f"Carrot received shutdown signal ({signum}). Waiting for children to join")
+		results = benchmarks.dumps(benchmarks.run(tasks=tasks, queue=queue))
+		if output:
+			with open(output, 'w') as f:
+				f.write(results)
+		else:
+			self.stdout.write(results)
@@ -0,0 +1,297 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+
+import pika
+
+
+class MemoryQueue:
+	"""
+	A queue of the in-memory broker. Supports the arguments carrot declares: x-max-priority, and
+	x-message-ttl with x-dead-letter-exchange/x-dead-letter-routing-key.
+	"""
+	def __init__(self, name, arguments=None):
+		arguments = arguments or {}
+		self.name = name
+		self.max_priority = arguments.get('x-max-priority')
+		self.ttl = arguments['x-message-ttl'] / 1000 if 'x-message-ttl' in arguments else None
+		self.dead_letter_exchange = arguments.get('x-dead-letter-exchange')
+		self.dead_letter_routing_key = arguments.get('x-dead-letter-routing-key')
+
+		self.consumers = []
+		self._messages = []
+		self._sequence = itertools.count()
+
+	def __len__(self):
+		return len(self._messages)
+
+	def put(self, body, properties, requeued=False):
+		priority = 0
+		if self.max_priority:
+			priority = min(getattr(properties, 'priority', None) or 0, self.max_priority)
+		# Requeued messages go back to the head of the queue, like RabbitMQ does
+		sequence = -next(self._sequence) if requeued else next(self._sequence)
+		heapq.heappush(self._messages, (-priority, sequence, time.monotonic(), body, properties))
+
+	def get(self):
+		_, _, _, body, properties = heapq.heappop(self._messages)
+		return body, properties
+
+	def expired(self, now):
+		"""
+		Pop the messages whose TTL has passed
+		"""
+		expired = []
+		while self.ttl is not None and self._messages and self._messages[0][2] + self.ttl <= now:
+			_, _, _, body, properties = heapq.heappop(self._messages)
+			expired.append((body, properties))
+		return expired
+
+
+class MemoryBroker:
+	"""
+	A minimal in-process stand-in for RabbitMQ: direct exchanges, queues, prefetch, acks, priorities and
+	TTL dead-lettering. Every connection of the process shares the one broker. Meant for tests and benchmarks.
+	"""
+	def __init__(self):
+		self.condition = threading.Condition()
+		self.reset()
+
+	def reset(self):
+		with self.condition:
+			self.exchanges = {}
+			self.queues = {}
+			self.bindings = {}
+
+	def declare_queue(self, name, arguments=None, passive=False):
+		with self.condition:
+			if name not in self.queues:
+				if passive:
+					raise pika.exceptions.ChannelClosedByBroker(404, f"NOT_FOUND - no queue '{name}'")
+				self.queues[name] = MemoryQueue(name, arguments)
+			return self.queues[name]
+
+	def bind(self, exchange, queue, routing_key):
+		with self.condition:
+			queues = self.bindings.setdefault((exchange, routing_key), [])
+			if queue not in queues:
+				queues.append(queue)
+
+	def publish(self, exchange, routing_key, body, properties, requeued=False):
+		with self.condition:
+			# The default exchange routes to the queue named by the routing key
+			names = [routing_key] if exchange == '' else self.bindings.get((exchange, routing_key), [])
+			for name in names:
+				if name in self.queues:
+					self.queues[name].put(body, properties, requeued=requeued)
+			self.condition.notify_all()
+
+	def expire(self):
+		now = time.monotonic()
+		with self.condition:
+			for queue in list(self.queues.values()):
+				for body, properties in queue.expired(now):
+					if queue.dead_letter_exchange is not None:
+						routing_key = queue.dead_letter_routing_key or queue.name
+						self.publish(queue.dead_letter_exchange, routing_key, body, properties)
+
+	def next_expiry(self):
+		"""
+		:returns: seconds until the next message expires, or None
+		"""
+		with self.condition:
+			expiries = [queue._messages[0][2] + queue.ttl for queue in self.queues.values() if queue.ttl is not None and queue._messages]
+		return max(min(expiries) - time.monotonic(), 0) if expiries else None
+
+
+broker = MemoryBroker()
+
+
+class MemoryChannel:
+	def __init__(self, connection):
+		self.connection = connection
+		self.is_open = True
+		self.prefetch_count = 0
+		self.unacked = {}
+
+		self._consumers = []
+		self._consuming = False
+		self._delivery_tags = itertools.count(1)
+		self._confirm_callback = None
+		self._confirm_tags = itertools.count(1)
+		self._confirms = deque()
+		self._impl = SimpleNamespace(confirm_delivery=self._confirm_delivery)
+
+	def exchange_declare(self, exchange, exchange_type='direct', durable=False, **kwargs):
+		assert exchange_type == 'direct', "The memory broker only supports direct exchanges"
+		with broker.condition:
+			broker.exchanges[exchange] = exchange_type
+
+	def queue_declare(self, queue, passive=False, durable=False, arguments=None, **kwargs):
+		declared = broker.declare_queue(queue, arguments, passive=passive)
+		return SimpleNamespace(method=SimpleNamespace(queue=queue, message_count=len(declared), consumer_count=len(declared.consumers)))
+
+	def queue_bind(self, queue, exchange, routing_key=None, **kwargs):
+		broker.bind(exchange, queue, routing_key or queue)
+
+	def basic_qos(self, prefetch_count=0, **kwargs):
+		self.prefetch_count = prefetch_count
+
+	def basic_consume(self, queue, on_message_callback, auto_ack=False, **kwargs):
+		consumer = SimpleNamespace(queue=broker.declare_queue(queue, passive=True), callback=on_message_callback, unacked=0, auto_ack=auto_ack)
+		self._consumers.append(consumer)
+		with broker.condition:
+			consumer.queue.consumers.append(consumer)
+		return f"ctag{len(self._consumers)}"
+
+	def basic_cancel(self, consumer_tag=None):
+		self._cancel_consumers()
+
+	def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+		if isinstance(body, str):
+			body = body.encode('utf-8')
+		broker.publish(exchange, routing_key, body, properties)
+		if self._confirm_callback is not None:
+			self._confirms.append(next(self._confirm_tags))
+
+	def basic_ack(self, delivery_tag=0, multiple=False):
+		for consumer, _, _ in self._settle(delivery_tag, multiple):
+			consumer.unacked -= 1
+
+	def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+		for consumer, body, properties in self._settle(delivery_tag, multiple):
+			consumer.unacked -= 1
+			if requeue:
+				consumer.queue.put(body, properties, requeued=True)
+		with broker.condition:
+			broker.condition.notify_all()
+
+	def basic_reject(self, delivery_tag=0, requeue=True):
+		self.basic_nack(delivery_tag, requeue=requeue)
+
+	def start_consuming(self):
+		self._consuming = True
+		while self._consuming and self.is_open:
+			self.connection.process_data_events(time_limit=None)
+
+	def stop_consuming(self, consumer_tag=None):
+		self._consuming = False
+		self._cancel_consumers()
+
+	def close(self):
+		# Unacked messages go back to their queue, like when a connection to RabbitMQ is lost
+		if self.unacked:
+			self.basic_nack(multiple=True, delivery_tag=max(self.unacked))
+		self._cancel_consumers()
+		self.is_open = False
+
+	def _cancel_consumers(self):
+		with broker.condition:
+			for consumer in self._consumers:
+				if consumer in consumer.queue.consumers:
+					consumer.queue.consumers.remove(consumer)
+		self._consumers = []
+
+	def _settle(self, delivery_tag, multiple):
+		with broker.condition:
+			tags = [tag for tag in self.unacked if tag <= delivery_tag] if multiple else [delivery_tag]
+			return [self.unacked.pop(tag) for tag in tags if tag in self.unacked]
+
+	def _confirm_delivery(self, ack_nack_callback, callback=None):
+		self._confirm_callback = ack_nack_callback
+		if callback is not None:
+			callback(SimpleNamespace(method=pika.spec.Confirm.SelectOk()))
+
+	def _deliveries(self):
+		"""
+		Take the messages this channel's consumers may receive within their prefetch
+		"""
+		deliveries = []
+		with broker.condition:
+			for consumer in self._consumers:
+				while len(consumer.queue) and (consumer.auto_ack or not self.prefetch_count or consumer.unacked < self.prefetch_count):
+					body, properties = consumer.queue.get()
+					delivery_tag = next(self._delivery_tags)
+					if not consumer.auto_ack:
+						consumer.unacked += 1
+						self.unacked[delivery_tag] = (consumer, body, properties)
+					deliveries.append((consumer.callback, delivery_tag, body, properties))
+		return deliveries
+
+	def _dispatch(self):
+		dispatched = 0
+		while self._confirms:
+			tag = self._confirms.popleft()
+			self._confirm_callback(SimpleNamespace(method=pika.spec.Basic.Ack(delivery_tag=tag, multiple=False)))
+			dispatched += 1
+
+		for callback, delivery_tag, body, properties in self._deliveries():
+			method = pika.spec.Basic.Deliver(delivery_tag=delivery_tag)
+			callback(self, method, properties or pika.BasicProperties(), body)
+			dispatched += 1
+		return dispatched
+
+
+class MemoryConnection:
+	"""
+	A stand-in for pika.BlockingConnection backed by the in-memory broker, selected with
+	CARROT['transport'] = 'carrot.memory.MemoryConnection'. Only works within a single process.
+	"""
+	POLL_INTERVAL = 0.1
+
+	def __init__(self, parameters=None):
+		self.is_open = True
+		self._channels = []
+		self._callbacks = deque()
+
+	def channel(self):
+		channel = MemoryChannel(self)
+		self._channels.append(channel)
+		return channel
+
+	def close(self):
+		for channel in self._channels:
+			channel.close()
+		self.is_open = False
+		with broker.condition:
+			broker.condition.notify_all()
+
+	def add_callback_threadsafe(self, callback):
+		if not self.is_open:
+			raise pika.exceptions.ConnectionWrongStateError('Connection is closed')
+		with broker.condition:
+			self._callbacks.append(callback)
+			broker.condition.notify_all()
+
+	def process_data_events(self, time_limit=0):
+		"""
+		Run threadsafe callbacks, confirms and deliveries. Waits up to `time_limit` seconds (None: until
+		something happens) when there is nothing to do.
+		"""
+		deadline = None if time_limit is None else time.monotonic() + time_limit
+		while True:
+			broker.expire()
+			if self._dispatch():
+				return
+
+			remaining = None if deadline is None else deadline - time.monotonic()
+			if remaining is not None and remaining <= 0 or not self.is_open:
+				return
+
+			waits = [self.POLL_INTERVAL, broker.next_expiry(), remaining]
+			with broker.condition:
+				if not self._callbacks:
+					broker.condition.wait(min(wait for wait in waits if wait is not None))
+
+	def _dispatch(self):
+		dispatched = 0
+		while self._callbacks:
+			self._callbacks.popleft()()
+			dispatched += 1
+		for channel in list(self._channels):
+			if channel.is_open:
+				dispatched += channel._dispatch()
+		return dispatched
@@ -0,0 +1,54 @@
+import json
+
+# Bumped whenever the layout of a task message changes
+MESSAGE_VERSION = 1
+
+FORMAT_ID = 'id'
+FORMAT_JSON = 'json'
+MESSAGE_FORMATS = (FORMAT_ID, FORMAT_JSON)
+
+
+def encode_task(task, message_format=FORMAT_ID):
+	"""
+	:param task: a saved Task instance
+	:param message_format: 'id' to send only the task id, 'json' to embed everything needed to execute it
+	:returns: str message body
+	"""
+	if message_format == FORMAT_ID:
+		return str(task.id)
+
+	assert message_format == FORMAT_JSON, f"Unknown message format ({message_format})"
+	return json.dumps({
+		'v': MESSAGE_VERSION,
+		'id': task.id,
+		'kallable': task.kallable,
+		# Arguments moved to the payload store are read by the worker, they may have been loaded on the instance
+		'args': [] if task.payload_ref else task.args or [],
+		'kwargs': {} if task.payload_ref else task.kwargs or {},
+		'queue': task.queue,
+		'eta': task.eta.isoformat() if task.eta else None,
+		'retries': task.retries,
+		'priority': task.priority,
+		'created_on': task.created_on.isoformat() if task.created_on else None,
+		'reply_to': task.reply_to,
+		'group': task.group_id,
+		'chain': task.chain,
+		'payload_ref': task.payload_ref,
+	})
+
+
+def decode_task(body):
+	"""
+	Decode a task message. Legacy id-only messages, and messages of a version this release
+	does not understand, are decoded to just their id so the task is read from the db.
+
+	:param str body: the message body
+	:returns: dict with at least an `id` key
+	"""
+	if not body.startswith('{'):
+		return {'id': body}
+
+	payload = json.loads(body)
+	if payload.get('v') != MESSAGE_VERSION:
+		return {'id': payload['id']}
+	return payload
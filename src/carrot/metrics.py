@@ -0,0 +1,296 @@
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LOGGER = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds, from sub-millisecond db reads up to long running tasks
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+
+class Counter:
+	"""
+	A monotonically increasing value per combination of label values
+
+	Example:
+	failures = Counter('publish_failures_total', 'Messages which could not be published', ['exchange'])
+	failures.inc('carrot.direct')
+	"""
+	type = 'counter'
+
+	def __init__(self, name, help, labelnames=()):
+		self.name = name
+		self.help = help
+		self.labelnames = tuple(labelnames)
+		self._values = {}
+		self._lock = threading.Lock()
+
+	def inc(self, *labelvalues, amount=1):
+		with self._lock:
+			self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+	def reset(self):
+		with self._lock:
+			self._values = {}
+
+	def snapshot(self):
+		with self._lock:
+			return [[list(labels), value] for labels, value in self._values.items()]
+
+	@staticmethod
+	def merge(value, other):
+		return value + other
+
+	def samples(self, values):
+		for labels, value in values:
+			yield self.name, dict(zip(self.labelnames, labels)), value
+
+
+class Histogram(Counter):
+	"""
+	Counts observations in cumulative buckets, plus their sum and count
+
+	Example:
+	duration = Histogram('task_duration_seconds', 'Time spent executing tasks', ['kallable'])
+	duration.observe(0.25, 'myapp.tasks.send_email')
+	"""
+	type = 'histogram'
+
+	def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+		super().__init__(name, help, labelnames)
+		self.buckets = tuple(sorted(buckets))
+
+	def observe(self, value, *labelvalues):
+		# Only the bucket the value falls in is counted here, buckets are made cumulative when rendered
+		index = bisect_left(self.buckets, value)
+		with self._lock:
+			counts = self._values.get(labelvalues)
+			if counts is None:
+				counts = self._values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+			counts[index] += 1
+			counts[-1] += value
+
+	def snapshot(self):
+		with self._lock:
+			return [[list(labels), list(counts)] for labels, counts in self._values.items()]
+
+	@staticmethod
+	def merge(value, other):
+		return [a + b for a, b in zip(value, other)]
+
+	def samples(self, values):
+		for labels, counts in values:
+			labels = dict(zip(self.labelnames, labels))
+			cumulative = 0
+			for bound, count in zip(self.buckets + (float('inf'),), counts):
+				cumulative += count
+				yield f"{self.name}_bucket", {**labels, 'le': _format_value(bound)}, cumulative
+			yield f"{self.name}_sum", labels, counts[-1]
+			yield f"{self.name}_count", labels, cumulative
+
+
+class Registry:
+	"""
+	The metrics of this process. Snapshots of several processes (e.g. the workers) can be merged and rendered together.
+	"""
+	def __init__(self, prefix='carrot_'):
+		self.prefix = prefix
+		self._metrics = {}
+
+	def counter(self, name, help, labelnames=()):
+		return self._register(Counter(self.prefix + name, help, labelnames))
+
+	def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+		return self._register(Histogram(self.prefix + name, help, labelnames, buckets))
+
+	def _register(self, metric):
+		assert metric.name not in self._metrics, f"Metric ({metric.name}) is already registered"
+		self._metrics[metric.name] = metric
+		return metric
+
+	def reset(self):
+		for metric in self._metrics.values():
+			metric.reset()
+
+	def snapshot(self):
+		"""
+		:returns: a json serializable dict of every metric name to its values
+		"""
+		return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+	def merge(self, *snapshots):
+		"""
+		:returns: one snapshot summing the values of every snapshot, for the metrics of this registry
+		"""
+		merged = {}
+		for snapshot in snapshots:
+			for name, values in snapshot.items():
+				metric = self._metrics.get(name)
+				if metric is None:
+					continue
+				into = merged.setdefault(name, {})
+				for labels, value in values:
+					labels = tuple(labels)
+					into[labels] = metric.merge(into[labels], value) if labels in into else value
+		return {name: [[list(labels), value] for labels, value in values.items()] for name, values in merged.items()}
+
+	def render(self, snapshot=None):
+		"""
+		:returns: the metrics in the Prometheus text exposition format
+		"""
+		snapshot = self.snapshot() if snapshot is None else snapshot
+		lines = []
+		for name, metric in self._metrics.items():
+			lines.append(f"# HELP {name} {metric.help}")
+			lines.append(f"# TYPE {name} {metric.type}")
+			for sample_name, labels, value in metric.samples(snapshot.get(name, [])):
+				lines.append(f"{sample_name}{_format_labels(labels)} {_format_value(value)}")
+		return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+	if not labels:
+		return ''
+	pairs = ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+	return f"{{{pairs}}}"
+
+
+def _escape(value):
+	return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+	if value == float('inf'):
+		return '+Inf'
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REGISTRY = Registry()
+
+# Forked workers start counting from zero, whatever their parent counted is reported by the parent
+if hasattr(os, 'register_at_fork'):
+	os.register_at_fork(after_in_child=REGISTRY.reset)
+
+PUBLISHED = REGISTRY.counter('published_total', "Messages published", ['exchange'])
+PUBLISH_FAILURES = REGISTRY.counter('publish_failures_total', "Messages which failed to publish, including retried attempts", ['exchange'])
+ENQUEUE_SECONDS = REGISTRY.histogram('enqueue_seconds', "Time to publish a single task or a batch of tasks, including confirms", ['kind'])
+QUEUE_WAIT_SECONDS = REGISTRY.histogram('queue_wait_seconds', "Time from a task being created (or due) to it starting", ['queue'])
+TASK_FETCH_SECONDS = REGISTRY.histogram('task_fetch_seconds', "Time reading a task from the db in the worker")
+TASK_SECONDS = REGISTRY.histogram('task_seconds', "Time executing a task", ['kallable', 'status'])
+TASKS = REGISTRY.counter('tasks_total', "Tasks executed", ['queue', 'status'])
+TASKS_THROTTLED = REGISTRY.counter('tasks_throttled_total', "Tasks deferred by the rate limit of their kallable", ['kallable'])
+CONSUMER_RECONNECTS = REGISTRY.counter('consumer_reconnects_total', "Consumer reconnects after the connection was lost", ['queue'])
+
+
+class SnapshotWriter:
+	"""
+	Writes the snapshot of a registry to `directory`/<pid>.json every `interval` seconds, so the metrics of
+	many worker processes can be aggregated by the supervisor
+	"""
+	def __init__(self, directory, interval, registry=REGISTRY):
+		self.directory = directory
+		self.interval = interval
+		self.registry = registry
+		self._stopped = threading.Event()
+		self._thread = None
+
+	def start(self):
+		self._stopped.clear()
+		self._thread = threading.Thread(target=self._write_periodically, name='carrot-metrics', daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		self._stopped.set()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+		self.write()
+
+	def write(self):
+		# Written to a temporary file first, so a reader never sees half a snapshot
+		path = snapshot_path(self.directory, os.getpid())
+		tmp_path = f"{path}.tmp"
+		try:
+			with open(tmp_path, 'w') as f:
+				json.dump(self.registry.snapshot(), f)
+			os.replace(tmp_path, path)
+		except OSError:
+			LOGGER.exception(f"Unable to write metrics snapshot ({path})")
+
+	def _write_periodically(self):
+		while not self._stopped.wait(self.interval):
+			self.write()
+
+
+def default_directory(pid):
+	"""
+	The snapshot directory of the supervisor `pid`, so deployments sharing a host don't mix their snapshots
+	"""
+	return os.path.join(tempfile.gettempdir(), f"carrot-metrics-{pid}")
+
+
+def snapshot_path(directory, pid):
+	return os.path.join(directory, f"{pid}.json")
+
+
+def read_snapshots(directory):
+	"""
+	:returns: list of the snapshots written to `directory`
+	"""
+	return read_snapshots_from(glob.glob(os.path.join(directory, '*.json')))
+
+
+def read_snapshots_from(paths):
+	snapshots = []
+	for path in paths:
+		try:
+			with open(path) as f:
+				snapshots.append(json.load(f))
+		except (OSError, ValueError):
+			# The process may have been replaced meanwhile
+			continue
+	return snapshots
+
+
+def start_http_server(port, collect=None, address='127.0.0.1'):
+	"""
+	Serve the metrics on http://<address>:<port>/metrics from a background thread
+
+	:param collect: optional callable returning the text to serve, by default this process' metrics
+	:returns: the ThreadingHTTPServer, call shutdown() to stop it
+	"""
+	collect = collect or REGISTRY.render
+
+	class MetricsHandler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			body = collect().encode('utf-8')
+			self.send_response(200)
+			self.send_header('Content-Type', CONTENT_TYPE)
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			pass
+
+	server = ThreadingHTTPServer((address, port), MetricsHandler)
+	server.daemon_threads = True
+	threading.Thread(target=server.serve_forever, name='carrot-metrics-http', daemon=True).start()
+	LOGGER.info(f"Serving metrics on ({address}:{port})")
+	return server
+
+
+def metrics_view(request):
+	"""
+	A django view of this process' metrics, e.g. path('metrics', carrot.metrics.metrics_view)
+	"""
+	from django.http import HttpResponse
+
+	return HttpResponse(REGISTRY.render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,12 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carrot', '0003_add_pid_field'),
+    ]
+
+    operations = [
+		migrations.AddField('Task', 'published_on', models.DateTimeField(blank=True, null=True)),
+    ]
@@ -0,0 +1,47 @@
+import carrot.fields
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def text_to_json(apps, schema_editor):
+	Task = apps.get_model('carrot', 'Task')
+	db_alias = schema_editor.connection.alias
+
+	batch = []
+	for task in Task.objects.using(db_alias).only('id', 'args', 'kwargs').iterator(chunk_size=BATCH_SIZE):
+		task.args_json = task.args
+		task.kwargs_json = task.kwargs
+		batch.append(task)
+		if len(batch) >= BATCH_SIZE:
+			Task.objects.using(db_alias).bulk_update(batch, ['args_json', 'kwargs_json'])
+			batch = []
+
+	if batch:
+		Task.objects.using(db_alias).bulk_update(batch, ['args_json', 'kwargs_json'])
+
+
+def json_to_text(apps, schema_editor):
+	# The text fields can't be written with bulk_update's CASE expressions, so rows are updated one at a time
+	Task = apps.get_model('carrot', 'Task')
+	db_alias = schema_editor.connection.alias
+
+	for task in Task.objects.using(db_alias).only('id', 'args_json', 'kwargs_json').iterator(chunk_size=BATCH_SIZE):
+		Task.objects.using(db_alias).filter(id=task.id).update(args=task.args_json or [], kwargs=task.kwargs_json or {})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carrot', '0004_add_published_on_field'),
+    ]
+
+    operations = [
+        migrations.AddField('Task', 'args_json', carrot.fields.LazyJSONField(blank=True, default=list)),
+        migrations.AddField('Task', 'kwargs_json', carrot.fields.LazyJSONField(blank=True, default=dict)),
+        migrations.RunPython(text_to_json, json_to_text),
+        migrations.RemoveField('Task', 'args'),
+        migrations.RemoveField('Task', 'kwargs'),
+        migrations.RenameField('Task', 'args_json', 'args'),
+        migrations.RenameField('Task', 'kwargs_json', 'kwargs'),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+import carrot.operations
+
+
+class Migration(migrations.Migration):
+
+    # Built with CREATE INDEX CONCURRENTLY on PostgreSQL, which can't run within a transaction
+    atomic = False
+
+    dependencies = [
+        ('carrot', '0005_json_arguments'),
+    ]
+
+    operations = [
+        carrot.operations.AddIndexConcurrently(
+            model_name='task',
+            index=models.Index(fields=['status', 'queue', 'created_on'], name='carrot_task_status_queue_idx'),
+        ),
+        carrot.operations.AddIndexConcurrently(
+            model_name='task',
+            index=models.Index(condition=models.Q(status__in=['pending', 'running']), fields=['queue', 'created_on'], name='carrot_task_active_idx'),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carrot', '0007_task_eta'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='retries',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
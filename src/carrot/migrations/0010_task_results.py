@@ -0,0 +1,27 @@
+import carrot.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carrot', '0009_task_priority'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='reply_to',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='result',
+            field=carrot.fields.LazyJSONField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='result_expires',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carrot', '0010_task_results'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='dedupe_key',
+            field=models.CharField(blank=True, default=None, max_length=255, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='task',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'pending')), fields=('dedupe_key',), name='carrot_task_pending_dedupe_key'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carrot', '0011_task_dedupe_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Throttle',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kallable', models.CharField(max_length=512, unique=True)),
+                ('tokens', models.FloatField(default=0)),
+                ('updated_on', models.DateTimeField()),
+            ],
+        ),
+    ]
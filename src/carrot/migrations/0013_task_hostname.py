@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carrot', '0012_throttle'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='hostname',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
@@ -0,0 +1,35 @@
+import carrot.fields
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carrot', '0013_task_hostname'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskGroup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.PositiveIntegerField()),
+                ('remaining', models.IntegerField()),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('callback', carrot.fields.LazyJSONField(blank=True, default=None, null=True)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('completed_on', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='chain',
+            field=carrot.fields.LazyJSONField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='group',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='tasks', to='carrot.taskgroup'),
+        ),
+    ]
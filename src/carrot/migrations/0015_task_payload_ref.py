@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carrot', '0014_task_groups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='payload_ref',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+import carrot.operations
+
+
+class Migration(migrations.Migration):
+
+    # Built with CREATE INDEX CONCURRENTLY on PostgreSQL, which can't run within a transaction
+    atomic = False
+
+    dependencies = [
+        ('carrot', '0015_task_payload_ref'),
+    ]
+
+    operations = [
+        carrot.operations.AddIndexConcurrently(
+            model_name='task',
+            index=models.Index(condition=models.Q(result_expires__isnull=False), fields=['result_expires'], name='carrot_task_result_expires_idx'),
+        ),
+    ]
@@ -1,20 +1,235 @@
+import asyncio
+import json
 import logging
 import os
+import socket
+import time
+from datetime import timedelta
 
-from django.db import models
+from asgiref.sync import async_to_sync, sync_to_async
+from django.db import IntegrityError, models, connections, router, transaction
 from django.core.validators import ValidationError
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
-from carrot.fields import ListField, DictField
-from carrot.connections import publisher
+from carrot.fields import LazyJSONField, LazyJSONQuerySet
+from carrot import metrics, outbox, payloads
+from carrot.connections import pool
+from carrot.messages import encode_task
+from carrot.results import AsyncResult, encode_result, listener
+from carrot.retry import get_policy
+from carrot.scheduling import DUE_THRESHOLD, choose_delay, delay_queue_name
 from carrot.settings import carrot_settings, DEFAULT_QUEUE_NAME
-from carrot.utils import import_callable
+from carrot.status import StatusReporter
+from carrot.utils import CallableCache
 
 
 LOGGER = logging.getLogger(__name__)
 EMPTY_STRING = ''
 MESSAGE_FIELD_MAX_LEN = 2048
 
+# Recorded with the pid of the worker running a task, a pid can only be checked on its own host
+HOSTNAME = socket.gethostname()
+
+SYNC_REPORTER = StatusReporter()
+
+# Resolved kallables, shared by validation and execution
+kallables = CallableCache(
+	maxsize=carrot_settings['kallable_cache_size'],
+	negative_ttl=carrot_settings['kallable_negative_ttl'],
+	allowed=carrot_settings['allowed_kallables'],
+)
+
+
+class TaskManager(models.Manager.from_queryset(LazyJSONQuerySet)):
+	def create(self, countdown=None, reply=False, debounce=None, **kwargs):
+		"""
+		:param countdown: optional number of seconds to wait before the task is executed, sets `eta`
+		:param reply: if True, the worker notifies this process when the task finishes, so task.wait() doesn't poll
+		:param debounce: optional number of seconds to hold a task with a `dedupe_key` before it's executed, every
+			identical task created meanwhile is merged into it
+		"""
+		return super().create(**self._task_kwargs(countdown, reply, debounce, kwargs))
+
+	async def aenqueue(self, countdown=None, reply=False, debounce=None, **kwargs):
+		"""
+		Create a task from a coroutine, e.g. an async view. The row is written from a thread, as Django's async ORM does, and the
+		message is published on the event loop's AsyncRabbitPublisher, so no thread waits on RabbitMQ. The
+		arguments are those of create().
+
+		:returns: the task, once its message was confirmed by the broker
+		"""
+		task = await sync_to_async(self._insert)(countdown, reply, debounce, kwargs)
+		if task.deduplicated or not task.can_publish:
+			return task
+
+		await task.apublish()
+		if carrot_settings['outbox']:
+			# Published already, so the outbox relay must not publish it again
+			await self.filter(id=task.id).aupdate(published_on=timezone.now())
+		return task
+
+	def _insert(self, countdown, reply, debounce, kwargs):
+		# reply=True may open the result listener's connection, so the kwargs are built off the loop too
+		task = self.model(**self._task_kwargs(countdown, reply, debounce, kwargs))
+		task.save(force_insert=True, using=self._db_for_write(), publish=False)
+		return task
+
+	def _db_for_write(self):
+		# self.db is the read alias, a router may send it to a replica
+		return self._db or router.db_for_write(self.model)
+
+	@staticmethod
+	def _task_kwargs(countdown, reply, debounce, kwargs):
+		if debounce is not None:
+			if not kwargs.get('dedupe_key'):
+				raise ValidationError("debounce requires a dedupe_key")
+			countdown = debounce
+		if countdown is not None:
+			kwargs['eta'] = timezone.now() + timedelta(seconds=countdown)
+		if reply:
+			kwargs['reply_to'] = listener.reply_to
+		return kwargs
+
+	def claim_pending(self, task_id, exclude_kallables=()):
+		"""
+		Read a task and mark it running for this process in one statement, only if it's pending and due. Of two
+		workers handling the same message (e.g. a redelivery), at most one gets the task.
+
+		On PostgreSQL and SQLite (3.35+) this is a single UPDATE ... RETURNING, elsewhere the row is locked with
+		SELECT ... FOR UPDATE SKIP LOCKED and updated in the same transaction.
+
+		:param exclude_kallables: kallables which are never claimed here, e.g. rate limited ones are claimed by their RateLimit
+		:returns: the running task, or None if it doesn't exist, isn't pending, isn't due or has an excluded kallable
+		"""
+		Status = self.model.Status
+		# Id-only messages carry the id as a str
+		task_id = self.model._meta.pk.to_python(task_id)
+		now = timezone.now()
+		pid = os.getpid()
+		due_before = now + timedelta(seconds=DUE_THRESHOLD)
+		exclude_kallables = list(exclude_kallables)
+
+		using = self._db_for_write()
+		connection = connections[using]
+		if connection.vendor == 'postgresql' or (connection.vendor == 'sqlite' and connection.Database.sqlite_version_info >= (3, 35)):
+			quote = connection.ops.quote_name
+			adapt = connection.ops.adapt_datetimefield_value
+			sql = (
+				f"UPDATE {quote(self.model._meta.db_table)} SET {quote('status')} = %s, {quote('started_on')} = %s, "
+				f"{quote('pid')} = %s, {quote('hostname')} = %s WHERE {quote('id')} = %s AND {quote('status')} = %s "
+				f"AND ({quote('eta')} IS NULL OR {quote('eta')} < %s)"
+			)
+			params = [Status.RUNNING, adapt(now), pid, HOSTNAME, task_id, Status.PENDING, adapt(due_before)]
+			if exclude_kallables:
+				sql += f" AND {quote('kallable')} NOT IN ({', '.join(['%s'] * len(exclude_kallables))})"
+				params += exclude_kallables
+			sql += f" RETURNING {', '.join(quote(field.column) for field in self.model._meta.concrete_fields)}"
+			# Raw querysets convert the returned columns like any other query
+			tasks = list(self.raw(sql, params, using=using))
+			return tasks[0] if tasks else None
+
+		queryset = self.using(using).filter(id=task_id, status=Status.PENDING).filter(models.Q(eta__isnull=True) | models.Q(eta__lt=due_before))
+		if exclude_kallables:
+			queryset = queryset.exclude(kallable__in=exclude_kallables)
+		skip_locked = connection.features.has_select_for_update_skip_locked
+		with transaction.atomic(using=using):
+			task = queryset.select_for_update(skip_locked=skip_locked).first()
+			if task is not None:
+				self.using(using).filter(id=task.id).update(status=Status.RUNNING, started_on=now, pid=pid, hostname=HOSTNAME)
+				task.status = Status.RUNNING
+				task.started_on = now
+				task.pid = pid
+				task.hostname = HOSTNAME
+		return task
+
+	def bulk_enqueue(self, tasks, batch_size=None):
+		"""
+		Create and publish many tasks at once. Each distinct kallable and queue is validated a single time,
+		rows are written with bulk_create and every message is published back to back on one channel.
+		Backends which don't return primary keys from bulk inserts (MySQL) insert the rows one by one instead.
+
+		:param tasks: iterable of unsaved Task instances
+		:param batch_size: passed through to bulk_create
+		:returns: list of (task, exception) tuples for tasks which were saved but could not be published.
+			Tasks with the `dedupe_key` of a pending task are skipped and marked `deduplicated`.
+		"""
+		using = self._db_for_write()
+		tasks = list(tasks)
+		for kallable in {task.kallable for task in tasks}:
+			self.model.validate_kallable(kallable)
+		for queue in {task.queue for task in tasks}:
+			self.model.validate_queue(queue)
+		for task in tasks:
+			task.validate_arguments()
+			task.truncate_message()
+
+		externalized = []
+		try:
+			for task in tasks:
+				payload_ref = payloads.externalize(task)
+				if payload_ref:
+					externalized.append((task, payload_ref))
+
+			# All or nothing, so the payloads can be deleted if a row fails to insert
+			with transaction.atomic(using=using):
+				if not any(task.dedupe_key for task in tasks):
+					created = self._create_all(tasks, batch_size, using)
+				else:
+					created = self._bulk_create_deduplicated(tasks, batch_size, using)
+		except Exception:
+			payloads.delete([payload_ref for _, payload_ref in externalized])
+			raise
+
+		# No row refers to the payloads written for skipped duplicates: they were never inserted, or (after an
+		# IntegrityError) were reloaded as the pending task with its own payload_ref
+		payloads.delete([payload_ref for task, payload_ref in externalized if task.deduplicated])
+		publishable = [task for task in created if task.can_publish]
+		if carrot_settings['outbox']:
+			# Failures are logged at commit time and left for the outbox relay
+			outbox.enqueue(publishable, using)
+			return []
+		return self.model.publish_many(publishable)
+
+	def _create_all(self, tasks, batch_size, using):
+		"""
+		bulk_create `tasks`. The ids are needed to publish them, so backends which don't return them from bulk
+		inserts get one INSERT per task within a single transaction.
+		"""
+		if connections[using].features.can_return_rows_from_bulk_insert:
+			return self.using(using).bulk_create(tasks, batch_size=batch_size)
+
+		with transaction.atomic(using=using):
+			for task in tasks:
+				# Model.save, as Task.save would validate and publish each task again
+				models.Model.save(task, force_insert=True, using=using)
+		return tasks
+
+	def _bulk_create_deduplicated(self, tasks, batch_size, using):
+		"""
+		bulk_create the tasks whose dedupe_key isn't already pending, or repeated earlier in `tasks`
+		"""
+		keys = {task.dedupe_key for task in tasks if task.dedupe_key}
+		seen = set(self.using(using).filter(dedupe_key__in=keys, status=self.model.Status.PENDING).values_list('dedupe_key', flat=True))
+		unique = []
+		for task in tasks:
+			if task.dedupe_key:
+				if task.dedupe_key in seen:
+					task.deduplicated = True
+					continue
+				seen.add(task.dedupe_key)
+			unique.append(task)
+
+		try:
+			with transaction.atomic(using=using):
+				return self._create_all(unique, batch_size, using)
+		except IntegrityError:
+			# An identical task was created concurrently: insert one at a time, so only the duplicates are skipped
+			for task in unique:
+				task.pk = None
+				task._state.adding = True
+			return [task for task in unique if task._insert_unless_pending(using=using)]
+
 
 class Task(models.Model):
 	"""
@@ -33,8 +248,8 @@ class Task(models.Model):
 		UNKNOWN_ERROR = 1
 
 	kallable = models.CharField(max_length=512)
-	args = ListField(blank=True, default=EMPTY_STRING)
-	kwargs = DictField(blank=True, default=EMPTY_STRING)
+	args = LazyJSONField(blank=True, default=list)
+	kwargs = LazyJSONField(blank=True, default=dict)
 
 	queue = models.CharField(max_length=255, blank=True, default=DEFAULT_QUEUE_NAME)
 
@@ -43,91 +258,587 @@ class Task(models.Model):
 	exit_code = models.SmallIntegerField(choices=ExitCode.choices, blank=True, null=True)
 	created_by = models.CharField(max_length=512, blank=True, default=EMPTY_STRING)
 	pid = models.IntegerField(blank=True, null=True)
+	hostname = models.CharField(max_length=255, blank=True, default=EMPTY_STRING)
 
 	created_on = models.DateTimeField(auto_now_add=True)
 	started_on = models.DateTimeField(null=True, blank=True)
 	completed_on = models.DateTimeField(null=True, blank=True)
+	published_on = models.DateTimeField(null=True, blank=True)
+	eta = models.DateTimeField(null=True, blank=True)
+	retries = models.PositiveIntegerField(default=0)
+	priority = models.PositiveSmallIntegerField(default=0)
+	reply_to = models.CharField(max_length=255, blank=True, default=EMPTY_STRING)
+	result = LazyJSONField(null=True, blank=True, default=None)
+	result_expires = models.DateTimeField(null=True, blank=True)
+	dedupe_key = models.CharField(max_length=255, null=True, blank=True, default=None)
+	# Groups are pruned apart from their tasks, so there's no constraint to cascade through every member
+	group = models.ForeignKey('TaskGroup', null=True, blank=True, on_delete=models.DO_NOTHING, db_constraint=False, related_name='tasks')
+	# The tasks to run after this one completes, see carrot.workflows.chain()
+	chain = LazyJSONField(null=True, blank=True, default=None)
+	# Set when args and kwargs were moved to the payload store (CARROT['payload_store']), they are then empty here
+	payload_ref = models.CharField(max_length=64, blank=True, default=EMPTY_STRING)
+
+	objects = TaskManager()
+
+	# Set when saving found an identical pending task, this instance then holds that task
+	deduplicated = False
+
+	class Meta:
+		indexes = [
+			models.Index(fields=['status', 'queue', 'created_on'], name='carrot_task_status_queue_idx'),
+			# Only the small, hot part of the table: tasks which are waiting or running
+			models.Index(
+				fields=['queue', 'created_on'],
+				name='carrot_task_active_idx',
+				condition=models.Q(status__in=['pending', 'running']),
+			),
+			# Only the tasks which hold a result, for expiring them
+			models.Index(
+				fields=['result_expires'],
+				name='carrot_task_result_expires_idx',
+				condition=models.Q(result_expires__isnull=False),
+			),
+		]
+		constraints = [
+			# Only enforced by backends which support partial indexes (PostgreSQL, SQLite)
+			models.UniqueConstraint(
+				fields=['dedupe_key'],
+				name='carrot_task_pending_dedupe_key',
+				condition=models.Q(status='pending'),
+			),
+		]
 
 	@property
 	def can_publish(self):
 		return self.queue in carrot_settings['queues'] and self.status == self.Status.PENDING
 
-	def execute(self):
-		"""
-		Execute the function that this task represents
+	@property
+	def is_due(self):
+		return self.eta is None or (self.eta - timezone.now()).total_seconds() < DUE_THRESHOLD
+
+	def claim(self):
 		"""
-		# List/Dictfields may not be lists/dicts if the model instance
-		# wasn't initialized from the db
-		if not self.args:
-			self.args = []
-		if not self.kwargs:
-			self.kwargs = {}
+		Atomically mark this task as running, only if it's still pending.
+		Guards against executing a task twice when the row wasn't read before execution.
 
+		:returns: True if this call moved the task from pending to running
+		"""
 		self.started_on = timezone.now()
-		self.status = self.Status.RUNNING
 		self.pid = os.getpid()
-		if self.id:
-			self.save(validate=False, update_fields={'status', 'started_on', 'pid'})
+		self.hostname = HOSTNAME
+		claimed = type(self).objects.filter(id=self.id, status=self.Status.PENDING).update(
+			status=self.Status.RUNNING,
+			started_on=self.started_on,
+			pid=self.pid,
+			hostname=self.hostname,
+		)
+		if claimed:
+			self.status = self.Status.RUNNING
+		return bool(claimed)
+
+	def execute(self, claimed=False, reporter=None):
+		"""
+		Execute the function that this task represents
+
+		:param claimed: True if the task was already marked running with self.claim()
+		:param reporter: optional StatusReporter used to write the status, by default it's written synchronously
+		"""
+		reporter = reporter or SYNC_REPORTER
+		self._mark_running(claimed, reporter)
 
 		LOGGER.info(f"Executing task (pid: {self.pid}) ({self.id}) => ({self.kallable})")
 		try:
 			self.exit_code = self.ExitCode.SUCCESS
 			self.message = ''
-			func = import_callable(self.kallable)
-			return func(*self.args, **self.kwargs)
+			func = kallables.resolve(self.kallable)
+			self._load_payload()
+			if asyncio.iscoroutinefunction(func):
+				# Outside of an asyncio queue a coroutine would never be awaited, it's run on a loop of its own
+				func = async_to_sync(func)
+			return self._keep_result(func(*self.args, **self.kwargs))
 
 		except Exception as e:
 			self.exit_code = self.ExitCode.UNKNOWN_ERROR
 			self.message = repr(e)
+			self._schedule_retry(e)
 			raise
 
 		finally:
-			self.status = self.Status.COMPLETED if self.exit_code == self.ExitCode.SUCCESS else self.Status.FAILED
-			self.completed_on = timezone.now()
-			self.pid = None
+			self._mark_finished(reporter)
+
+	async def aexecute(self, claimed=False, reporter=None):
+		"""
+		Execute the function that this task represents from within an event loop.
+		Coroutine functions are awaited, other callables are run in a thread so they don't block the loop.
+
+		:param claimed: True if the task was already marked running with self.claim()
+		:param reporter: optional StatusReporter used to write the status, by default it's written synchronously
+		"""
+		reporter = reporter or SYNC_REPORTER
+		await sync_to_async(self._mark_running)(claimed, reporter)
+
+		LOGGER.info(f"Executing task (pid: {self.pid}) ({self.id}) => ({self.kallable})")
+		try:
+			self.exit_code = self.ExitCode.SUCCESS
+			self.message = ''
+			func = kallables.resolve(self.kallable)
+			if self.payload_ref:
+				await sync_to_async(self._load_payload, thread_sensitive=False)()
+			if asyncio.iscoroutinefunction(func):
+				return self._keep_result(await func(*self.args, **self.kwargs))
+			return self._keep_result(await sync_to_async(func, thread_sensitive=False)(*self.args, **self.kwargs))
+
+		except Exception as e:
+			self.exit_code = self.ExitCode.UNKNOWN_ERROR
+			self.message = repr(e)
+			self._schedule_retry(e)
+			raise
+
+		finally:
+			await sync_to_async(self._mark_finished)(reporter)
+
+	def _load_payload(self):
+		# Large arguments are only read from the payload store once the task is about to run, a missing payload fails it
+		if self.payload_ref:
+			self.args, self.kwargs = payloads.load(self.payload_ref)
+
+	def _mark_running(self, claimed, reporter):
+		# List/Dictfields may not be lists/dicts if the model instance
+		# wasn't initialized from the db
+		if not self.args:
+			self.args = []
+		if not self.kwargs:
+			self.kwargs = {}
+
+		self._execute_start = time.perf_counter()
+		if not claimed:
+			self.started_on = timezone.now()
+			self.status = self.Status.RUNNING
+			self.pid = os.getpid()
+			self.hostname = HOSTNAME
 			if self.id:
-				self.save(validate=False, update_fields={'status', 'exit_code', 'completed_on', 'message', 'pid'})
+				reporter.running(self)
+
+	def _mark_finished(self, reporter):
+		self.pid = None
+		if self.status == self.Status.PENDING:
+			# A retry was scheduled: the task waits in a delay queue, using no worker, until its eta
+			try:
+				reporter.retrying(self)
+			except IntegrityError:
+				# An identical task was created while this one ran, it's executed instead of the retry
+				LOGGER.info(f"Retry of task ({self.id}) dropped, a task with dedupe_key ({self.dedupe_key}) is pending")
+				self.message = f"{self.message}, retry dropped for a pending duplicate"[:MESSAGE_FIELD_MAX_LEN]
+			else:
+				metrics.TASK_SECONDS.observe(time.perf_counter() - self._execute_start, self.kallable, 'retrying')
+				metrics.TASKS.inc(self.queue, 'retrying')
+				try:
+					self.publish()
+				except Exception:
+					LOGGER.exception(f"Unable to publish retry ({self.retries}) of task ({self.id})")
+				return
+
+		self.status = self.Status.COMPLETED if self.exit_code == self.ExitCode.SUCCESS else self.Status.FAILED
+		self.completed_on = timezone.now()
+		metrics.TASK_SECONDS.observe(time.perf_counter() - self._execute_start, self.kallable, self.status)
+		metrics.TASKS.inc(self.queue, self.status)
+		if self.id:
+			# The status of a workflow task is written before its group or chain continues, so the callback
+			# or next step reads it from the db rather than a status still buffered by the reporter
+			(SYNC_REPORTER if self.group_id or self.chain else reporter).finished(self)
+		if self.reply_to:
+			self._reply()
+		if self.id and (self.group_id or self.chain):
+			self._continue_workflow()
+
+	def _continue_workflow(self):
+		"""
+		Count this task towards its group, publishing the group's callback if it was the last one,
+		and publish the next task of its chain if it completed
+		"""
+		try:
+			if self.group_id:
+				# Not self._state.db, a task read from a message or a replica would count towards the group there
+				TaskGroup.finish_one(self.group_id, failed=self.status == self.Status.FAILED, using=router.db_for_write(TaskGroup))
+			if self.chain and self.status == self.Status.COMPLETED:
+				step = self.from_spec(self.chain[0])
+				step.chain = self.chain[1:] or None
+				step.save()
+		except Exception:
+			LOGGER.exception(f"Unable to continue the workflow of task ({self.id})")
+
+	def _keep_result(self, value):
+		"""
+		Store the return value of the kallable if the queue keeps results, and hold on to it for the reply
+		"""
+		store = self.queue in carrot_settings['queues'] and carrot_settings['queues'][self.queue]['store_results']
+		if store or self.reply_to:
+			kept, self._result_reason = encode_result(value, carrot_settings['result_max_size'])
+			if self._result_reason is not None:
+				LOGGER.warning(f"Result of task ({self.id}) was not kept: {self._result_reason}")
+			elif store:
+				self.result = kept
+				self.result_expires = timezone.now() + timedelta(seconds=carrot_settings['result_ttl'])
+			self._reply_result = kept
+		return value
+
+	def _reply(self):
+		"""
+		Notify the process waiting on this task that it finished
+		"""
+		payload = {'id': self.id, 'status': self.status, 'message': self.message}
+		reason = getattr(self, '_result_reason', None)
+		if self.status == self.Status.COMPLETED and reason is None:
+			payload['result'] = getattr(self, '_reply_result', None)
+		elif reason is not None:
+			payload['reason'] = reason
+
+		try:
+			with pool.checkout() as publisher:
+				publisher.publish_confirmed(json.dumps(payload), exchange=carrot_settings['exchange'], routing_key=self.reply_to)
+		except Exception:
+			LOGGER.exception(f"Unable to send the result of task ({self.id}) to ({self.reply_to})")
+
+	def wait(self, timeout=None):
+		"""
+		Wait for this task to finish, see AsyncResult.get()
+
+		:returns: the return value of the kallable
+		"""
+		return AsyncResult(self).get(timeout)
+
+	def _schedule_retry(self, exc):
+		"""
+		Mark the task pending again, with an eta, if its retry policy allows another attempt after `exc`
+		"""
+		if not self.id or self.queue not in carrot_settings['queues']:
+			return
+		policy = get_policy(self.kallable, self.queue)
+		if policy is None or not policy.should_retry(exc, self.retries):
+			return
+
+		delay = policy.delay(self.retries)
+		self.retries += 1
+		self.eta = timezone.now() + timedelta(seconds=delay)
+		self.status = self.Status.PENDING
+		LOGGER.info(f"Task ({self.id}) failed with {self.message}, retry ({self.retries}) in ({delay:.1f}) seconds")
 
 	def publish(self):
 		"""
 		Publishes message to configured RabbitMQ connection if self.queue is a valid Queue member
 		"""
 		assert self.can_publish
-		publisher.publish(
-			message=str(self.id),
+		start = time.perf_counter()
+		routing_key, message, priority = self.get_message()
+		with pool.checkout() as publisher:
+			# Waits for the broker to confirm the message when publisher confirms are enabled, a nack raises
+			publisher.publish_confirmed(
+				message=message,
+				exchange=carrot_settings['exchange'],
+				routing_key=routing_key,
+				priority=priority,
+			)
+		metrics.ENQUEUE_SECONDS.observe(time.perf_counter() - start, 'task')
+
+	async def apublish(self):
+		"""
+		Publish from a coroutine, on the event loop's AsyncRabbitPublisher, and wait for the broker to confirm
+		"""
+		from carrot import aio
+
+		assert self.can_publish
+		start = time.perf_counter()
+		routing_key, message, priority = self.get_message()
+		await aio.get_publisher().publish(
+			message,
 			exchange=carrot_settings['exchange'],
-			routing_key=carrot_settings['queues'][self.queue]['queue_name'],
+			routing_key=routing_key,
+			priority=priority,
 		)
+		metrics.ENQUEUE_SECONDS.observe(time.perf_counter() - start, 'task')
+
+	@classmethod
+	def publish_many(cls, tasks):
+		"""
+		Publishes messages for many tasks in a single batch
+
+		:returns: list of (task, exception) tuples for tasks which could not be published
+		"""
+		assert all(task.can_publish for task in tasks)
+		start = time.perf_counter()
+		with pool.checkout() as publisher:
+			failures = publisher.publish_batch(
+				[task.get_message() for task in tasks],
+				exchange=carrot_settings['exchange'],
+			)
+		metrics.ENQUEUE_SECONDS.observe(time.perf_counter() - start, 'batch')
+		return [(tasks[index], error) for index, error in failures]
+
+	def get_message(self):
+		"""
+		:returns: tuple of (routing_key, message body, priority) used to publish this task.
+			Tasks with an eta in the future are routed to the delay queue which fits the remaining time.
+		"""
+		routing_key = carrot_settings['queues'][self.queue]['queue_name']
+		delay = choose_delay(self.eta, carrot_settings['delay_buckets'])
+		if delay is not None:
+			routing_key = delay_queue_name(routing_key, delay)
+		# The priority is only sent to queues which support it
+		priority = self.priority if carrot_settings['queues'][self.queue]['max_priority'] else None
+		return routing_key, encode_task(self, carrot_settings['message_format']), priority
+
+	@classmethod
+	def from_message(cls, payload):
+		"""
+		Build a task from a decoded message payload without reading it from the db.
+		The instance behaves as if it was loaded, so status updates are written by id.
+		"""
+		task = cls(
+			id=payload['id'],
+			kallable=payload['kallable'],
+			args=payload['args'],
+			kwargs=payload['kwargs'],
+			queue=payload['queue'],
+			eta=parse_datetime(payload['eta']) if payload.get('eta') else None,
+			retries=payload.get('retries', 0),
+			priority=payload.get('priority', 0),
+			created_on=parse_datetime(payload['created_on']) if payload.get('created_on') else None,
+			reply_to=payload.get('reply_to', EMPTY_STRING),
+			group_id=payload.get('group'),
+			chain=payload.get('chain'),
+			payload_ref=payload.get('payload_ref', EMPTY_STRING),
+			status=cls.Status.PENDING,
+		)
+		task._state.adding = False
+		# The task is claimed and updated from here on, never read again
+		task._state.db = router.db_for_write(cls)
+		return task
+
+	def to_spec(self):
+		"""
+		:returns: json serializable dict of what's needed to create this task later, see from_spec()
+		"""
+		return {
+			'kallable': self.kallable,
+			'args': list(self.args or []),
+			'kwargs': dict(self.kwargs or {}),
+			'queue': self.queue,
+			'priority': self.priority,
+		}
+
+	@classmethod
+	def from_spec(cls, spec, **kwargs):
+		"""
+		:returns: an unsaved task from a dict of to_spec(), extra `kwargs` are passed to its kallable
+		"""
+		return cls(
+			kallable=spec['kallable'],
+			args=spec.get('args', []),
+			kwargs={**spec.get('kwargs', {}), **kwargs},
+			queue=spec.get('queue', DEFAULT_QUEUE_NAME),
+			priority=spec.get('priority', 0),
+		)
+
+	@staticmethod
+	def validate_kallable(kallable):
+		"""
+		Used to verify that a kallable is both importable and is callable
+		"""
+		func = kallables.resolve(kallable)
+
+		if not callable(func):
+			raise ValidationError(f"Callable ({kallable}) is not callable")
+
+	@staticmethod
+	def validate_queue(queue):
+		"""
+		Used to verify that a queue is valid, if set
+		"""
+		if queue and queue not in carrot_settings['queues']:
+			raise ValidationError(f"({queue}) is not a valid carrot queue")
 
 	def validate(self):
 		"""
 		Used to verify that a kallable is both importable and is callable
 		Also, used to verify that a queue is valid, if set
 		"""
-		# Make sure self.kallable is importable and is a callable object
-		func = import_callable(self.kallable)
+		self.validate_kallable(self.kallable)
+		self.validate_queue(self.queue)
+		self.validate_arguments()
 
-		if not callable(func):
-			raise ValidationError(f"Callable ({self.kallable}) is not callable")
+	def validate_arguments(self):
+		"""
+		Used to verify that args is a list and kwargs is a dict. Empty values are replaced with an empty list/dict.
+		"""
+		if self.args in ['', None]:
+			self.args = []
+		elif not isinstance(self.args, (list, tuple)):
+			raise ValidationError(f"Invalid args: must be a list but got: {type(self.args)}")
+
+		if self.kwargs in ['', None]:
+			self.kwargs = {}
+		elif not isinstance(self.kwargs, dict):
+			raise ValidationError(f"Invalid kwargs: must be a dict but got: {type(self.kwargs)}")
+
+	def truncate_message(self):
+		"""
+		Truncate the message if it's too long
+		"""
+		_message = str(self.message)
+		if len(_message) > MESSAGE_FIELD_MAX_LEN:
+			self.message = _message[:MESSAGE_FIELD_MAX_LEN]
+
+	def _insert_unless_pending(self, *args, **kwargs):
+		"""
+		Insert this task unless a pending task has the same dedupe_key. The unique constraint settles concurrent
+		inserts; backends without partial indexes only get a lookup first.
+
+		:returns: True if the task was inserted, otherwise this instance is reloaded as the pending task
+		"""
+		using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+		enforced = connections[using].features.supports_partial_indexes
+		pending_tasks = type(self).objects.using(using).filter(dedupe_key=self.dedupe_key, status=self.Status.PENDING)
 
-		# If instance has `queue` set, require that it exists
-		if self.queue and self.queue not in carrot_settings['queues']:
-			raise ValidationError(f"({self.queue}) is not a valid carrot queue")
+		# A second attempt is only needed when the pending task started running in between
+		for _ in range(2):
+			pending = None if enforced else pending_tasks.values_list('id', flat=True).first()
+			if pending is None:
+				try:
+					with transaction.atomic(using=using):
+						super().save(*args, **kwargs)
+					return True
+				except IntegrityError:
+					if not enforced:
+						raise
+					pending = pending_tasks.values_list('id', flat=True).first()
+
+			if pending is not None:
+				LOGGER.debug(f"Task with dedupe_key ({self.dedupe_key}) is already pending ({pending})")
+				self.id = pending
+				self._state.adding = False
+				self._state.db = using
+				self.refresh_from_db()
+				self.deduplicated = True
+				return False
+
+		raise IntegrityError(f"Unable to insert task with dedupe_key ({self.dedupe_key})")
 
 	def save(self, *args, **kwargs):
 		"""
-		Enforces validation and publishes to queue during creation if queue is set
+		Enforces validation and publishes to queue during creation if queue is set.
+		In outbox mode the publish is deferred until the surrounding transaction commits.
+		Pass publish=False to only write the row, e.g. when the caller publishes it with apublish().
 		"""
 		if kwargs.pop('validate', True):
 			self.validate()
+		publish = kwargs.pop('publish', True)
 
-		# Truncate the message if it's too long
-		_message = str(self.message)
-		if len(_message) > MESSAGE_FIELD_MAX_LEN:
-			self.message = _message[:MESSAGE_FIELD_MAX_LEN]
+		self.truncate_message()
 
 		is_new = self._state.adding
+		payload_ref = payloads.externalize(self) if is_new else None
+
+		try:
+			if is_new and self.dedupe_key:
+				inserted = self._insert_unless_pending(*args, **kwargs)
+			else:
+				super().save(*args, **kwargs)
+				inserted = True
+		except Exception:
+			if payload_ref:
+				# No row refers to the payload just written
+				payloads.delete([payload_ref])
+			raise
+
+		if not inserted:
+			if payload_ref:
+				# This instance now holds the pending task, the payload just written belongs to no task
+				payloads.delete([payload_ref])
+			return
+		if is_new and publish and self.can_publish:
+			if carrot_settings['outbox']:
+				outbox.enqueue([self], self._state.db)
+			else:
+				self.publish()
+
+
+class TaskGroup(models.Model):
+	"""
+	Tracks the completion of a group of tasks (see carrot.workflows) with a counter, decremented with a single
+	UPDATE by each task as it finishes, completed or failed. The task which brings it to zero creates and
+	publishes the group's callback, so completion never scans the tasks of the group.
+	"""
+	size = models.PositiveIntegerField()
+	remaining = models.IntegerField()
+	failed = models.PositiveIntegerField(default=0)
+	# A Task.to_spec(), created with a `group_id` kwarg once every task finished
+	callback = LazyJSONField(null=True, blank=True, default=None)
+	created_on = models.DateTimeField(auto_now_add=True)
+	completed_on = models.DateTimeField(null=True, blank=True)
+
+	objects = models.Manager.from_queryset(LazyJSONQuerySet)()
+
+	@property
+	def is_complete(self):
+		return self.remaining <= 0
+
+	def __str__(self):
+		return f"TaskGroup ({self.id}): {self.size - self.remaining}/{self.size} finished"
+
+	@classmethod
+	def finish_one(cls, group_id, failed=False, using=None):
+		"""
+		Count one finished task of a group, and publish the group's callback when it was the last one
+
+		:returns: the number of tasks of the group still to finish
+		"""
+		using = using or router.db_for_write(cls)
+		with transaction.atomic(using=using):
+			remaining = cls._decrement(group_id, int(failed), using)
+			if remaining == 0:
+				cls.objects.using(using).get(id=group_id).complete()
+		return remaining
+
+	@classmethod
+	def _decrement(cls, group_id, failed, using):
+		connection = connections[using]
+		if connection.vendor == 'postgresql' or (connection.vendor == 'sqlite' and connection.Database.sqlite_version_info >= (3, 35)):
+			quote = connection.ops.quote_name
+			with connection.cursor() as cursor:
+				cursor.execute(
+					f"UPDATE {quote(cls._meta.db_table)} SET {quote('remaining')} = {quote('remaining')} - 1, "
+					f"{quote('failed')} = {quote('failed')} + %s WHERE {quote('id')} = %s RETURNING {quote('remaining')}",
+					[failed, group_id],
+				)
+				row = cursor.fetchone()
+			return row[0] if row else None
+
+		# Without UPDATE ... RETURNING, the row lock taken by the update makes the read within the same transaction exact
+		queryset = cls.objects.using(using).filter(id=group_id)
+		queryset.update(remaining=models.F('remaining') - 1, failed=models.F('failed') + failed)
+		return queryset.values_list('remaining', flat=True).first()
+
+	def complete(self):
+		"""
+		Mark the group complete and create its callback, published once the surrounding transaction commits
+		"""
+		self.completed_on = timezone.now()
+		self.save(update_fields=['completed_on'])
+		if self.callback is not None:
+			callback = Task.from_spec(self.callback, group_id=self.id)
+			callback.save(using=self._state.db, publish=False)
+			if callback.can_publish:
+				outbox.enqueue([callback], self._state.db)
+
+
+class Throttle(models.Model):
+	"""
+	The token bucket of a rate limited kallable (CARROT['rate_limits']), shared by every worker process.
+	Tokens are refilled lazily from `updated_on` whenever the row is locked to admit a task.
+	"""
+	kallable = models.CharField(max_length=512, unique=True)
+	tokens = models.FloatField(default=0)
+	updated_on = models.DateTimeField()
 
-		super().save(*args, **kwargs)
-		if is_new and self.can_publish:
-			self.publish()
+	def __str__(self):
+		return self.kallable
@@ -0,0 +1,35 @@
+from django.db import NotSupportedError
+from django.db.migrations import AddIndex
+
+
+class AddIndexConcurrently(AddIndex):
+	"""
+	An AddIndex which builds the index with CREATE INDEX CONCURRENTLY on PostgreSQL, so tasks can still be inserted
+	while the index of a large table is built. Other backends build it like AddIndex. The migration must set
+	`atomic = False`, PostgreSQL can't build an index concurrently within a transaction.
+	"""
+	def describe(self):
+		return f"Concurrently create index {self.index.name} on field(s) {', '.join(self.index.fields)} of model {self.model_name}"
+
+	def database_forwards(self, app_label, schema_editor, from_state, to_state):
+		if schema_editor.connection.vendor != 'postgresql':
+			return super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+		self._ensure_not_in_transaction(schema_editor)
+		model = to_state.apps.get_model(app_label, self.model_name)
+		if self.allow_migrate_model(schema_editor.connection.alias, model):
+			schema_editor.add_index(model, self.index, concurrently=True)
+
+	def database_backwards(self, app_label, schema_editor, from_state, to_state):
+		if schema_editor.connection.vendor != 'postgresql':
+			return super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+		self._ensure_not_in_transaction(schema_editor)
+		model = from_state.apps.get_model(app_label, self.model_name)
+		if self.allow_migrate_model(schema_editor.connection.alias, model):
+			schema_editor.remove_index(model, self.index, concurrently=True)
+
+	@staticmethod
+	def _ensure_not_in_transaction(schema_editor):
+		if schema_editor.connection.in_atomic_block:
+			raise NotSupportedError("Indexes can't be created concurrently within a transaction, set atomic = False on the migration")
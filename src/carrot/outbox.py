@@ -0,0 +1,116 @@
+import logging
+import threading
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+LOGGER = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class OutboxBatch:
+	"""
+	The tasks saved during one transaction, published together once it commits
+	"""
+	def __init__(self, using):
+		self.using = using
+		self.tasks = []
+
+	def is_registered(self, connection):
+		"""
+		True while this batch's on_commit hook is still waiting on the current transaction.
+		The hook is dropped if the transaction rolls back, so the batch must not be reused after that.
+		"""
+		return connection.in_atomic_block and any(entry[1] == self.flush for entry in connection.run_on_commit)
+
+	def flush(self):
+		batches = _batches()
+		if batches.get(self.using) is self:
+			del batches[self.using]
+		publish(self.tasks, self.using)
+
+
+def _batches():
+	if not hasattr(_local, 'batches'):
+		_local.batches = {}
+	return _local.batches
+
+
+def enqueue(tasks, using):
+	"""
+	Publish tasks once the current transaction commits, or right away outside of a transaction.
+	Every task saved within the same transaction is published in a single batch.
+	"""
+	connection = transaction.get_connection(using)
+	if not connection.in_atomic_block:
+		publish(tasks, using)
+		return
+
+	batches = _batches()
+	batch = batches.get(using)
+	if batch is None or not batch.is_registered(connection):
+		batch = batches[using] = OutboxBatch(using)
+		transaction.on_commit(batch.flush, using=using)
+	batch.tasks.extend(tasks)
+
+
+def publish(tasks, using):
+	"""
+	Publish committed tasks which haven't been published yet, then mark them as published.
+	Tasks are re-read by id first so rows rolled back in a savepoint, or already published by the relay, are skipped.
+
+	:returns: list of (task, exception) tuples for tasks which could not be published
+	"""
+	from carrot.models import Task
+
+	if not tasks:
+		return []
+
+	unpublished = set(
+		Task.objects.using(using).filter(id__in=[task.id for task in tasks], published_on__isnull=True).values_list('id', flat=True)
+	)
+	# A later instance wins when an id was reused after a savepoint rollback
+	tasks = [task for task in {task.id: task for task in tasks}.values() if task.id in unpublished]
+
+	failures = Task.publish_many(tasks)
+	for task, error in failures:
+		LOGGER.error(f"Failed to publish task ({task.id}), it will be published by the outbox relay: {error}")
+
+	failed = {task.id for task, _ in failures}
+	published = [task.id for task in tasks if task.id not in failed]
+	Task.objects.using(using).filter(id__in=published).update(published_on=timezone.now())
+	return failures
+
+
+def relay(using=None, batch_size=1000, grace=60):
+	"""
+	Publish pending tasks that were committed but never published, e.g. because the process died
+	between the commit and its on_commit hook.
+
+	:param grace: seconds a task may be unpublished before the relay considers it lost
+	:returns: the number of tasks published
+	"""
+	from carrot.models import Task
+
+	cutoff = timezone.now() - timedelta(seconds=grace)
+	queryset = Task.objects.using(using).filter(
+		status=Task.Status.PENDING,
+		published_on__isnull=True,
+		created_on__lt=cutoff,
+	).order_by('id')
+
+	total = 0
+	last_id = 0
+	while True:
+		tasks = list(queryset.filter(id__gt=last_id)[:batch_size])
+		if not tasks:
+			break
+
+		last_id = tasks[-1].id
+		tasks = [task for task in tasks if task.can_publish]
+		failures = publish(tasks, using or Task.objects.db)
+		total += len(tasks) - len(failures)
+
+	return total
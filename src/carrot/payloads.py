@@ -0,0 +1,124 @@
+import json
+import logging
+import os
+import re
+import uuid
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from carrot.settings import carrot_settings
+from carrot.utils import import_callable
+
+LOGGER = logging.getLogger(__name__)
+
+_REF = re.compile(r'[0-9a-f]{32}')
+
+
+class FileSystemPayloadStore:
+	"""
+	Keeps task payloads as files under `directory`, which every worker must be able to read (a local
+	directory for a single host, a shared mount otherwise). Files are written to a temporary name first,
+	so a reader never sees half a payload.
+
+	A payload store only needs put(bytes) -> ref, open(ref) -> binary file object and delete(ref).
+
+	Example:
+	CARROT = {
+		'payload_store': 'carrot.payloads.FileSystemPayloadStore',
+		'payload_store_options': {'directory': '/mnt/shared/carrot-payloads'},
+	}
+	"""
+	def __init__(self, directory):
+		self.directory = directory
+
+	def put(self, data):
+		"""
+		:param bytes data: the payload
+		:returns: the reference to store on the task
+		"""
+		ref = uuid.uuid4().hex
+		path = self._path(ref)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		tmp_path = f"{path}.tmp"
+		with open(tmp_path, 'wb') as f:
+			f.write(data)
+		os.replace(tmp_path, path)
+		return ref
+
+	def open(self, ref):
+		return open(self._path(ref), 'rb')
+
+	def delete(self, ref):
+		try:
+			os.remove(self._path(ref))
+		except FileNotFoundError:
+			pass
+
+	def _path(self, ref):
+		if not _REF.fullmatch(ref):
+			raise ValueError(f"Invalid payload reference ({ref})")
+		# Spread over subdirectories, so no single directory holds every payload
+		return os.path.join(self.directory, ref[:2], ref)
+
+
+_store = None
+
+
+def get_store():
+	"""
+	:returns: the payload store of CARROT['payload_store'], or None if large arguments stay in the db
+	"""
+	global _store
+	if _store is None and carrot_settings['payload_store'] is not None:
+		_store = import_callable(carrot_settings['payload_store'])(**carrot_settings['payload_store_options'])
+	return _store
+
+
+def externalize(task):
+	"""
+	Move the args and kwargs of an unsaved task to the payload store if they are larger than `payload_threshold`
+	bytes of JSON, leaving only a reference on the task
+
+	:returns: the payload reference, or None if the arguments stay on the task
+	"""
+	store = get_store()
+	if store is None or task.payload_ref:
+		return None
+
+	data = json.dumps({'args': task.args or [], 'kwargs': task.kwargs or {}}, cls=DjangoJSONEncoder).encode('utf-8')
+	if len(data) <= carrot_settings['payload_threshold']:
+		return None
+
+	task.payload_ref = store.put(data)
+	task.args = []
+	task.kwargs = {}
+	LOGGER.debug(f"Arguments of ({len(data)}) bytes moved to payload ({task.payload_ref})")
+	return task.payload_ref
+
+
+def load(ref):
+	"""
+	Read a payload from the store. Python's JSON decoder needs the whole document, so the file is read in one go
+	rather than streamed or memory-mapped; the arguments only ever exist in the worker executing the task.
+
+	:returns: tuple of (args, kwargs)
+	"""
+	store = get_store()
+	assert store is not None, f"Payload ({ref}) can't be read without CARROT['payload_store']"
+	with store.open(ref) as f:
+		payload = json.load(f)
+	return payload['args'], payload['kwargs']
+
+
+def delete(refs):
+	"""
+	Delete the payloads of tasks which were pruned
+	"""
+	store = get_store()
+	if store is None:
+		return
+	for ref in refs:
+		try:
+			store.delete(ref)
+		except Exception:
+			LOGGER.exception(f"Unable to delete payload ({ref})")
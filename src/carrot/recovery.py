@@ -0,0 +1,74 @@
+import logging
+
+from django.db import IntegrityError, router, transaction
+
+from carrot.utils import pid_exists
+
+LOGGER = logging.getLogger(__name__)
+
+RECOVERED_MESSAGE = "Recovered after its worker process died"
+
+
+def recover(batch_size=1000, using=None):
+	"""
+	Reset the tasks left running by worker processes of this host which no longer exist back to pending, and
+	re-publish them in batches of `batch_size`. Tasks running on other hosts are left alone, their pids can
+	only be checked there.
+
+	A task whose dedupe_key is pending again meanwhile is failed instead, the pending task replaces it. Of dead
+	tasks sharing a dedupe_key, the first is reset and the others are failed.
+
+	:returns: the number of tasks re-published
+	"""
+	from carrot.models import HOSTNAME, Task
+
+	using = using or router.db_for_write(Task)
+	queryset = Task.objects.using(using).filter(status=Task.Status.RUNNING, hostname=HOSTNAME, pid__isnull=False).order_by('id')
+
+	total = 0
+	last_id = 0
+	while True:
+		rows = list(queryset.filter(id__gt=last_id).values_list('id', 'pid')[:batch_size])
+		if not rows:
+			break
+		last_id = rows[-1][0]
+
+		dead_pids = {pid for pid in {pid for _, pid in rows} if not pid_exists(pid)}
+		ids = [task_id for task_id, pid in rows if pid in dead_pids]
+		if not ids:
+			continue
+
+		# Only rows which are still running under a dead pid, a task may have finished or moved on meanwhile
+		dead = Task.objects.using(using).filter(id__in=ids, status=Task.Status.RUNNING, pid__in=dead_pids)
+		dead.filter(dedupe_key__isnull=True).update(status=Task.Status.PENDING, pid=None, started_on=None, message=RECOVERED_MESSAGE)
+		# Resetting these may break the unique pending dedupe_key, so they're reset one at a time
+		for task_id, dedupe_key in list(dead.filter(dedupe_key__isnull=False).values_list('id', 'dedupe_key')):
+			_reset_deduplicated(dead.filter(id=task_id), dedupe_key, using)
+
+		tasks = [task for task in Task.objects.using(using).filter(id__in=ids, status=Task.Status.PENDING) if task.can_publish]
+		failures = Task.publish_many(tasks)
+		for task, error in failures:
+			LOGGER.error(f"Failed to publish recovered task ({task.id}), it's pending but unpublished: {error}")
+		total += len(tasks) - len(failures)
+		LOGGER.info(f"Recovered ({len(tasks)}) tasks of dead workers ({sorted(dead_pids)}), ({total}) so far")
+
+	return total
+
+
+def _reset_deduplicated(queryset, dedupe_key, using):
+	"""
+	Reset a dead task with a dedupe_key back to pending, or fail it if a task with that key is pending already
+	"""
+	from carrot.models import Task
+
+	pending = Task.objects.using(using).filter(dedupe_key=dedupe_key, status=Task.Status.PENDING)
+	try:
+		with transaction.atomic(using=using):
+			# Checked first for backends without partial indexes, elsewhere the unique constraint settles races
+			if not pending.exists():
+				queryset.update(status=Task.Status.PENDING, pid=None, started_on=None, message=RECOVERED_MESSAGE)
+				return
+	except IntegrityError:
+		pass
+	LOGGER.info(f"Task with dedupe_key ({dedupe_key}) is pending already, failing the recovered task")
+	queryset.update(status=Task.Status.FAILED, pid=None, message=RECOVERED_MESSAGE)
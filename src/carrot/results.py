@@ -0,0 +1,233 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+import pika
+from django.core.serializers.json import DjangoJSONEncoder
+
+from carrot.amqp import RabbitConnection
+from carrot.settings import carrot_settings
+
+LOGGER = logging.getLogger(__name__)
+
+
+class TaskFailed(Exception):
+	"""
+	Raised when waiting for the result of a task which failed
+	"""
+
+
+class ResultUnavailable(Exception):
+	"""
+	Raised when a task finished but its result wasn't kept: results are disabled for its queue,
+	the result was too large or not JSON serializable, or it expired
+	"""
+
+
+def encode_result(value, max_size):
+	"""
+	:returns: tuple of (value, None) if the value can be kept, or (None, reason) if it can't
+	"""
+	try:
+		encoded = json.dumps(value, cls=DjangoJSONEncoder)
+	except (TypeError, ValueError) as e:
+		return None, f"Result is not JSON serializable: {e}"
+
+	size = len(encoded.encode('utf-8'))
+	if max_size and size > max_size:
+		return None, f"Result of ({size}) bytes exceeds result_max_size ({max_size})"
+	return json.loads(encoded), None
+
+
+class ResultListener(RabbitConnection):
+	"""
+	Receives the results of tasks created by this process. Each process declares one exclusive reply queue,
+	named in the `reply_to` of its tasks, which workers publish a message to when the task finishes.
+	Waiting for a result therefore blocks on the connection rather than polling the db.
+	"""
+	POLL_INTERVAL = 1
+	# Replies nobody waited for are dropped, oldest first, past this many
+	MAX_UNCLAIMED = 10000
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self._reset()
+		if hasattr(os, 'register_at_fork'):
+			os.register_at_fork(after_in_child=self._reset)
+
+	def _reset(self):
+		# A forked child gets its own queue, the parent's connection and results stay with the parent
+		self._connection = None
+		self._channel = None
+		self._lock = threading.Lock()
+		self._results = {}
+		self.queue = f"{carrot_settings['queue_prefix']}.reply.{socket.gethostname()}.{os.getpid()}.{uuid.uuid4().hex[:8]}"
+
+	@property
+	def reply_to(self):
+		"""
+		The name of the reply queue, declared before it's handed out so no reply can be lost
+		"""
+		with self._lock:
+			self._ensure_consuming()
+		return self.queue
+
+	def wait(self, task_id, timeout=None):
+		"""
+		:returns: the reply payload for the task
+		:raises TimeoutError: if no reply arrived within `timeout` seconds
+		"""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while True:
+			if task_id in self._results:
+				return self._results.pop(task_id)
+
+			remaining = None if deadline is None else deadline - time.monotonic()
+			if remaining is not None and remaining <= 0:
+				raise TimeoutError(f"No result for task ({task_id}) within {timeout} seconds")
+
+			# One thread reads from the connection at a time, the others find their reply in _results
+			if not self._lock.acquire(timeout=-1 if remaining is None else remaining):
+				continue
+			try:
+				if task_id not in self._results:
+					self._ensure_consuming()
+					time_limit = self.POLL_INTERVAL if remaining is None else min(remaining, self.POLL_INTERVAL)
+					self._connection.process_data_events(time_limit=time_limit)
+			except pika.exceptions.AMQPConnectionError as e:
+				LOGGER.warning(f"Result listener lost its connection, reconnecting: {e}")
+				self.close()
+			finally:
+				self._lock.release()
+
+	def _ensure_consuming(self):
+		if self.is_open:
+			return
+		self.connect()
+		self._channel.exchange_declare(exchange=carrot_settings['exchange'], exchange_type=self.DEFAULT_EXCHANGE_TYPE, durable=carrot_settings['durable_exchange'])
+		self._channel.queue_declare(self.queue, exclusive=True, auto_delete=True)
+		self._channel.queue_bind(exchange=carrot_settings['exchange'], queue=self.queue, routing_key=self.queue)
+		self._channel.basic_consume(self.queue, self._on_reply, auto_ack=True)
+
+	def _on_reply(self, channel, method_frame, header_frame, body):
+		try:
+			payload = json.loads(body)
+			self._results[payload['id']] = payload
+			if len(self._results) > self.MAX_UNCLAIMED:
+				self._results.pop(next(iter(self._results)))
+		except (ValueError, KeyError):
+			LOGGER.warning(f"Result listener discarded an invalid reply: {body!r}")
+
+
+listener = ResultListener(
+	host=carrot_settings['host'],
+	port=carrot_settings['port'],
+	user=carrot_settings['user'],
+	password=carrot_settings['password'],
+	exchange=carrot_settings['exchange'],
+)
+
+
+class AsyncResult:
+	"""
+	The result of a task. Tasks created with reply=True by this process are waited for through the
+	result listener; the result of any other task is read from the db.
+
+	Example:
+	task = Task.objects.create(kallable='myapp.tasks.add', args=[1, 2], reply=True)
+	AsyncResult(task).get(timeout=10)
+	"""
+	DB_POLL_INTERVAL = 1
+
+	def __init__(self, task):
+		"""
+		:param task: a Task, or the id of one
+		"""
+		from carrot.models import Task
+
+		self.task = task if isinstance(task, Task) else Task.objects.get(id=task)
+
+	@property
+	def status(self):
+		return self.task.status
+
+	def ready(self):
+		self.task.refresh_from_db(fields=['status'])
+		return self.task.status in (self.task.Status.COMPLETED, self.task.Status.FAILED)
+
+	def get(self, timeout=None):
+		"""
+		Wait for the task to finish
+
+		:returns: the return value of the kallable
+		:raises TimeoutError: if the task didn't finish within `timeout` seconds
+		:raises TaskFailed: if the task failed
+		:raises ResultUnavailable: if the task completed but its result wasn't kept
+		"""
+		if self.task.reply_to and self.task.reply_to == listener.queue:
+			# The reply is kept on the task, since it's only delivered once
+			if getattr(self.task, '_reply_payload', None) is None:
+				self.task._reply_payload = self._wait_for_reply(timeout)
+			if self.task._reply_payload:
+				return self._from_reply(self.task._reply_payload)
+			return self._from_db()
+
+		if self.ready():
+			return self._from_db()
+
+		# Not created by this process, so there's no reply to wait for
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while not self.ready():
+			remaining = None if deadline is None else deadline - time.monotonic()
+			if remaining is not None and remaining <= 0:
+				raise TimeoutError(f"Task ({self.task.id}) did not finish within {timeout} seconds")
+			time.sleep(self.DB_POLL_INTERVAL if remaining is None else min(remaining, self.DB_POLL_INTERVAL))
+		return self._from_db()
+
+	def _wait_for_reply(self, timeout):
+		"""
+		Replies are best effort: a worker which can't publish one only logs it, and the reply queue is deleted when the
+		listener reconnects. The db is checked every DB_POLL_INTERVAL seconds, so a lost reply never blocks forever.
+
+		:returns: the reply payload, or {} if the task finished but its reply didn't arrive
+		"""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		finished = False
+		while True:
+			remaining = None if deadline is None else deadline - time.monotonic()
+			if remaining is not None and remaining <= 0:
+				if finished:
+					return {}
+				raise TimeoutError(f"Task ({self.task.id}) did not finish within {timeout} seconds")
+
+			try:
+				return listener.wait(self.task.id, self.DB_POLL_INTERVAL if remaining is None else min(remaining, self.DB_POLL_INTERVAL))
+			except TimeoutError:
+				pass
+
+			if finished:
+				# The status is written before the reply is sent, which had another interval to arrive
+				LOGGER.warning(f"No reply for finished task ({self.task.id}), reading its result from the db")
+				return {}
+			finished = self.ready()
+
+	def _from_reply(self, payload):
+		if payload['status'] != self.task.Status.COMPLETED:
+			raise TaskFailed(payload['message'])
+		if 'result' not in payload:
+			raise ResultUnavailable(payload.get('reason') or f"The result of task ({self.task.id}) was not kept")
+		return payload['result']
+
+	def _from_db(self):
+		from django.utils import timezone
+
+		self.task.refresh_from_db(fields=['status', 'message', 'result', 'result_expires'])
+		if self.task.status != self.task.Status.COMPLETED:
+			raise TaskFailed(self.task.message)
+		if self.task.result_expires is None or self.task.result_expires <= timezone.now():
+			raise ResultUnavailable(f"The result of task ({self.task.id}) was not kept or has expired")
+		return self.task.result
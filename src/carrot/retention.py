@@ -0,0 +1,77 @@
+import json
+import logging
+import time
+from datetime import timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from carrot import payloads
+
+LOGGER = logging.getLogger(__name__)
+
+
+def prune(days, batch_size=1000, archive=None, sleep=0.1, using=None):
+	"""
+	Delete completed and failed tasks created more than `days` ago. Rows are deleted in batches of
+	`batch_size`, each in its own short transaction, so the table is never locked for long.
+
+	:param archive: optional file object, every deleted row is written to it as a line of JSON first
+	:param sleep: seconds to pause between batches, to leave room for the hot path
+	:returns: the number of tasks deleted
+	"""
+	from carrot.models import Task, TaskGroup
+
+	cutoff = timezone.now() - timedelta(days=days)
+	queryset = Task.objects.using(using).filter(
+		status__in=[Task.Status.COMPLETED, Task.Status.FAILED],
+		created_on__lt=cutoff,
+	)
+
+	total = 0
+	while True:
+		ids = list(queryset.order_by('id').values_list('id', flat=True)[:batch_size])
+		if not ids:
+			break
+
+		if archive is not None:
+			for row in Task.objects.using(using).filter(id__in=ids).order_by('id').values():
+				archive.write(json.dumps(row, cls=DjangoJSONEncoder) + '\n')
+			archive.flush()
+
+		refs = []
+		if payloads.get_store() is not None:
+			refs = list(Task.objects.using(using).filter(id__in=ids).exclude(payload_ref='').values_list('payload_ref', flat=True))
+
+		deleted, _ = Task.objects.using(using).filter(id__in=ids).delete()
+		payloads.delete(refs)
+		total += deleted
+		LOGGER.info(f"Pruned ({deleted}) tasks, ({total}) so far")
+
+		if len(ids) < batch_size:
+			break
+		time.sleep(sleep)
+
+	# Completed groups are only a counter row each, their tasks were pruned above
+	TaskGroup.objects.using(using).filter(completed_on__lt=cutoff).delete()
+	return total
+
+
+def expire_results(batch_size=1000, using=None):
+	"""
+	Clear the results whose TTL has passed, in batches of `batch_size`
+
+	:returns: the number of results cleared
+	"""
+	from carrot.models import Task
+
+	queryset = Task.objects.using(using).filter(result_expires__lt=timezone.now())
+	total = 0
+	while True:
+		ids = list(queryset.order_by('id').values_list('id', flat=True)[:batch_size])
+		if not ids:
+			break
+		total += Task.objects.using(using).filter(id__in=ids).update(result=None, result_expires=None)
+		if len(ids) < batch_size:
+			break
+	return total
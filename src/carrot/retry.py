@@ -0,0 +1,61 @@
+import random
+
+from carrot.settings import carrot_settings
+from carrot.utils import import_callable
+
+
+class RetryPolicy:
+	"""
+	Decides whether a failed task is retried, and how long it waits first.
+	The n-th retry waits `backoff * backoff_factor ** n` seconds, capped at `max_backoff`. With `jitter`
+	the wait is randomized between half and all of that, so tasks which failed together don't retry together.
+
+	Example:
+	policy = RetryPolicy(max_attempts=5, backoff=2, retry_on=['requests.exceptions.Timeout'])
+	"""
+	def __init__(self, max_attempts=3, backoff=1, backoff_factor=2, max_backoff=3600, jitter=True, retry_on=('builtins.Exception',)):
+		"""
+		:param max_attempts: the maximum number of retries, after the first attempt
+		:param retry_on: exception classes, or dot-notated paths to them, which are retried
+		"""
+		assert max_attempts >= 0, "max_attempts can't be negative"
+		assert backoff >= 0 and backoff_factor >= 1, "backoff can't be negative and backoff_factor must be at least 1"
+		self.max_attempts = int(max_attempts)
+		self.backoff = backoff
+		self.backoff_factor = backoff_factor
+		self.max_backoff = max_backoff
+		self.jitter = jitter
+		self.retry_on = tuple(import_callable(exc) if isinstance(exc, str) else exc for exc in retry_on)
+
+	def should_retry(self, exc, retries):
+		"""
+		:param exc: the exception the task raised
+		:param retries: the number of times the task was already retried
+		"""
+		return retries < self.max_attempts and isinstance(exc, self.retry_on)
+
+	def delay(self, retries):
+		"""
+		:returns: seconds to wait before the retry following `retries` earlier retries
+		"""
+		delay = min(self.max_backoff, self.backoff * self.backoff_factor ** retries)
+		if self.jitter:
+			delay = random.uniform(delay / 2, delay)
+		return delay
+
+
+# Policies are built on first use, so their exception classes are imported lazily
+_policies = {}
+
+
+def get_policy(kallable, queue):
+	"""
+	:returns: the RetryPolicy of a kallable, falling back to the policy of its queue, or None if it's never retried
+	"""
+	key = (kallable, queue)
+	if key not in _policies:
+		options = carrot_settings['retry_policies'].get(kallable)
+		if options is None and queue in carrot_settings['queues']:
+			options = carrot_settings['queues'][queue]['retry']
+		_policies[key] = RetryPolicy(**options) if options is not None else None
+	return _policies[key]
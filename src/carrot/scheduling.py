@@ -0,0 +1,133 @@
+import heapq
+import logging
+import math
+import signal
+import threading
+import time
+
+from django.db import close_old_connections, connections
+from django.db.utils import OperationalError
+from django.utils import timezone
+
+LOGGER = logging.getLogger(__name__)
+
+# A task due within this many seconds is executed rather than delayed again
+DUE_THRESHOLD = 0.5
+
+# Delay buckets in seconds: 1s, 2s, 4s ... ~18h. Every queue has one delay queue per bucket.
+DEFAULT_DELAY_BUCKETS = [2 ** i for i in range(17)]
+
+
+def delay_queue_name(queue_name, delay):
+	return f"{queue_name}.delay.{delay}"
+
+
+def choose_delay(eta, buckets, now=None):
+	"""
+	Pick the delay queue for a task due at `eta`. The largest bucket that doesn't overshoot is used, so
+	a task hops through at most log2(delay) buckets and is delivered within about a second of its eta.
+
+	:returns: the bucket (seconds) to wait in, or None if the task is due
+	"""
+	if eta is None:
+		return None
+
+	remaining = (eta - (now or timezone.now())).total_seconds()
+	if remaining < DUE_THRESHOLD:
+		return None
+
+	fitting = [bucket for bucket in buckets if bucket <= remaining + DUE_THRESHOLD]
+	return max(fitting) if fitting else min(buckets)
+
+
+class PeriodicTask:
+	"""
+	A kallable to enqueue every `interval` seconds. Runs are aligned to multiples of the interval
+	(e.g. every 300 seconds runs at :00, :05, :10 ...), so restarting the scheduler doesn't shift them.
+	"""
+	def __init__(self, name, kallable, interval, args=None, kwargs=None, queue=None):
+		assert interval > 0, "The interval of a periodic task must be positive"
+		self.name = name
+		self.kallable = kallable
+		self.interval = interval
+		self.args = args or []
+		self.kwargs = kwargs or {}
+		self.queue = queue
+
+	def next_run(self, now):
+		return (math.floor(now / self.interval) + 1) * self.interval
+
+	def enqueue(self):
+		from carrot.models import Task
+
+		options = {'queue': self.queue} if self.queue else {}
+		return Task.objects.create(
+			kallable=self.kallable,
+			args=self.args,
+			kwargs=self.kwargs,
+			created_by=f"scheduler:{self.name}",
+			**options
+		)
+
+
+# Periodic tasks registered in code, in addition to CARROT['schedule']
+registry = {}
+
+
+def register(name, kallable, interval, **options):
+	"""
+	Register a periodic task, e.g. register('cleanup', 'myapp.tasks.cleanup', interval=300)
+	"""
+	registry[name] = PeriodicTask(name, kallable, interval, **options)
+
+
+class Scheduler:
+	"""
+	Enqueues periodic tasks when they are due. Only one scheduler should run per deployment.
+	The next run of every periodic task is kept in a heap, so nothing polls the db.
+	"""
+	def __init__(self, periodic_tasks):
+		self.periodic_tasks = {periodic_task.name: periodic_task for periodic_task in periodic_tasks}
+		self._stopped = threading.Event()
+
+	def run(self):
+		signal.signal(signal.SIGTERM, self._sigterm)
+		signal.signal(signal.SIGINT, self._sigterm)
+
+		now = time.time()
+		heap = [(periodic_task.next_run(now), name) for name, periodic_task in self.periodic_tasks.items()]
+		heapq.heapify(heap)
+		LOGGER.info(f"Scheduler started with ({len(heap)}) periodic tasks")
+
+		while heap and not self._stopped.is_set():
+			due, name = heap[0]
+			wait = due - time.time()
+			if wait > 0:
+				self._stopped.wait(wait)
+				continue
+
+			heapq.heappop(heap)
+			periodic_task = self.periodic_tasks[name]
+			try:
+				task = self._enqueue(periodic_task)
+				LOGGER.info(f"Scheduled periodic task ({name}) as task ({task.id})")
+			except Exception:
+				LOGGER.exception(f"Unable to enqueue periodic task ({name})")
+			heapq.heappush(heap, (periodic_task.next_run(time.time()), name))
+
+	@staticmethod
+	def _enqueue(periodic_task):
+		# This process lives for long, a connection dropped by the db (or past CONN_MAX_AGE) is replaced
+		close_old_connections()
+		try:
+			return periodic_task.enqueue()
+		except OperationalError:
+			connections.close_all()
+			return periodic_task.enqueue()
+
+	def stop(self):
+		self._stopped.set()
+
+	def _sigterm(self, signum, frame):
+		LOGGER.info(f"Scheduler received shutdown signal ({signum})")
+		self.stop()
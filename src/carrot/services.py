@@ -1,12 +1,26 @@
 import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
+from asgiref.sync import sync_to_async
 from django.db import connections
 from django.db.utils import OperationalError
 from django.db.models import Q
+from django.utils import timezone
 
-from carrot.models import Task
-from carrot.amqp import RabbitConsumer
+from carrot import metrics
+from carrot.models import HOSTNAME, Task, kallables
+from carrot.amqp import MultiQueueConsumer, RabbitConsumer
+from carrot.executors import EXECUTION_SERIAL, EXECUTION_ASYNCIO, create_executor
+from carrot.messages import decode_task
 from carrot.settings import carrot_settings
+from carrot.status import create_reporter
+from carrot.throttling import get_limit
+from carrot.utils import get_rss
 
 
 LOGGER = logging.getLogger(__name__)
@@ -14,53 +28,403 @@ LOGGER = logging.getLogger(__name__)
 
 class Worker(RabbitConsumer):
 	"""
-	Worker is a serial queued task consumer
+	Worker is a queued task consumer. By default tasks are executed serially, one at a time.
+	A queue's `execution_mode` can instead run up to `execution_pool_size` tasks at once in a thread
+	pool ('threads') or on an asyncio event loop ('asyncio'), where `async def` kallables are awaited.
+
+	A serial worker with a `pipeline_depth` reads that many messages ahead, and fetches their rows with one
+	query in a background thread while the current task executes. Tasks still run one at a time, in order.
 	"""
 	PREFETCH_COUNT = 1
 
 	def __init__(self, queue, *args, **kwargs):
 		assert queue in carrot_settings['queues'], f"{queue} is not a valid queue"
+		queue_settings = carrot_settings['queues'][queue]
+
+		kwargs['queue'] = queue_settings['queue_name']
+		self._configure(queue_settings, kwargs)
+		super().__init__(*args, **kwargs)
+		if self.pipeline_depth:
+			self._pipeline = deque()
 
-		kwargs['queue'] = carrot_settings['queues'][queue]['queue_name']
+	def _configure(self, queue_settings, kwargs):
+		"""
+		Read the execution options of a queue (or worker group), and the consumer kwargs they imply
+		"""
 		kwargs['exchange'] = carrot_settings['exchange']
 		kwargs['host'] = carrot_settings['host']
 		kwargs['port'] = carrot_settings['port']
 		kwargs['user'] = carrot_settings['user']
 		kwargs['password'] = carrot_settings['password']
+		kwargs['drain_timeout'] = carrot_settings['drain_timeout']
 
-		kwargs['prefetch_count'] = self.PREFETCH_COUNT
-		kwargs['callback'] = self.on_message
+		self.execution_mode = queue_settings['execution_mode']
+		self.pool_size = queue_settings['execution_pool_size']
+		self.reporter = create_reporter(
+			queue_settings['status_reporting'],
+			batch_size=carrot_settings['status_batch_size'],
+			interval=carrot_settings['status_batch_interval'],
+		)
 
-		super().__init__(*args, **kwargs)
+		# Recycling limits, the worker exits once reached and is replaced by the supervisor
+		self.max_tasks = queue_settings['max_tasks_per_worker']
+		self.max_memory = queue_settings['max_worker_memory']
+		self._task_count = 0
+		self._task_count_lock = threading.Lock()
+		# Tasks executing right now, by id, so those still running when a drain times out can be recorded
+		self._running = {}
+
+		# Messages received but not started (single queue pipelining), and the future of the row of each task id
+		self.pipeline_depth = queue_settings['pipeline_depth']
+		self._pipeline = None
+		self._prefetched = {}
+		self._fetcher = None
+
+		# Workers are built by the supervisor before it forks them, so this defaults to the supervisor's directory
+		self.metrics_dir = carrot_settings['metrics_dir'] or metrics.default_directory(os.getpid())
+
+		if self.execution_mode == EXECUTION_SERIAL:
+			kwargs['prefetch_count'] = self.PREFETCH_COUNT + self.pipeline_depth
+			kwargs['callback'] = self.on_message
+		else:
+			# Enough messages are prefetched to keep every slot of the pool busy
+			kwargs['prefetch_count'] = self.pool_size
+			kwargs['callback'] = self.aon_message if self.execution_mode == EXECUTION_ASYNCIO else self.on_message
 
 	def run(self):
 		# Ensure new db fds are opened since workers are commonly forks
 		connections.close_all()
-		return super().run()
 
-	def on_message(self, message):
+		# Pay the import cost of known kallables before the first task arrives
+		kallables.preload(carrot_settings['preload_kallables'])
+		kallables.preload(carrot_settings['allowed_kallables'] or [])
+
+		# Executors start threads, so they are only created once running (after a fork)
+		self.executor = create_executor(self.execution_mode, self.pool_size)
+		if self.pipeline_depth:
+			self._fetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='carrot-prefetch')
+		self.reporter.start()
+		snapshots = None
+		if carrot_settings['metrics_port'] is not None:
+			# The supervisor serves the metrics of every worker from their snapshots
+			snapshots = metrics.SnapshotWriter(self.metrics_dir, carrot_settings['metrics_interval'])
+			snapshots.start()
 		try:
-			task = self._get_task(message)
+			return super().run()
+		finally:
+			if self.executor is not None:
+				self.executor.shutdown(wait=True)
+				self.executor = None
+			if self._fetcher is not None:
+				# The db connection of the fetching thread is closed from that thread
+				self._fetcher.submit(connections.close_all)
+				self._fetcher.shutdown(wait=True)
+				self._fetcher = None
+			self.reporter.stop()
+			if snapshots is not None:
+				snapshots.stop()
+
+	def _consume(self):
+		"""
+		A pipelining worker buffers its messages like a MultiQueueConsumer, so the messages waiting behind the
+		current task are known and their rows can be fetched ahead
+		"""
+		if self._pipeline is None:
+			return super()._consume()
+
+		self._pipeline.clear()
+		self._prefetched.clear()
+		self._channel.basic_qos(prefetch_count=self._prefetch_count)
+		self._channel.basic_consume(self.queue, self._on_pipelined)
+
+		while not self._shutdown_flag:
+			if not self._pipeline:
+				self._connection.process_data_events(time_limit=self.DEFAULT_POLL_INTERVAL)
+				continue
+
+			channel, method_frame, header_frame, body = self._pipeline.popleft()
+			self._on_message(channel, method_frame, header_frame, body)
+			# Read whatever arrived meanwhile, so the next task's row can be fetched while this one runs
+			self._connection.process_data_events(time_limit=0)
+
+	def _on_pipelined(self, channel, method_frame, header_frame, body):
+		self._pipeline.append((channel, method_frame, header_frame, body))
+
+	def _requeue_prefetched(self):
+		super()._requeue_prefetched()
+		while self._pipeline:
+			channel, method_frame, header_frame, body = self._pipeline.popleft()
+			if channel.is_open:
+				channel.basic_nack(delivery_tag=method_frame.delivery_tag, requeue=True)
+		self._prefetched.clear()
+
+	def _waiting(self):
+		"""
+		:returns: the bodies of the messages received but not started, in the order they will run
+		"""
+		return [body for _, _, _, body in self._pipeline or ()]
+
+	def _prefetch(self):
+		"""
+		Fetch the rows of up to `pipeline_depth` waiting tasks with one query, in the background
+		"""
+		if self._fetcher is None:
+			return
+
+		ids = []
+		for body in self._waiting()[:self.pipeline_depth]:
+			try:
+				payload = decode_task(body.decode(self.message_encoding) if self.message_encoding is not None else body)
+			except Exception:
+				# Reported once the message is delivered
+				continue
+			# Messages which carry their task are claimed by id, there's nothing to fetch
+			if 'kallable' not in payload and str(payload['id']) not in self._prefetched:
+				ids.append(str(payload['id']))
+
+		if ids:
+			future = self._fetcher.submit(self._fetch_rows, ids)
+			for task_id in ids:
+				self._prefetched[task_id] = future
+
+	@staticmethod
+	def _fetch_rows(ids):
+		try:
+			tasks = list(Task.objects.filter(id__in=ids))
 		except OperationalError:
-			# client timeout might cause db connections to close. Attempt reconnect
 			connections.close_all()
-			task = self._get_task(message)
+			tasks = list(Task.objects.filter(id__in=ids))
+		return {str(task.id): task for task in tasks}
 
-		if task is None:
-			LOGGER.error(f"task ({message}) does not exist, was db_table flushed?")
+	def _take_prefetched(self, task_id):
+		"""
+		:returns: the prefetched row of a task, or None if it has to be read
+		"""
+		future = self._prefetched.pop(str(task_id), None)
+		if future is None:
+			return None
 
-		elif task.status != task.Status.PENDING:
-			LOGGER.info(f"task ({message}) no longer pending execution, discarding.")
+		start = time.perf_counter()
+		try:
+			rows = future.result()
+		except Exception as e:
+			LOGGER.warning(f"Unable to prefetch task ({task_id}), reading it again: {e}")
+			return None
+		metrics.TASK_FETCH_SECONDS.observe(time.perf_counter() - start)
+		# A task missing from the rows may have been committed since, it's read again
+		return rows.get(str(task_id))
 
-		else:
+	def on_message(self, message):
+		self._prefetch()
+		task, claimed = self._prepare(message)
+		if task is not None:
+			self._running[task.id] = task
 			try:
-				task.execute()
+				task.execute(claimed=claimed, reporter=self.reporter)
 			except: # noqa
 				LOGGER.exception("Carrot Worker caught an exception, the task failed, but the worker does not die")
+			finally:
+				self._running.pop(task.id, None)
+			self._after_task()
+
+	async def aon_message(self, message):
+		task, claimed = await sync_to_async(self._prepare)(message)
+		if task is not None:
+			self._running[task.id] = task
+			try:
+				await task.aexecute(claimed=claimed, reporter=self.reporter)
+			except: # noqa
+				LOGGER.exception("Carrot Worker caught an exception, the task failed, but the worker does not die")
+			finally:
+				self._running.pop(task.id, None)
+			self._after_task()
+
+	def _after_task(self):
+		"""
+		Stop the worker once it has executed max_tasks tasks or its memory grew past max_memory (kB)
+		"""
+		with self._task_count_lock:
+			self._task_count += 1
+			count = self._task_count
+
+		if self._shutdown_flag:
+			return
+
+		if self.max_tasks and count >= self.max_tasks:
+			LOGGER.info(f"Worker executed ({count}) tasks, stopping to be recycled")
+			self.request_stop()
+
+		elif self.max_memory:
+			rss = get_rss()
+			if rss > self.max_memory:
+				LOGGER.info(f"Worker memory ({rss}kB) exceeds ({self.max_memory}kB), stopping to be recycled")
+				self.request_stop()
+
+	def _on_drain_timeout(self):
+		"""
+		Record the tasks still executing as running in this process, whatever the status reporting mode. Their
+		messages are requeued when the connection closes and then discarded, since the tasks aren't pending,
+		and `manage.py carrot recover` re-publishes them once this process is gone.
+		"""
+		super()._on_drain_timeout()
+		stuck = list(self._running)
+		if not stuck:
+			return
+
+		LOGGER.warning(f"Tasks ({stuck}) were still running when the worker stopped, recording them for recovery")
+		try:
+			Task.objects.filter(id__in=stuck, status__in=[Task.Status.PENDING, Task.Status.RUNNING]).update(
+				status=Task.Status.RUNNING,
+				pid=os.getpid(),
+				hostname=HOSTNAME,
+				message="Still running when its worker shut down",
+			)
+		except Exception:
+			LOGGER.exception(f"Unable to record stuck tasks ({stuck})")
+
+	def _prepare(self, message):
+		"""
+		Find the task a message refers to and check that it should be executed
+
+		:returns: tuple of (task or None, whether the task was already claimed)
+		"""
+		payload = decode_task(message)
+		if 'kallable' in payload:
+			# The message carries the task, so it's claimed by id instead of being read from the db
+			task = Task.from_message(payload)
+			if not task.is_due:
+				return self._delay(task)
+			limit = get_limit(task.kallable)
+			if limit is not None:
+				return self._throttle(task, limit)
+			task, claimed = self._claim(task)
+			self._observe_wait(task)
+			return task, claimed
+
+		task = self._take_prefetched(payload['id'])
+		if task is None:
+			# Usually the task is read and marked running by one conditional UPDATE
+			claimed_task = self._claim_pending(payload['id'])
+			if claimed_task is not None:
+				self._observe_wait(claimed_task)
+				return claimed_task, True
+
+			# Otherwise the row is read to find out why it wasn't claimed
+			try:
+				task = self._get_task(payload['id'])
+			except OperationalError:
+				# client timeout might cause db connections to close. Attempt reconnect
+				connections.close_all()
+				task = self._get_task(payload['id'])
+
+		if task is None:
+			LOGGER.error(f"task ({payload['id']}) does not exist, was db_table flushed?")
+			return None, False
+
+		elif task.status != task.Status.PENDING:
+			LOGGER.info(f"task ({payload['id']}) no longer pending execution, discarding.")
+			return None, False
+
+		elif not task.is_due:
+			return self._delay(task)
+
+		limit = get_limit(task.kallable)
+		if limit is not None:
+			return self._throttle(task, limit)
+
+		# A prefetched row, or one which became due since the claim was attempted, is claimed on its own
+		task, claimed = self._claim(task)
+		self._observe_wait(task)
+		return task, claimed
+
+	def _observe_wait(self, task):
+		# From when the task was created, or became due, until now that it's about to start
+		if task is not None and task.created_on is not None:
+			since = max(task.created_on, task.eta) if task.eta else task.created_on
+			metrics.QUEUE_WAIT_SECONDS.observe((timezone.now() - since).total_seconds(), task.queue)
+
+	def _delay(self, task):
+		"""
+		Send a task which isn't due yet on to the next delay queue
+		"""
+		try:
+			task.publish()
+			LOGGER.debug(f"task ({task.id}) is not due until ({task.eta}), delayed again")
+		except Exception:
+			LOGGER.exception(f"Unable to delay task ({task.id}), it will not be executed")
+		return None, False
+
+	def _throttle(self, task, limit):
+		"""
+		Claim a rate limited task, or defer it through the delay queues while its kallable is over the limit
+		"""
+		claimed, wait = limit.acquire(task)
+		if claimed:
+			self._observe_wait(task)
+			return task, True
+		if wait is None:
+			LOGGER.info(f"task ({task.id}) no longer pending execution or not yet committed, discarding.")
+			return None, False
+
+		# Deferred for at least the smallest delay bucket, a shorter wait would come straight back
+		metrics.TASKS_THROTTLED.inc(task.kallable)
+		wait = max(wait, min(carrot_settings['delay_buckets']))
+		task.eta = timezone.now() + timedelta(seconds=wait)
+		LOGGER.debug(f"task ({task.id}) is throttled, deferred for ({wait:.1f}) seconds")
+		return self._delay(task)
+
+	def _claim(self, task):
+		try:
+			claimed = task.claim()
+		except OperationalError:
+			connections.close_all()
+			claimed = task.claim()
+
+		if not claimed:
+			LOGGER.info(f"task ({task.id}) no longer pending execution or not yet committed, discarding.")
+			return None, False
+		return task, True
+
+	def _claim_pending(self, task_id):
+		start = time.perf_counter()
+		# Rate limited tasks are claimed by their RateLimit, once it admits them
+		exclude_kallables = carrot_settings['rate_limits'].keys()
+		try:
+			task = Task.objects.claim_pending(task_id, exclude_kallables=exclude_kallables)
+		except OperationalError:
+			connections.close_all()
+			task = Task.objects.claim_pending(task_id, exclude_kallables=exclude_kallables)
+		metrics.TASK_FETCH_SECONDS.observe(time.perf_counter() - start)
+		return task
 
 	def _get_task(self, task_id):
+		start = time.perf_counter()
 		try:
 			task = Task.objects.get(id=task_id)
 		except Task.DoesNotExist:
 			task = None
+		metrics.TASK_FETCH_SECONDS.observe(time.perf_counter() - start)
 		return task
+
+
+class GroupWorker(Worker, MultiQueueConsumer):
+	"""
+	A Worker which consumes every queue of a worker group (CARROT['worker_groups']), picking the next task
+	by the group's queue weights, or strictly in the order of its queues
+	"""
+	def __init__(self, group, *args, **kwargs):
+		assert group in carrot_settings['worker_groups'], f"{group} is not a valid worker group"
+		group_settings = carrot_settings['worker_groups'][group]
+
+		kwargs['queues'] = {
+			carrot_settings['queues'][queue]['queue_name']: weight for queue, weight in group_settings['queues'].items()
+		}
+		kwargs['policy'] = group_settings['policy']
+		self._configure(group_settings, kwargs)
+		if self.execution_mode != EXECUTION_SERIAL:
+			kwargs['max_inflight'] = self.pool_size
+		MultiQueueConsumer.__init__(self, *args, **kwargs)
+
+	def _waiting(self):
+		# Every queue's buffer, the next message may come from any of them
+		return [body for buffer in self._buffers.values() for _, _, _, body in buffer]
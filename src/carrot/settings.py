@@ -1,6 +1,12 @@
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
+from carrot.amqp import CONSUME_POLICIES, POLICY_WEIGHTED
+from carrot.executors import EXECUTION_MODES, EXECUTION_SERIAL
+from carrot.messages import MESSAGE_FORMATS, FORMAT_ID
+from carrot.scheduling import DEFAULT_DELAY_BUCKETS
+from carrot.status import REPORTING_MODES, REPORTING_SYNC
+
 # At the time of writing, the queue name was limited to 255 bytes of UTF-8 chars.
 # https://www.rabbitmq.com/queues.html
 MAX_BYTES_QUEUE_NAME = 255
@@ -14,11 +20,53 @@ DEFAULTS = {
 	'exchange': 'carrot.direct',
 	'queue_prefix': 'carrot',
 	'worker_concurrency': 1,
+	'execution_mode': EXECUTION_SERIAL,
+	'execution_pool_size': 10,
+	'pipeline_depth': 0,
+	'status_reporting': REPORTING_SYNC,
+	'status_batch_size': 100,
+	'status_batch_interval': 1,
+	'max_tasks_per_worker': 0,
+	'max_worker_memory': 0,
+	'autoscale_interval': 10,
+	'autoscale_messages_per_worker': 10,
+	'shutdown_timeout': 30,
+	'drain_timeout': None,
+	'kallable_cache_size': 512,
+	'kallable_negative_ttl': 5,
+	'preload_kallables': [],
+	'allowed_kallables': None,
 	'durable_queue': True,
 	'durable_exchange': True,
 	'durable_messages': False,
+	'message_format': FORMAT_ID,
+	'outbox': False,
+	'outbox_relay_grace': 60,
+	'retention_days': 30,
+	'delay_buckets': DEFAULT_DELAY_BUCKETS,
+	'schedule': {},
+	'retry': None,
+	'retry_policies': {},
+	'rate_limits': {},
+	'store_results': False,
+	'result_max_size': 65536,
+	'result_ttl': 86400,
+	'payload_store': None,
+	'payload_store_options': {},
+	'payload_threshold': 65536,
+	'publisher_confirms': False,
+	'publisher_confirm_window': 1000,
+	'publisher_pool_size': 10,
+	'publisher_pool_max_idle': 300,
+	'publisher_pool_timeout': 30,
 	'include_default_queue': True,
 	'queues': {},
+	'worker_groups': {},
+	'transport': None,
+	'metrics_port': None,
+	'metrics_address': '127.0.0.1',
+	'metrics_dir': None,
+	'metrics_interval': 5,
 }
 
 # Merge defaults with APP settings
@@ -27,6 +75,10 @@ assert isinstance(carrot_settings, dict), f'wrong type ({type(carrot_settings)})
 for k, v in DEFAULTS.items():
 	carrot_settings.setdefault(k, v)
 
+# Workers stop waiting on their tasks a little before the supervisor kills them, so stuck tasks can be recorded
+if carrot_settings['drain_timeout'] is None:
+	carrot_settings['drain_timeout'] = carrot_settings['shutdown_timeout'] * 0.8
+
 # Default queue
 if carrot_settings['include_default_queue'] is True:
 	carrot_settings['queues'].setdefault(DEFAULT_QUEUE_NAME, {})
@@ -40,12 +92,86 @@ for queue, queue_settings in carrot_settings['queues'].items():
 	queue_settings.setdefault('queue_name', f"{carrot_settings['queue_prefix']}.{queue}")
 	queue_settings.setdefault('worker_concurrency', carrot_settings['worker_concurrency'])
 	queue_settings.setdefault('durable_queue', carrot_settings['durable_queue'])
+	queue_settings.setdefault('execution_mode', carrot_settings['execution_mode'])
+	queue_settings.setdefault('execution_pool_size', carrot_settings['execution_pool_size'])
+	queue_settings.setdefault('pipeline_depth', carrot_settings['pipeline_depth'])
+	queue_settings.setdefault('status_reporting', carrot_settings['status_reporting'])
+	queue_settings.setdefault('min_workers', queue_settings['worker_concurrency'])
+	queue_settings.setdefault('max_workers', max(int(queue_settings['min_workers']), int(queue_settings['worker_concurrency'])))
+	queue_settings.setdefault('max_tasks_per_worker', carrot_settings['max_tasks_per_worker'])
+	queue_settings.setdefault('max_worker_memory', carrot_settings['max_worker_memory'])
+	queue_settings.setdefault('retry', carrot_settings['retry'])
+	queue_settings.setdefault('max_priority', None)
+	queue_settings.setdefault('store_results', carrot_settings['store_results'])
 
 	# Validations
 	queue_settings['worker_concurrency'] = int(queue_settings['worker_concurrency'])
+	queue_settings['execution_pool_size'] = int(queue_settings['execution_pool_size'])
+	if queue_settings['status_reporting'] not in REPORTING_MODES:
+		raise ImproperlyConfigured(f"status_reporting of queue ({queue}) must be one of: {REPORTING_MODES}")
+	queue_settings['min_workers'] = int(queue_settings['min_workers'])
+	queue_settings['max_workers'] = int(queue_settings['max_workers'])
+	queue_settings['max_tasks_per_worker'] = int(queue_settings['max_tasks_per_worker'])
+	queue_settings['max_worker_memory'] = int(queue_settings['max_worker_memory'])
+	if not 0 <= queue_settings['min_workers'] <= queue_settings['max_workers']:
+		raise ImproperlyConfigured(f"Queue ({queue}) must have 0 <= min_workers <= max_workers")
+	if queue_settings['execution_mode'] not in EXECUTION_MODES:
+		raise ImproperlyConfigured(f"execution_mode of queue ({queue}) must be one of: {EXECUTION_MODES}")
+	queue_settings['pipeline_depth'] = int(queue_settings['pipeline_depth'])
+	if queue_settings['pipeline_depth'] < 0 or (queue_settings['pipeline_depth'] and queue_settings['execution_mode'] != EXECUTION_SERIAL):
+		raise ImproperlyConfigured(f"pipeline_depth of queue ({queue}) must be >= 0, and only applies to the serial execution_mode")
+	if queue_settings['max_priority'] is not None and not 1 <= int(queue_settings['max_priority']) <= 255:
+		raise ImproperlyConfigured(f"max_priority of queue ({queue}) must be between 1 and 255 (RabbitMQ recommends at most 10)")
+	if not isinstance(queue_settings['retry'], (dict, type(None))):
+		raise ImproperlyConfigured(f"retry of queue ({queue}) must be a dict of RetryPolicy options or None")
 	if not len(queue_settings['queue_name'].encode('utf-8')) <= MAX_BYTES_QUEUE_NAME:
 		raise ImproperlyConfigured(f"Queue names may be up to {MAX_BYTES_QUEUE_NAME} bytes of UTF-8 characters")
 
+# Worker groups consume several queues from one pool of workers, by weight or strictly in order
+for group, group_settings in carrot_settings['worker_groups'].items():
+	assert isinstance(group, str)
+	assert isinstance(group_settings, dict)
+
+	group_settings.setdefault('policy', POLICY_WEIGHTED)
+	group_settings.setdefault('worker_concurrency', carrot_settings['worker_concurrency'])
+	group_settings.setdefault('execution_mode', carrot_settings['execution_mode'])
+	group_settings.setdefault('execution_pool_size', carrot_settings['execution_pool_size'])
+	group_settings.setdefault('pipeline_depth', carrot_settings['pipeline_depth'])
+	group_settings.setdefault('status_reporting', carrot_settings['status_reporting'])
+	group_settings.setdefault('min_workers', group_settings['worker_concurrency'])
+	group_settings.setdefault('max_workers', max(int(group_settings['min_workers']), int(group_settings['worker_concurrency'])))
+	group_settings.setdefault('max_tasks_per_worker', carrot_settings['max_tasks_per_worker'])
+	group_settings.setdefault('max_worker_memory', carrot_settings['max_worker_memory'])
+
+	# A list of queues is weighted equally
+	if isinstance(group_settings.get('queues'), (list, tuple)):
+		group_settings['queues'] = {queue: 1 for queue in group_settings['queues']}
+
+	# Validations
+	if not isinstance(group_settings.get('queues'), dict) or not group_settings['queues']:
+		raise ImproperlyConfigured(f"Worker group ({group}) needs the queues it consumes")
+	for queue, weight in group_settings['queues'].items():
+		if queue not in carrot_settings['queues']:
+			raise ImproperlyConfigured(f"Worker group ({group}) consumes an unknown queue ({queue})")
+		if not isinstance(weight, int) or weight < 1:
+			raise ImproperlyConfigured(f"Weight of queue ({queue}) in worker group ({group}) must be a positive int")
+	if group_settings['policy'] not in CONSUME_POLICIES:
+		raise ImproperlyConfigured(f"policy of worker group ({group}) must be one of: {CONSUME_POLICIES}")
+	group_settings['execution_pool_size'] = int(group_settings['execution_pool_size'])
+	if group_settings['status_reporting'] not in REPORTING_MODES:
+		raise ImproperlyConfigured(f"status_reporting of worker group ({group}) must be one of: {REPORTING_MODES}")
+	if group_settings['execution_mode'] not in EXECUTION_MODES:
+		raise ImproperlyConfigured(f"execution_mode of worker group ({group}) must be one of: {EXECUTION_MODES}")
+	group_settings['pipeline_depth'] = int(group_settings['pipeline_depth'])
+	if group_settings['pipeline_depth'] < 0 or (group_settings['pipeline_depth'] and group_settings['execution_mode'] != EXECUTION_SERIAL):
+		raise ImproperlyConfigured(f"pipeline_depth of worker group ({group}) must be >= 0, and only applies to the serial execution_mode")
+	group_settings['min_workers'] = int(group_settings['min_workers'])
+	group_settings['max_workers'] = int(group_settings['max_workers'])
+	group_settings['max_tasks_per_worker'] = int(group_settings['max_tasks_per_worker'])
+	group_settings['max_worker_memory'] = int(group_settings['max_worker_memory'])
+	if not 0 <= group_settings['min_workers'] <= group_settings['max_workers']:
+		raise ImproperlyConfigured(f"Worker group ({group}) must have 0 <= min_workers <= max_workers")
+
 assert isinstance(carrot_settings['host'], str)
 assert isinstance(carrot_settings['port'], (int, str))
 assert isinstance(carrot_settings['user'], str)
@@ -54,8 +180,53 @@ assert isinstance(carrot_settings['password'], str)
 assert isinstance(carrot_settings['exchange'], str)
 assert isinstance(carrot_settings['queue_prefix'], str)
 assert isinstance(carrot_settings['worker_concurrency'], int)
+assert isinstance(carrot_settings['execution_pool_size'], int)
+assert isinstance(carrot_settings['pipeline_depth'], int) and carrot_settings['pipeline_depth'] >= 0
+assert isinstance(carrot_settings['status_batch_size'], int)
+assert isinstance(carrot_settings['status_batch_interval'], (int, float))
+assert isinstance(carrot_settings['max_tasks_per_worker'], int)
+assert isinstance(carrot_settings['max_worker_memory'], int)
+assert isinstance(carrot_settings['autoscale_interval'], (int, float))
+assert isinstance(carrot_settings['autoscale_messages_per_worker'], int)
+assert isinstance(carrot_settings['shutdown_timeout'], (int, float))
+assert isinstance(carrot_settings['drain_timeout'], (int, float)) and carrot_settings['drain_timeout'] <= carrot_settings['shutdown_timeout']
+assert isinstance(carrot_settings['kallable_cache_size'], int)
+assert isinstance(carrot_settings['kallable_negative_ttl'], (int, float))
+assert isinstance(carrot_settings['preload_kallables'], (list, tuple))
+assert isinstance(carrot_settings['allowed_kallables'], (list, tuple, type(None)))
 assert isinstance(carrot_settings['durable_queue'], bool)
 assert isinstance(carrot_settings['durable_exchange'], bool)
 assert isinstance(carrot_settings['durable_messages'], bool)
+assert carrot_settings['message_format'] in MESSAGE_FORMATS, f"message_format must be one of: {MESSAGE_FORMATS}"
+assert isinstance(carrot_settings['outbox'], bool)
+assert isinstance(carrot_settings['outbox_relay_grace'], (int, float))
+assert isinstance(carrot_settings['retention_days'], (int, float))
+assert isinstance(carrot_settings['delay_buckets'], (list, tuple)) and len(carrot_settings['delay_buckets']) > 0
+assert all(isinstance(bucket, int) and bucket > 0 for bucket in carrot_settings['delay_buckets'])
+assert isinstance(carrot_settings['schedule'], dict)
+assert isinstance(carrot_settings['retry_policies'], dict)
+assert isinstance(carrot_settings['transport'], (str, type(None)))
+assert isinstance(carrot_settings['store_results'], bool)
+assert isinstance(carrot_settings['result_max_size'], int)
+assert isinstance(carrot_settings['result_ttl'], (int, float)) and carrot_settings['result_ttl'] > 0
+assert isinstance(carrot_settings['payload_store'], (str, type(None)))
+assert isinstance(carrot_settings['payload_store_options'], dict)
+assert isinstance(carrot_settings['payload_threshold'], int) and carrot_settings['payload_threshold'] >= 0
+assert isinstance(carrot_settings['metrics_port'], (int, type(None)))
+assert isinstance(carrot_settings['metrics_address'], str)
+assert isinstance(carrot_settings['metrics_dir'], (str, type(None)))
+assert isinstance(carrot_settings['metrics_interval'], (int, float)) and carrot_settings['metrics_interval'] > 0
+assert all(isinstance(options, dict) for options in carrot_settings['retry_policies'].values())
+assert isinstance(carrot_settings['rate_limits'], dict)
+for kallable, options in carrot_settings['rate_limits'].items():
+	assert isinstance(options, dict), f"Rate limit of ({kallable}) must be a dict of RateLimit options"
+	assert options.get('rate') or options.get('max_concurrency'), f"Rate limit of ({kallable}) needs a rate or a max_concurrency"
+for name, entry in carrot_settings['schedule'].items():
+	assert 'kallable' in entry and 'interval' in entry, f"Schedule entry ({name}) needs a kallable and an interval"
+assert isinstance(carrot_settings['publisher_confirms'], bool)
+assert isinstance(carrot_settings['publisher_confirm_window'], int)
+assert isinstance(carrot_settings['publisher_pool_size'], int)
+assert isinstance(carrot_settings['publisher_pool_max_idle'], (int, float, type(None)))
+assert isinstance(carrot_settings['publisher_pool_timeout'], (int, float))
 assert isinstance(carrot_settings['include_default_queue'], bool)
 assert isinstance(carrot_settings['queues'], dict)
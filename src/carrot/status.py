@@ -0,0 +1,119 @@
+import logging
+import threading
+
+from django.db import connections
+
+LOGGER = logging.getLogger(__name__)
+
+REPORTING_SYNC = 'sync'
+REPORTING_SKIP_RUNNING = 'skip_running'
+REPORTING_BATCHED = 'batched'
+REPORTING_MODES = (REPORTING_SYNC, REPORTING_SKIP_RUNNING, REPORTING_BATCHED)
+
+RUNNING_FIELDS = {'status', 'started_on', 'pid', 'hostname'}
+FINISHED_FIELDS = {'status', 'exit_code', 'completed_on', 'message', 'pid', 'result', 'result_expires'}
+RETRY_FIELDS = FINISHED_FIELDS | {'retries', 'eta'}
+
+
+class StatusReporter:
+	"""
+	Writes the status of a task as it executes: one UPDATE when it starts running and one when it finishes
+	"""
+	def running(self, task):
+		task.save(validate=False, update_fields=RUNNING_FIELDS)
+
+	def finished(self, task):
+		task.save(validate=False, update_fields=FINISHED_FIELDS)
+
+	def retrying(self, task):
+		# Always written right away, the retry is published once the task is pending again
+		task.save(validate=False, update_fields=RETRY_FIELDS)
+
+	def start(self):
+		pass
+
+	def stop(self):
+		pass
+
+
+class SkipRunningStatusReporter(StatusReporter):
+	"""
+	Skips the UPDATE when a task starts running. Workers mark a task running when they claim it, in the statement
+	which reads it, so this only changes anything for tasks executed without a claim (task.execute(reporter=...)).
+	"""
+	def running(self, task):
+		pass
+
+
+class BatchedStatusReporter(SkipRunningStatusReporter):
+	"""
+	Only writes the final status of a task, and buffers those writes so they're flushed with a single
+	bulk_update every `batch_size` tasks or `interval` seconds, whichever comes first.
+	Buffered statuses are lost if the process is killed before they are flushed.
+	"""
+	DEFAULT_BATCH_SIZE = 100
+	DEFAULT_INTERVAL = 1
+
+	def __init__(self, batch_size=DEFAULT_BATCH_SIZE, interval=DEFAULT_INTERVAL):
+		self.batch_size = int(batch_size)
+		self.interval = interval
+
+		self._buffer = []
+		self._lock = threading.Lock()
+		self._stopped = threading.Event()
+		self._thread = None
+
+	def finished(self, task):
+		with self._lock:
+			self._buffer.append(task)
+			is_full = len(self._buffer) >= self.batch_size
+
+		if is_full:
+			self.flush()
+
+	def flush(self):
+		with self._lock:
+			tasks, self._buffer = self._buffer, []
+
+		if not tasks:
+			return
+
+		try:
+			type(tasks[0]).objects.bulk_update(tasks, FINISHED_FIELDS)
+		except Exception:
+			LOGGER.exception(f"Unable to write the status of ({len(tasks)}) tasks: {[task.id for task in tasks]}")
+
+	def start(self):
+		"""
+		Start flushing every `interval` seconds from a background thread
+		"""
+		self._stopped.clear()
+		self._thread = threading.Thread(target=self._flush_periodically, name='carrot-status', daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		"""
+		Stop the background thread and flush anything left in the buffer
+		"""
+		self._stopped.set()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+		self.flush()
+
+	def _flush_periodically(self):
+		try:
+			while not self._stopped.wait(self.interval):
+				self.flush()
+		finally:
+			connections.close_all()
+
+
+def create_reporter(mode, batch_size=BatchedStatusReporter.DEFAULT_BATCH_SIZE, interval=BatchedStatusReporter.DEFAULT_INTERVAL):
+	if mode == REPORTING_SYNC:
+		return StatusReporter()
+	if mode == REPORTING_SKIP_RUNNING:
+		return SkipRunningStatusReporter()
+	if mode == REPORTING_BATCHED:
+		return BatchedStatusReporter(batch_size=batch_size, interval=interval)
+	raise ValueError(f"Unknown status reporting mode ({mode})")
@@ -0,0 +1,224 @@
+import logging
+import glob
+import math
+import multiprocessing
+import os
+import shutil
+import signal
+import threading
+import time
+
+import pika
+
+from carrot import metrics
+from carrot.amqp import RabbitConnection
+from carrot.services import GroupWorker, Worker
+from carrot.settings import carrot_settings
+
+LOGGER = logging.getLogger(__name__)
+
+
+class WorkerPool:
+	"""
+	The worker processes consuming a single queue, or the queues of a worker group
+	"""
+	def __init__(self, queue, queue_settings, worker_class=Worker):
+		self.queue = queue
+		self.worker_class = worker_class
+		if worker_class is GroupWorker:
+			self.queue_names = [carrot_settings['queues'][name]['queue_name'] for name in queue_settings['queues']]
+		else:
+			self.queue_names = [queue_settings['queue_name']]
+		self.min_workers = queue_settings['min_workers']
+		self.max_workers = queue_settings['max_workers']
+		self.desired = self.min_workers
+
+		self.processes = []
+		self.stopping = []
+
+	@property
+	def autoscales(self):
+		return self.min_workers < self.max_workers
+
+	def spawn(self):
+		process = multiprocessing.Process(target=self.worker_class(self.queue).run, daemon=True)
+		process.start()
+		self.processes.append(process)
+		LOGGER.info(f"Started worker ({process.pid}) for queue ({self.queue})")
+
+	def reap(self):
+		"""
+		Forget about processes which have exited, so they are replaced
+
+		:returns: list of the processes which exited
+		"""
+		exited = [p for p in self.processes + self.stopping if not p.is_alive()]
+		for process in [p for p in self.processes if not p.is_alive()]:
+			self.processes.remove(process)
+			if process.exitcode == 0:
+				LOGGER.info(f"Worker ({process.pid}) for queue ({self.queue}) exited, replacing it")
+			else:
+				LOGGER.warning(f"Worker ({process.pid}) for queue ({self.queue}) died with exit code ({process.exitcode}), replacing it")
+
+		self.stopping = [p for p in self.stopping if p.is_alive()]
+		return exited
+
+	def scale(self, depth, messages_per_worker):
+		"""
+		Pick the number of workers for the current queue depth. Scaling up happens at once,
+		scaling down one worker per call to avoid flapping.
+		"""
+		wanted = math.ceil(depth / messages_per_worker) if messages_per_worker > 0 else self.max_workers
+		wanted = min(max(wanted, self.min_workers), self.max_workers)
+		if wanted < self.desired:
+			wanted = self.desired - 1
+
+		if wanted != self.desired:
+			LOGGER.info(f"Scaling queue ({self.queue}) from ({self.desired}) to ({wanted}) workers, depth ({depth})")
+		self.desired = wanted
+
+	def converge(self):
+		while len(self.processes) < self.desired:
+			self.spawn()
+
+		while len(self.processes) > self.desired:
+			# The newest workers are stopped first, they are the least likely to be busy
+			process = self.processes.pop()
+			process.terminate()
+			self.stopping.append(process)
+
+	def terminate(self):
+		for process in self.processes + self.stopping:
+			if process.is_alive():
+				process.terminate()
+		self.stopping.extend(self.processes)
+		self.processes = []
+
+
+class Supervisor:
+	"""
+	Supervises the worker processes of every queue. Dead workers are respawned, workers recycle themselves
+	(max_tasks_per_worker, max_worker_memory) and are replaced, and queues with min_workers < max_workers
+	are scaled according to their depth. SIGTERM and SIGINT are forwarded to the workers so they drain gracefully.
+	"""
+	TICK = 1
+
+	def __init__(self, queues=None):
+		queues = queues or carrot_settings['queues']
+		self.pools = [WorkerPool(queue, queue_settings) for queue, queue_settings in queues.items()]
+		self.pools += [
+			WorkerPool(group, group_settings, worker_class=GroupWorker)
+			for group, group_settings in carrot_settings['worker_groups'].items()
+		]
+
+		self.autoscale_interval = carrot_settings['autoscale_interval']
+		self.messages_per_worker = carrot_settings['autoscale_messages_per_worker']
+		self.shutdown_timeout = carrot_settings['shutdown_timeout']
+
+		self._shutdown_flag = False
+		self._last_autoscale = 0
+
+		# Metrics of exited workers, kept so counters don't go backwards when a worker is replaced
+		self.metrics_dir = carrot_settings['metrics_dir'] or metrics.default_directory(os.getpid())
+		self._retired_metrics = {}
+		self._metrics_lock = threading.Lock()
+		self._metrics_server = None
+
+	def run(self):
+		signal.signal(signal.SIGTERM, self._sigterm)
+		signal.signal(signal.SIGINT, self._sigterm)
+
+		if carrot_settings['metrics_port'] is not None:
+			self.start_metrics_server(carrot_settings['metrics_port'])
+
+		while not self._shutdown_flag:
+			if time.monotonic() - self._last_autoscale >= self.autoscale_interval:
+				self._last_autoscale = time.monotonic()
+				self.autoscale()
+
+			for pool in self.pools:
+				self.retire_metrics(pool.reap())
+				pool.converge()
+
+			time.sleep(self.TICK)
+
+		self.shutdown()
+
+	def autoscale(self):
+		pools = [pool for pool in self.pools if pool.autoscales]
+		if not pools:
+			return
+
+		# A short lived connection, so no socket is shared with the workers forked afterwards
+		connection = RabbitConnection(
+			host=carrot_settings['host'],
+			port=carrot_settings['port'],
+			user=carrot_settings['user'],
+			password=carrot_settings['password'],
+		)
+		try:
+			for pool in pools:
+				depth = sum(connection.queue_depth(queue_name) for queue_name in pool.queue_names)
+				pool.scale(depth, self.messages_per_worker)
+		except pika.exceptions.AMQPError as e:
+			LOGGER.warning(f"Unable to read queue depths for autoscaling: {str(e)}")
+		finally:
+			connection.close()
+
+	def start_metrics_server(self, port):
+		"""
+		Serve the metrics of every worker, aggregated from the snapshots they write to metrics_dir
+		"""
+		os.makedirs(self.metrics_dir, exist_ok=True)
+		for path in glob.glob(os.path.join(self.metrics_dir, '*.json')):
+			# Left over from a previous run
+			os.remove(path)
+		self._metrics_server = metrics.start_http_server(port, collect=self.collect_metrics, address=carrot_settings['metrics_address'])
+
+	def collect_metrics(self):
+		with self._metrics_lock:
+			snapshots = metrics.read_snapshots(self.metrics_dir)
+			snapshot = metrics.REGISTRY.merge(self._retired_metrics, metrics.REGISTRY.snapshot(), *snapshots)
+		return metrics.REGISTRY.render(snapshot)
+
+	def retire_metrics(self, processes):
+		"""
+		Fold the last snapshot of exited workers into the retired metrics
+		"""
+		if self._metrics_server is None:
+			return
+
+		for process in processes:
+			path = metrics.snapshot_path(self.metrics_dir, process.pid)
+			with self._metrics_lock:
+				for snapshot in metrics.read_snapshots_from([path]):
+					self._retired_metrics = metrics.REGISTRY.merge(self._retired_metrics, snapshot)
+				if os.path.exists(path):
+					os.remove(path)
+
+	def shutdown(self):
+		"""
+		Forward SIGTERM to every worker, wait for them to drain, and kill any left after shutdown_timeout
+		"""
+		for pool in self.pools:
+			pool.terminate()
+
+		deadline = time.monotonic() + self.shutdown_timeout
+		processes = [process for pool in self.pools for process in pool.stopping]
+		for process in processes:
+			process.join(max(deadline - time.monotonic(), 0))
+
+		for process in processes:
+			if process.is_alive():
+				LOGGER.warning(f"Worker ({process.pid}) did not stop within ({self.shutdown_timeout}s), killing it")
+				process.kill()
+				process.join()
+
+		if self._metrics_server is not None:
+			self._metrics_server.shutdown()
+			if carrot_settings['metrics_dir'] is None:
+				shutil.rmtree(self.metrics_dir, ignore_errors=True)
+
+	def _sigterm(self, signum, frame):
+		LOGGER.info(f"Carrot received shutdown signal ({signum}). Stopping workers")
+		self._shutdown_flag = True
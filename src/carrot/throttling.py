@@ -0,0 +1,90 @@
+import logging
+
+from django.db import router, transaction
+from django.utils import timezone
+
+from carrot.settings import carrot_settings
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RateLimit:
+	"""
+	Limits how often, and how many at once, the tasks of a kallable run across every worker process.
+	The rate is a token bucket of `burst` tokens refilled at `rate` tokens per second, kept in a Throttle row
+	which is locked while a task is admitted. Running tasks are counted from the db, so a task is claimed
+	(marked running) in the same transaction that admits it.
+
+	Example:
+	limit = RateLimit('myapp.tasks.call_api', rate=5, max_concurrency=2)
+	"""
+	# Seconds a task waits when the kallable is at its concurrency cap, there's no telling when a slot frees up
+	CONCURRENCY_WAIT = 1
+
+	def __init__(self, kallable, rate=None, burst=None, max_concurrency=None, granularity=1):
+		"""
+		:param rate: tasks per second, or None for no rate limit
+		:param burst: tasks which may start at once after being idle, by default one second worth of `rate`
+		:param max_concurrency: tasks which may run at the same time, or None for no cap
+		:param granularity: seconds a deferred task waits at least (the smallest delay bucket). The bucket holds at
+			least `granularity` seconds worth of `rate`, otherwise tokens refilled while tasks wait would be lost.
+		"""
+		assert rate is not None or max_concurrency is not None, f"Rate limit of ({kallable}) needs a rate or a max_concurrency"
+		assert rate is None or rate > 0, "rate must be positive"
+		assert max_concurrency is None or max_concurrency > 0, "max_concurrency must be positive"
+		self.kallable = kallable
+		self.rate = rate
+		self.burst = max(burst or rate or 1, (rate or 0) * granularity, 1)
+		self.max_concurrency = max_concurrency
+
+	def acquire(self, task):
+		"""
+		Claim the task if its kallable is within its limits
+
+		:returns: tuple of (whether the task was claimed, seconds to wait before trying again or None if
+			the task is no longer pending)
+		"""
+		from carrot.models import Task, Throttle
+
+		using = router.db_for_write(Throttle)
+		Throttle.objects.using(using).get_or_create(
+			kallable=self.kallable,
+			defaults={'tokens': self.burst, 'updated_on': timezone.now()},
+		)
+
+		with transaction.atomic(using=using):
+			throttle = Throttle.objects.using(using).select_for_update().get(kallable=self.kallable)
+			if self.max_concurrency is not None:
+				running = Task.objects.using(using).filter(kallable=self.kallable, status=Task.Status.RUNNING).count()
+				if running >= self.max_concurrency:
+					return False, self.CONCURRENCY_WAIT
+
+			now = timezone.now()
+			if self.rate is not None:
+				tokens = min(self.burst, throttle.tokens + (now - throttle.updated_on).total_seconds() * self.rate)
+				if tokens < 1:
+					return False, (1 - tokens) / self.rate
+
+			if not task.claim():
+				return False, None
+
+			if self.rate is not None:
+				throttle.tokens = tokens - 1
+				throttle.updated_on = now
+				throttle.save(update_fields=['tokens', 'updated_on'])
+			return True, 0
+
+
+# Built on first use, like retry policies
+_limits = {}
+
+
+def get_limit(kallable):
+	"""
+	:returns: the RateLimit of a kallable, or None if it isn't limited
+	"""
+	if kallable not in _limits:
+		options = carrot_settings['rate_limits'].get(kallable)
+		granularity = min(carrot_settings['delay_buckets'])
+		_limits[kallable] = RateLimit(kallable, granularity=granularity, **options) if options is not None else None
+	return _limits[kallable]
@@ -1,4 +1,27 @@
 import importlib
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+LOGGER = logging.getLogger(__name__)
+
+
+def pid_exists(pid):
+	"""
+	:returns: True if a process with this pid exists on this host
+	"""
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		# It exists, but belongs to another user
+		return True
+	return True
 
 
 def import_callable(path):
@@ -12,3 +35,95 @@ def import_callable(path):
 	callable_name = split_path[-1]
 	module = importlib.import_module(module_path)
 	return getattr(module, callable_name)
+
+
+class CallableCache:
+	"""
+	A bounded LRU cache in front of import_callable, so a kallable is only imported once per process.
+	Failed lookups are cached for `negative_ttl` seconds, so a bad kallable fails fast without being
+	re-imported on every call, while a deploy which adds it is still picked up shortly after.
+
+	Example:
+	cache = CallableCache(maxsize=128)
+	cache.preload(['myapp.tasks.send_email'])
+	func = cache.resolve('myapp.tasks.send_email')
+	"""
+	DEFAULT_MAXSIZE = 512
+	DEFAULT_NEGATIVE_TTL = 5
+
+	def __init__(self, maxsize=DEFAULT_MAXSIZE, negative_ttl=DEFAULT_NEGATIVE_TTL, allowed=None):
+		"""
+		:param maxsize: the maximum number of kallables (including failed lookups) kept
+		:param negative_ttl: seconds a failed lookup is remembered
+		:param allowed: optional iterable of the only kallables which may be resolved
+		"""
+		assert int(maxsize) > 0, "maxsize must be a positive int"
+		self.maxsize = int(maxsize)
+		self.negative_ttl = negative_ttl
+		self.allowed = frozenset(allowed) if allowed is not None else None
+
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def resolve(self, path):
+		"""
+		:param path: the dot-notated absolute path to a callable
+		:returns: callable, e.g. function, class
+		"""
+		if self.allowed is not None and path not in self.allowed:
+			raise ImportError(f"({path}) is not an allowed kallable")
+
+		with self._lock:
+			entry = self._entries.get(path)
+			if entry is not None:
+				self._entries.move_to_end(path)
+
+		if entry is not None:
+			func, error, expires = entry
+			if error is None:
+				return func
+			if time.monotonic() < expires:
+				raise error.with_traceback(None)
+
+		try:
+			func = import_callable(path)
+		except Exception as e:
+			self._store(path, (None, e, time.monotonic() + self.negative_ttl))
+			raise
+
+		self._store(path, (func, None, None))
+		return func
+
+	def preload(self, paths):
+		"""
+		Resolve kallables ahead of time, e.g. when a worker starts. Failures are logged, not raised.
+		"""
+		for path in paths:
+			try:
+				self.resolve(path)
+			except Exception:
+				LOGGER.exception(f"Unable to preload kallable ({path})")
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+	def _store(self, path, entry):
+		with self._lock:
+			self._entries[path] = entry
+			self._entries.move_to_end(path)
+			while len(self._entries) > self.maxsize:
+				self._entries.popitem(last=False)
+
+
+def get_rss():
+	"""
+	:returns: the resident set size of the current process in kB
+	"""
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+	except (OSError, ValueError, IndexError):
+		# Not linux, fall back to the peak rss which macOS reports in bytes
+		max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		return max_rss // 1024 if sys.platform == 'darwin' else max_rss
@@ -0,0 +1,70 @@
+"""
+Workflows built from tasks: a group runs tasks in parallel, a chord runs a callback once every task of a group
+finished, and a chain runs tasks one after the other.
+
+Example:
+group = workflows.chord(
+	[Task(kallable='myapp.tasks.resize', args=[image_id]) for image_id in image_ids],
+	callback=Task(kallable='myapp.tasks.notify'),
+)
+workflows.chain(Task(kallable='myapp.tasks.fetch'), Task(kallable='myapp.tasks.parse'), Task(kallable='myapp.tasks.index'))
+"""
+from django.core.exceptions import ValidationError
+
+
+def group(tasks, callback=None, batch_size=None):
+	"""
+	Create and publish tasks as a group, in one bulk_enqueue. Once every task of the group completed or failed,
+	`callback` is created with a `group_id` kwarg, so it can read the results of the group from the db.
+
+	:param tasks: iterable of unsaved Task instances
+	:param callback: optional unsaved Task
+	:param batch_size: passed through to bulk_create
+	:returns: tuple of (TaskGroup, list of (task, exception) for tasks which were saved but could not be published)
+	"""
+	from carrot.models import Task, TaskGroup
+
+	tasks = list(tasks)
+	if any(task.dedupe_key for task in tasks):
+		# A skipped duplicate would never count towards the group
+		raise ValidationError("The tasks of a group can't have a dedupe_key")
+	if callback is not None:
+		callback.validate()
+
+	task_group = TaskGroup.objects.create(
+		size=len(tasks),
+		remaining=len(tasks),
+		callback=callback.to_spec() if callback is not None else None,
+	)
+	if not tasks:
+		task_group.complete()
+		return task_group, []
+
+	for task in tasks:
+		task.group = task_group
+	return task_group, Task.objects.bulk_enqueue(tasks, batch_size=batch_size)
+
+
+def chord(tasks, callback, batch_size=None):
+	"""
+	A group with a callback, see group()
+	"""
+	return group(tasks, callback=callback, batch_size=batch_size)
+
+
+def chain(*tasks):
+	"""
+	Create and publish the first task; each following task is created and published once the one before it
+	completed. The chain stops at a task which fails.
+
+	:param tasks: unsaved Task instances, in the order they run
+	:returns: the first task
+	"""
+	assert tasks, "A chain needs at least one task"
+	for task in tasks[1:]:
+		task.validate()
+
+	first = tasks[0]
+	first.chain = [task.to_spec() for task in tasks[1:]] or None
+	first.save()
+	return first